@@ -1,31 +1,204 @@
 import sys
 import os
+import time
+import queue
 import datetime
-from pathlib import Path
-import piexif
 from send2trash import send2trash
 import json
+import sqlite3
 
 from PyQt5.QtWidgets import QMainWindow, QApplication, QWidget, QLabel, \
-    QPushButton, QVBoxLayout, QHBoxLayout, QFileDialog, QGridLayout, QScrollArea, \
-    QTextEdit, QFileSystemModel, QTreeView, QTreeWidget, QAction, QGraphicsView, QSizePolicy, QMessageBox, \
-    QFormLayout, QComboBox, QLineEdit, QGroupBox, QSizePolicy, QSpinBox, QProgressDialog
+    QPushButton, QVBoxLayout, QHBoxLayout, QFileDialog, QFileSystemModel, QTreeView, QAction, QMessageBox, \
+    QFormLayout, QComboBox, QLineEdit, QGroupBox, QSpinBox, QProgressBar, QDockWidget
 from PyQt5.QtGui import QPixmap
-from PyQt5.QtCore import Qt, QDir, QFileSystemWatcher, QTimer
+from PyQt5.QtCore import Qt, QDir, QFileSystemWatcher, QTimer, QThread, pyqtSignal
 
 
-from model import predict_image, save_changes
+import metrics
+from gallery import GalleryModel, GalleryView, PathRole, star_numbers
+from score_index import ScoreIndex, FIELDS, parse_conditions, scores_record
+from viewer_cache import FullImageCache, PREFETCH_RADIUS
+from exif_io import read_rating_tags
+from library_scan import scan_folder, iter_folders, SCAN_BATCH_INTERVAL
+from hot_folder import StabilityTracker, WriteRegistry, STABLE_POLL_INTERVAL
+from catalog import LibraryCatalog
+from model import predict_image, predict_images, save_changes, load_model, is_model_loaded, InferencePool, \
+    BACKENDS, set_backend, calculate_rating_percent, daemon_available
+
+# Loads the model weights off the UI thread so the window can paint first
+class ModelLoader(QThread):
+    loaded = pyqtSignal(str)  # Empty on success, otherwise the error message
+
+    def run(self):
+        try:
+            load_model()
+        except Exception as e:
+            self.loaded.emit(str(e) or type(e).__name__)
+            return
+        self.loaded.emit("")
+
+# Scores images off the UI thread, emitting each result as soon as it has been written so the
+# gallery updates live. requestInterruption() stops it after the batch being scored
+class AnalysisWorker(QThread):
+    scored = pyqtSignal(str, object)  # img_path, custom_dict (None when only the file was updated)
+    failed = pyqtSignal(str, str)     # img_path (empty when the whole analysis failed), error message
+
+    def __init__(self, img_paths, score, parent=None, cancel=None):
+        super().__init__(parent)
+        self.img_paths = img_paths
+        self.score = score  # Generator function (img_paths, on_error) -> (img_path, custom_dict)
+        # Called on interruption, True when the generator then ends by itself after reporting
+        # the images already being scored (worker pool), otherwise it is closed right away
+        self.cancel = cancel
+
+    def run(self):
+        def on_error(img_path, error):
+            self.failed.emit(img_path, str(error))
+
+        results = None
+        cancelled = False
+        try:
+            # Inside the try: building the worker pool loads the model, which may fail
+            results = self.score(self.img_paths, on_error)
+            for img_path, custom_dict in results:
+                self.scored.emit(img_path, custom_dict)
+                if self.isInterruptionRequested() and not cancelled:
+                    if self.cancel is None or not self.cancel():
+                        break
+                    cancelled = True
+        except Exception as e:
+            self.failed.emit("", str(e) or type(e).__name__)
+        finally:
+            if results is not None:
+                results.close()  # Stops decoding ahead right away
+
+# Reads the scores stored in the images of the library into a ScoreIndex off the UI thread,
+# from the library catalog for files that didn't change. Paths are added as they are found and
+# changes made by the UI are queued behind them (apply), so they land in order with the reads of
+# the paths they touch while the UI thread never waits. The UI queries the index directly.
+# When the catalog can't be written (locked by another instance, disk full) it is reported
+# through catalog_failed and the index goes on without it, reading the files instead
+class ScoreIndexLoader(QThread):
+    chunk_size = 256  # Paths read between interruption checks and catalog commits
+    changed = pyqtSignal()  # After each chunk read and change applied
+    catalog_failed = pyqtSignal(str)
+
+    def __init__(self, catalog=None, parent=None):
+        super().__init__(parent)
+        self.index = ScoreIndex(catalog=catalog)
+        self.queue = queue.Queue()
+
+    def add(self, img_paths, signatures=None):
+        self.queue.put((None, (list(img_paths), signatures)))
+
+    # Runs func(index, *args) on the loader thread once everything queued before it is done
+    def apply(self, func, *args):
+        self.queue.put((func, args))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                try:
+                    self.process(*item)
+                except sqlite3.Error as e:
+                    catalog, self.index.catalog = self.index.catalog, None
+                    if catalog is not None:
+                        catalog.rollback()
+                    self.catalog_failed.emit(str(e))
+                    self.process(*item)  # Changes are applied in memory again, paths read from the files
+            finally:
+                self.queue.task_done()
+
+    def process(self, func, args):
+        if func is not None:
+            func(self.index, *args)
+            self.changed.emit()
+            return
+        img_paths, signatures = args
+        for start in range(0, len(img_paths), self.chunk_size):
+            if self.isInterruptionRequested():
+                break
+            self.index.load(img_paths[start:start + self.chunk_size], signatures)
+            self.changed.emit()
+
+    # True while added paths or changes are still queued
+    def busy(self):
+        return self.queue.unfinished_tasks > 0
+
+    def stop(self):
+        self.requestInterruption()
+        self.queue.put(None)
+        self.wait()
+
+# Lists a folder (and its subfolders when recursive) off the UI thread. found is emitted with
+# [(folder, img_paths)] for the first folder holding images right away, then in batches, along
+# with img_path -> (size, mtime_ns) of the images in the batch
+class FolderScanner(QThread):
+    found = pyqtSignal(object, object)
+
+    def __init__(self, root, recursive, parent=None):
+        super().__init__(parent)
+        self.root = root
+        self.recursive = recursive
+        self.folders = 0
+        self.images = 0
+
+    def run(self):
+        batch = []
+        signatures = {}
+        shown = False
+        last_emit = time.perf_counter()
+        for folder, img_paths, folder_signatures in iter_folders(self.root, self.recursive, True):
+            if self.isInterruptionRequested():
+                return
+            batch.append((folder, img_paths))
+            signatures.update(folder_signatures)
+            self.folders += 1
+            self.images += len(img_paths)
+            if (img_paths and not shown) or time.perf_counter() - last_emit >= SCAN_BATCH_INTERVAL:
+                self.found.emit(batch, signatures)
+                batch = []
+                signatures = {}
+                shown = shown or bool(img_paths)
+                last_emit = time.perf_counter()
+        if batch:
+            self.found.emit(batch, signatures)
 
 class MainWindow(QMainWindow):
-    def __init__(self):
+    def __init__(self, inference_workers=1, blas_threads=1, prefetch_radius=PREFETCH_RADIUS):
         super().__init__()
+        self.inference_workers = inference_workers  # More than 1 scores in a pool of worker processes
+        self.blas_threads = blas_threads
+        self.inference_pool = None
+        self.scoring_pool = None  # inference_pool while the running analysis goes through it
+        self.analysis_worker = None
         self.all_image_paths = []
+        self.all_image_rows = {}  # img_path -> position in all_image_paths
         self.image_paths = []  # List to store image paths being used
         self.current_index = -1  # Track current image index for prev and next buttons, start with -1 (no image selected)
         self.is_initialized = False  # Flag to check if the gallery is initialized
-        self.edit_flag = False  # Flag to check if file updates are external or application
         self.filtered_flag = False 
-        self.selected_images = set()  # Store selected images
+        self.score_index = ScoreIndex()  # Scores of all_image_paths, for filtering and sorting
+        self.score_index_loader = None
+        self.catalog = None  # Library catalog of the loaded folder
+        self.folder_scanner = None
+        self.subtree_scanners = {}  # New subfolder of the library -> FolderScanner listing it
+        self.scan_recursive = False
+        self.folder_images = {}  # Watched folder -> set of the image paths directly inside it
+        self.changed_folders = set()
+        self.self_writes = WriteRegistry()  # EXIF writes of the app, not external changes
+        self.new_files = StabilityTracker()  # Files that landed in a watched folder, taken in once complete
+        self.auto_queue = []  # Complete new files waiting to be auto-analysed
+        self.analysis_auto = False
+        self.analysis_pending = set()
+        self.full_image_cache = FullImageCache(self, prefetch_radius)  # Display-size images around current_index
+        self.full_image_cache.ready.connect(self.on_full_image_ready)
+        self.gallery_model = GalleryModel(self)
+        self.gallery_model.set_score_index(self.score_index)
+        self.selected_images = self.gallery_model.selected  # Store selected images
 
         # Timer to delay the directory change handling
         self.change_timer = QTimer(self)
@@ -33,6 +206,11 @@ class MainWindow(QMainWindow):
         self.change_timer.setInterval(500)  # Set interval for debouncing (500 ms)
         self.change_timer.timeout.connect(self.handle_directory_change)
 
+        # Polls new files until their size settles
+        self.new_files_timer = QTimer(self)
+        self.new_files_timer.setInterval(STABLE_POLL_INTERVAL)
+        self.new_files_timer.timeout.connect(self.check_new_files)
+
         self.setWindowTitle("AestheticSense")
         self.resize(1400, 950)
 
@@ -80,23 +258,45 @@ class MainWindow(QMainWindow):
         self.filter_btn.clicked.connect(self.load_filtered_images)
         self.filter_btn.setVisible(False)  # Hidden initially
 
+        # Attribute thresholds, sort order and top-K, answered from the score index
+        self.filter_query = QLineEdit()
+        self.filter_query.setPlaceholderText("e.g. rating >= 4, fc9_MotionBlur < -0.2")
+        self.filter_query.returnPressed.connect(self.load_filtered_images)
+        self.sort_field = QComboBox()
+        self.sort_field.addItem("No Sort", None)
+        for field in FIELDS:
+            self.sort_field.addItem("Sort by " + field, field)
+        self.sort_order = QComboBox()  # Images without the field come last either way
+        self.sort_order.addItem("Highest First", True)
+        self.sort_order.addItem("Lowest First", False)
+        self.sort_order.currentIndexChanged.connect(
+            lambda index: self.top_k.setPrefix("Top " if self.sort_order.currentData() else "Bottom "))
+        self.top_k = QSpinBox()
+        self.top_k.setRange(0, 1000000)
+        self.top_k.setPrefix("Top ")
+        self.top_k.setSpecialValueText("All")
+        self.filter_controls = QWidget()
+        filter_controls_layout = QHBoxLayout(self.filter_controls)
+        filter_controls_layout.setContentsMargins(0, 0, 0, 0)
+        filter_controls_layout.addWidget(self.filter_query)
+        filter_controls_layout.addWidget(self.sort_field)
+        filter_controls_layout.addWidget(self.sort_order)
+        filter_controls_layout.addWidget(self.top_k)
+        self.filter_controls.setVisible(False)
+
         # Adding to Horizontal Layout
         self.analyse_bar.addWidget(self.analyse_btn)
         self.analyse_bar.addWidget(self.analyse_current_btn)
         self.analyse_bar.addWidget(self.analyse_selected_btn)
         self.analyse_bar.addWidget(self.filter_btn)
         self.analyse_bar.addWidget(self.filter_value)
+        self.analyse_bar.addWidget(self.filter_controls)
 
-        # Grid Layout for Image Blocks
-        self.grid_layout = QGridLayout()
-
-        # Scroll Area for Images
-        self.scroll_area = QScrollArea()
-        self.scroll_widget = QWidget()
-        self.scroll_widget.setLayout(self.grid_layout)
-        self.scroll_area.setWidget(self.scroll_widget)
-        self.scroll_area.setWidgetResizable(True)
-        self.image_center.addWidget(self.scroll_area)
+        # Gallery of image tiles, only the visible tiles are painted and have thumbnails loaded
+        self.gallery = GalleryView()
+        self.gallery.setModel(self.gallery_model)
+        self.gallery.clicked.connect(self.on_gallery_clicked)
+        self.image_center.addWidget(self.gallery)
 
         # Full-Size Image Viewer
         self.full_image_label = QLabel()
@@ -185,22 +385,364 @@ class MainWindow(QMainWindow):
         self.Load_Files.triggered.connect(self.load_files)
         self.menuFile.addAction(self.Load_Files)
 
+        self.Include_Subfolders = QAction("Include Subfolders", self)
+        self.Include_Subfolders.setCheckable(True)  # Load Folder scans the whole tree below the folder
+        self.menuFile.addAction(self.Include_Subfolders)
+
+        self.Auto_Analyse = QAction("Auto-Analyse New Images", self)
+        self.Auto_Analyse.setCheckable(True)  # Images landing in a watched folder are scored once complete
+        self.menuFile.addAction(self.Auto_Analyse)
+
+        # Watches every scanned folder, changes are applied as a delta by handle_directory_change
         self.folder_watcher = QFileSystemWatcher(self)
+        self.folder_watcher.directoryChanged.connect(self.on_directory_changed)
+
+        # Model state shown in the status bar, the net is only built on warm up or first analysis
+        self.model_loader = None
+        self.model_status_label = QLabel("Model not loaded")
+        self.statusBar().addPermanentWidget(self.model_status_label)
+
+        # Progress of the running analysis, the window stays usable while it runs
+        self.analysis_progress = QProgressBar()
+        self.analysis_progress.setMaximumWidth(250)
+        self.analysis_progress.setFormat("Analysing %v/%m")
+        self.analysis_progress.setVisible(False)
+        self.analysis_cancel_btn = QPushButton("Cancel")
+        self.analysis_cancel_btn.clicked.connect(self.cancel_analysis)
+        self.analysis_cancel_btn.setVisible(False)
+        self.statusBar().addPermanentWidget(self.analysis_progress)
+        self.statusBar().addPermanentWidget(self.analysis_cancel_btn)
+
+        # Live pipeline stats, metrics are only collected while the panel is open (or --metrics-file is set)
+        self.stats_label = QLabel()
+        self.stats_label.setAlignment(Qt.AlignLeft | Qt.AlignTop)
+        self.stats_label.setStyleSheet("font-family: monospace;")
+        self.stats_dock = QDockWidget("Pipeline Stats", self)
+        self.stats_dock.setWidget(self.stats_label)
+        self.stats_dock.setVisible(False)
+        self.stats_dock.visibilityChanged.connect(self.on_stats_visibility)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.stats_dock)
+        self.menuView = self.menubar.addMenu("View")
+        self.menuView.addAction(self.stats_dock.toggleViewAction())
+
+        self.stats_timer = QTimer(self)
+        self.stats_timer.setInterval(1000)
+        self.stats_timer.timeout.connect(self.update_stats_panel)
+        self.metrics_writer = None
+
+    # Not loaded here while a scoring daemon runs, the analysis goes through the daemon
+    def warm_model(self):
+        if is_model_loaded() or self.model_loader is not None:
+            self.update_model_status()
+            return
+        if daemon_available():
+            self.model_status_label.setText("Using scoring daemon")
+            return
+        self.model_status_label.setText("Model loading...")
+        self.model_loader = ModelLoader(self)
+        self.model_loader.loaded.connect(self.on_model_loaded)
+        self.model_loader.start()
+
+    def on_model_loaded(self, error):
+        self.model_loader = None
+        if error:
+            self.model_status_label.setText("Model failed to load")
+            self.model_status_label.setToolTip(error)
+            return
+        self.update_model_status()
+
+    # Analyse buttons go through the worker pool when started with --workers N, and through
+    # the scoring daemon (see predict_images) when one is running. Runs on the analysis thread,
+    # so the pool's net load and fork don't block the window
+    def score_images(self, img_paths, on_error=None):
+        if self.inference_workers > 1 and not daemon_available():
+            if self.inference_pool is None:
+                self.inference_pool = InferencePool(self.inference_workers, self.blas_threads)
+            self.scoring_pool = self.inference_pool
+            return self.inference_pool.predict_images(img_paths, on_error=on_error)
+        return predict_images(img_paths, on_error=on_error)
+
+    # Called on the analysis thread when it is interrupted, see AnalysisWorker
+    def cancel_scoring(self):
+        if self.scoring_pool is None:
+            return False
+        self.scoring_pool.cancel()
+        return True
+
+    # Single images go through predict_image, which uses the scoring daemon when one is running
+    def score_single_images(self, img_paths, on_error=None):
+        for img_path in img_paths:
+            try:
+                yield predict_image(img_path), None
+            except Exception as e:
+                on_error(img_path, e)
+
+    def start_analysis(self, img_paths, score=None, auto=False):
+        if self.analysis_worker is not None:
+            QMessageBox.information(self, "Analysis Running", "Please wait for the current analysis to finish or cancel it.")
+            return
+        self.scoring_pool = None
+
+        self.analysis_total = len(img_paths)
+        self.analysis_done = 0
+        self.analysis_errors = []
+        self.analysis_progress.setRange(0, len(img_paths))
+        self.analysis_progress.setValue(0)
+        self.analysis_progress.setVisible(True)
+        self.analysis_cancel_btn.setEnabled(True)
+        self.analysis_cancel_btn.setVisible(True)
+        for button in (self.analyse_btn, self.analyse_current_btn, self.analyse_selected_btn):
+            button.setEnabled(False)
+
+        self.analysis_auto = auto
+        self.analysis_pending = set(img_paths)
+        self.self_writes.expect(self.analysis_pending)
+        self.analysis_worker = AnalysisWorker(img_paths, score or self.score_images, self, self.cancel_scoring)
+        self.analysis_worker.scored.connect(self.on_image_scored)
+        self.analysis_worker.failed.connect(self.on_image_failed)
+        self.analysis_worker.finished.connect(self.on_analysis_finished)
+        self.analysis_worker.start()
+
+    def on_image_scored(self, img_path, custom_dict):
+        self.self_writes.record(img_path)
+        self.analysis_pending.discard(img_path)
+        if custom_dict is not None:
+            self.change_score_index(ScoreIndex.update, img_path, scores_record(custom_dict))
+        else:
+            self.change_score_index(ScoreIndex.load, [img_path])  # Written by predict_image, read it back
+        self.set_metadata_panel(img_path)
+        self.set_grid_metadata(img_path)
+        self.analysis_done += 1
+        self.analysis_progress.setValue(self.analysis_done)
+
+    def on_image_failed(self, img_path, error):
+        self.analysis_errors.append((img_path, error))
+        if img_path in self.analysis_pending:
+            self.self_writes.finish([img_path])
+            self.analysis_pending.discard(img_path)
+        if img_path:
+            self.analysis_done += 1
+            self.analysis_progress.setValue(self.analysis_done)
+
+    def cancel_analysis(self):
+        if self.analysis_worker is not None:
+            self.analysis_worker.requestInterruption()
+            self.analysis_cancel_btn.setEnabled(False)
+            self.statusBar().showMessage("Cancelling analysis...")
+
+    def on_analysis_finished(self):
+        worker = self.analysis_worker
+        self.analysis_worker = None
+        worker.deleteLater()
+        self.self_writes.finish(self.analysis_pending)  # Cancelled before they were written
+        self.analysis_pending = set()
+
+        self.analysis_progress.setVisible(False)
+        self.analysis_cancel_btn.setVisible(False)
+        for button in (self.analyse_btn, self.analyse_current_btn, self.analyse_selected_btn):
+            button.setEnabled(True)
+
+        message = "{} {} of {} {}images".format("Auto-analysed" if self.analysis_auto else "Analysed",
+                                                self.analysis_done - len(self.analysis_errors), self.analysis_total,
+                                                "new " if self.analysis_auto else "")
+        if self.analysis_errors:
+            message += ", {} failed ({})".format(len(self.analysis_errors), self.analysis_errors[0][1])
+        self.statusBar().showMessage(message, 10000)
+        if not self.analysis_auto:
+            self.clearSelectedImages()  # The selection stays while new images are scored
+        self.update_model_status()
+        self.start_auto_analysis()
+
+    # Scores the queued new images in one run, images landing meanwhile go in the next one
+    def start_auto_analysis(self):
+        if self.analysis_worker is not None or not self.auto_queue:
+            return
+        img_paths = self.auto_queue
+        self.auto_queue = []
+        self.start_analysis(img_paths, auto=True)
+
+    def check_new_files(self):
+        complete = self.new_files.poll()
+        if not self.new_files:
+            self.new_files_timer.stop()
+        # Only files still in a watched folder, the folder may have gone meanwhile
+        complete = [img_path for img_path in complete
+                    if img_path in self.folder_images.get(os.path.dirname(img_path), ())]
+        if not complete:
+            return
+        self.add_images(complete)
+        if self.Auto_Analyse.isChecked():
+            self.auto_queue.extend(complete)
+            self.start_auto_analysis()
+
+    def closeEvent(self, event):
+        if self.analysis_worker is not None:
+            self.analysis_worker.requestInterruption()
+            self.analysis_worker.wait()
+        self.stop_scan()
+        if self.score_index_loader is not None:
+            self.score_index_loader.stop()
+        self.open_catalog(None)
+        if self.inference_pool is not None:
+            self.inference_pool.terminate()
+            self.inference_pool = None
+        if self.metrics_writer is not None:
+            self.metrics_writer.stop()
+            self.metrics_writer = None
+        self.gallery_model.stop()
+        self.full_image_cache.stop()
+        super().closeEvent(event)
+
+    def start_metrics_file(self, path, interval):
+        metrics.enable()
+        self.metrics_writer = metrics.PrometheusFileWriter(path, interval).start()
+
+    def on_stats_visibility(self, visible):
+        if visible:
+            metrics.enable()
+            self.update_stats_panel()
+            self.stats_timer.start()
+        else:
+            self.stats_timer.stop()
+            if self.metrics_writer is None:
+                metrics.enable(False)
+
+    def update_stats_panel(self):
+        snapshot = metrics.snapshot()
+        counters = snapshot['counters']
+        lines = ["Images scored:   {}".format(counters.get('images_scored', 0)),
+                 "Images failed:   {}".format(counters.get('images_failed', 0)),
+                 "Images/s (now):  {:.1f}".format(snapshot['recent_images_per_second']),
+                 "Images/s (avg):  {:.1f}".format(snapshot['images_per_second'])]
+        if snapshot['cache_hit_rate'] is not None:
+            lines.append("Cache hit rate:  {:.0%}".format(snapshot['cache_hit_rate']))
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append("{}: {}".format(name.replace('_', ' ').capitalize(), value))
+        lines.append("")
+        lines.append("{:<13}{:>7}{:>9}{:>9}".format("Stage (ms)", "count", "p50", "p95"))
+        for stage, stats in sorted(snapshot['stages'].items()):
+            lines.append("{:<13}{:>7}{:>9.1f}{:>9.1f}".format(stage, stats['count'], stats['p50_ms'], stats['p95_ms']))
+        self.stats_label.setText("\n".join(lines))
+
+    def update_model_status(self):
+        if is_model_loaded():
+            self.model_status_label.setText("Model ready")
+            self.model_status_label.setToolTip("")
 
     def load_folder(self):
         folder = QFileDialog.getExistingDirectory(self, "Select Image Folder")
 
         if folder:
-            # Load all images from the selected folder
-            self.image_paths = [os.path.join(folder, f) for f in os.listdir(folder) 
-                                if f.lower().endswith(('.jpg', '.jpeg'))]
-
-            if not self.image_paths:
-                QMessageBox.warning(self, "No Images Found", "No images found in the selected folder!", QMessageBox.Ok)
-                return
-            
-            self.setTree(folder)
-            self.basic_load()
+            self.scan_library(os.path.normpath(folder), self.Include_Subfolders.isChecked())
+
+    # Lists the folder on a background thread, the gallery is shown with the first folder holding
+    # images and grows as the rest of the scan comes in
+    def scan_library(self, folder, recursive):
+        self.stop_scan()
+        self.open_catalog(folder)
+        self.setTree(folder)
+        self.scan_recursive = recursive
+        self.folder_images = {}
+        self.changed_folders.clear()
+        self.new_files = StabilityTracker()
+        self.auto_queue = []
+        self.scan_loaded = False
+        self.folder_scanner = FolderScanner(folder, recursive, self)
+        self.folder_scanner.found.connect(self.on_folders_scanned)
+        self.folder_scanner.finished.connect(self.on_scan_finished)
+        self.folder_scanner.start()
+        self.statusBar().showMessage("Scanning " + folder + "...")
+
+    def on_folders_scanned(self, batch, signatures):
+        scanner = self.sender()
+        if scanner is None or scanner is not self.folder_scanner:
+            return  # Still queued from a scan that was replaced by a newer one
+        img_paths = []
+        for folder, folder_paths in batch:
+            self.folder_images[folder] = set(folder_paths)
+            img_paths.extend(folder_paths)
+        self.folder_watcher.addPaths([folder for folder, _ in batch])
+        if not img_paths:
+            return
+        if not self.scan_loaded:
+            self.scan_loaded = True
+            self.image_paths = img_paths
+            self.basic_load(signatures)
+        else:
+            self.add_images(img_paths, signatures)
+
+    def on_scan_finished(self):
+        scanner = self.folder_scanner
+        if scanner is None or scanner is not self.sender():
+            return  # A scan that was replaced by a newer one
+        self.folder_scanner = None
+        scanner.deleteLater()
+        self.statusBar().showMessage("Found {} images in {} folders".format(scanner.images, scanner.folders), 10000)
+        if self.catalog is not None:
+            try:
+                self.catalog.prune(self.folder_images)  # Forget the images deleted while the library was closed
+            except sqlite3.Error as e:
+                self.statusBar().showMessage("Library catalog not saved: " + str(e))
+        if not self.scan_loaded:
+            QMessageBox.warning(self, "No Images Found", "No images found in the selected folder!", QMessageBox.Ok)
+
+    def stop_scan(self):
+        self.stop_subtree_scans()
+        if self.folder_scanner is not None:
+            scanner = self.folder_scanner
+            self.folder_scanner = None
+            scanner.found.disconnect(self.on_folders_scanned)
+            scanner.requestInterruption()
+            scanner.wait()
+            scanner.deleteLater()
+
+    # Lists a subfolder that appeared in the library on a background thread, like scan_library,
+    # so copying a large folder tree in doesn't freeze the window
+    def scan_subtree(self, folder):
+        scanner = FolderScanner(folder, True, self)
+        scanner.found.connect(self.on_subtree_scanned)
+        scanner.finished.connect(self.on_subtree_finished)
+        self.subtree_scanners[folder] = scanner
+        scanner.start()
+
+    def on_subtree_scanned(self, batch, signatures):
+        if self.sender() not in self.subtree_scanners.values():
+            return  # Stopped while its batches were queued
+        added = []
+        for folder, folder_paths in batch:
+            self.folder_images[folder] = set(folder_paths)
+            added.extend(folder_paths)
+        self.folder_watcher.addPaths([folder for folder, _ in batch])
+        if added:
+            self.new_files.add(added)
+            self.new_files_timer.start()
+
+    def on_subtree_finished(self):
+        scanner = self.sender()
+        if scanner in self.subtree_scanners.values():
+            del self.subtree_scanners[scanner.root]
+            scanner.deleteLater()
+
+    # Stops the subtree scans of folder and the folders below it, every one when folder is None
+    def stop_subtree_scans(self, folder=None):
+        prefix = None if folder is None else os.path.join(folder, '')
+        for root in [r for r in self.subtree_scanners if prefix is None or r == folder or r.startswith(prefix)]:
+            scanner = self.subtree_scanners.pop(root)
+            scanner.found.disconnect(self.on_subtree_scanned)
+            scanner.requestInterruption()
+            scanner.wait()
+            scanner.deleteLater()
+
+    # Catalog of the library at folder, None for loose files or when the cache folder isn't writable
+    def open_catalog(self, folder):
+        if self.catalog is not None:
+            self.catalog.close()
+            self.catalog = None
+        if folder is not None:
+            try:
+                self.catalog = LibraryCatalog(folder)
+            except (sqlite3.Error, OSError):
+                self.catalog = None
 
     def load_files(self):
         files, files_types = QFileDialog.getOpenFileNames(None, "Select Files", "", "Images (*.jpg *.jpeg)")
@@ -210,28 +752,101 @@ class MainWindow(QMainWindow):
             QMessageBox.warning(self, "No Images Found", "No images found!", QMessageBox.Ok)
             return
             
-        self.folder_watcher.removePaths(self.folder_watcher.directories())
+        self.stop_scan()
+        self.open_catalog(None)
+        self.folder_images = {}
+        self.new_files = StabilityTracker()
+        self.auto_queue = []
+        if self.folder_watcher.directories():
+            self.folder_watcher.removePaths(self.folder_watcher.directories())
         self.treeWidget.setModel(None)
         self.basic_load()
 
-    def basic_load(self): 
-        self.all_image_paths = self.image_paths.copy()
+    def basic_load(self, signatures=None):
+        self.set_all_image_paths(self.image_paths.copy())
+        self.filtered_flag = False  # Images added while loading go straight to the gallery
         self.analyse_btn.setVisible(True) 
         self.analyse_selected_btn.setVisible(True)
         self.filter_btn.setVisible(True)  
         self.filter_value.setVisible(True)  
+        self.filter_controls.setVisible(True)
         self.prev_btn.setVisible(False)
         self.next_btn.setVisible(False)
         self.analyse_current_btn.setVisible(False)
         self.metadata_panel.setVisible(False)
+        self.start_score_index(self.all_image_paths, signatures)
         self.display_images()
-    
+
+    def start_score_index(self, img_paths, signatures=None):
+        if self.score_index_loader is not None:
+            self.score_index_loader.stop()
+            self.score_index_loader.deleteLater()
+        self.score_index_loader = ScoreIndexLoader(self.catalog, self)
+        self.score_index_loader.catalog_failed.connect(self.on_catalog_failed)
+        self.score_index_loader.changed.connect(self.gallery_model.ratings_changed)
+        self.score_index = self.score_index_loader.index
+        self.gallery_model.set_score_index(self.score_index)
+        self.score_index_loader.start()
+        self.score_index_loader.add(img_paths, signatures)
+
+    def on_catalog_failed(self, error):
+        if self.sender() is self.score_index_loader:
+            self.statusBar().showMessage("Library catalog not saved, scores are read from the files: " + error)
+
+    # Changes to the index go behind the reads still queued on the loader thread, so the UI
+    # doesn't wait for a library load to finish
+    def change_score_index(self, func, *args):
+        if self.score_index_loader is not None:
+            self.score_index_loader.apply(func, *args)
+        else:
+            func(self.score_index, *args)
+
+    # all_image_paths and its path -> position map always change together
+    def set_all_image_paths(self, img_paths):
+        self.all_image_paths = img_paths
+        self.all_image_rows = dict((img_path, row) for row, img_path in enumerate(img_paths))
+
+    # New images of the library, shown unless a filter is applied
+    def add_images(self, img_paths, signatures=None):
+        first = len(self.all_image_paths)
+        self.all_image_paths.extend(img_paths)
+        self.all_image_rows.update((img_path, row) for row, img_path in enumerate(img_paths, first))
+        if self.score_index_loader is not None:
+            self.score_index_loader.add(img_paths, signatures)
+        else:
+            self.score_index.load(img_paths, signatures)
+        if self.filtered_flag == False:
+            self.image_paths.extend(img_paths)
+            self.gallery_model.insert_paths(img_paths)
+
+    # Removes images that are gone from disk, the rest of the gallery is left alone
+    def remove_images(self, removed):
+        self.set_all_image_paths([img_path for img_path in self.all_image_paths if img_path not in removed])
+        self.auto_queue = [img_path for img_path in self.auto_queue if img_path not in removed]
+        self.self_writes.forget(removed)
+        self.change_score_index(ScoreIndex.remove, list(removed))
+        self.image_paths = [img_path for img_path in self.image_paths if img_path not in removed]
+        self.gallery_model.remove_paths(removed)
+        for img_path in removed:
+            self.full_image_cache.invalidate(img_path)
+
+    # Images edited by another program, their scores, thumbnail and viewer image are read again
+    def reload_images(self, img_paths):
+        self.self_writes.forget(img_paths)
+        if self.score_index_loader is not None:
+            self.score_index_loader.add(img_paths)
+        else:
+            self.score_index.load(img_paths)
+        for img_path in img_paths:
+            self.gallery_model.reload(img_path)
+            self.full_image_cache.invalidate(img_path)
+
     def setTree(self, folder):
         self.model = QFileSystemModel()
         self.model.setRootPath(folder)
         self.model.setNameFilters(["*.jpg", "*.jpeg"])  # Adjust for both .jpg and .jpeg files
         self.model.setNameFilterDisables(False)  # Enable the filter to show only those files
-        self.model.setFilter(QDir.Files)
+        self.model.setFilter(QDir.AllDirs | QDir.Files | QDir.NoDotAndDotDot)  # Subfolders are browsable too
         self.treeWidget.setModel(self.model)
         self.treeWidget.setRootIndex(self.model.index(folder))
         self.treeWidget.setColumnWidth(0, 250)
@@ -240,148 +855,101 @@ class MainWindow(QMainWindow):
         self.treeWidget.setColumnHidden(2, True)  # Hide the "Type" column
         self.treeWidget.setColumnHidden(3, True)  # Hide the "Date Modified" column
 
-        # Always clear old paths
-        self.folder_watcher.removePaths(self.folder_watcher.directories())
-
-        # Add new folder
-        self.folder_watcher.addPath(folder)
-        self.folder_watcher.directoryChanged.connect(self.on_directory_changed)
+        # Always clear old paths, the scan adds every folder it lists
+        if self.folder_watcher.directories():
+            self.folder_watcher.removePaths(self.folder_watcher.directories())
 
-    def on_directory_changed(self):
-        if self.edit_flag == True:
-            self.edit_flag = False
-            return
-        self.change_timer.start()
+    # Own writes fire this too, so the timer isn't restarted: a folder written to continuously
+    # (scores of a running analysis) would otherwise hold back the changes of every other one
+    def on_directory_changed(self, folder):
+        self.changed_folders.add(folder)
+        if not self.change_timer.isActive():
+            self.change_timer.start()
 
+    # Only the folders that changed are listed again, and only the delta is applied. New files
+    # are taken in once complete (see check_new_files), files changed by the app itself are skipped
     def handle_directory_change(self):
-        folder = self.folder_watcher.directories()[0]
-
-        new_image_paths = [os.path.join(folder, f) for f in os.listdir(folder) if f.lower().endswith(('.jpg', '.jpeg'))]
-        
-        removed = set(self.all_image_paths).difference(set(new_image_paths))
-        added = set(new_image_paths).difference(set(self.all_image_paths))
+        changed_folders = self.changed_folders
+        self.changed_folders = set()
+        score_index = self.score_index  # Images still queued are read fresh by the loader anyway
+
+        removed = set()
+        added = []
+        modified = []
+        for folder in sorted(changed_folders):
+            if folder not in self.folder_images:
+                continue  # Already dropped with a parent folder
+            if not os.path.isdir(folder):
+                removed.update(self.drop_folder(folder))  # Removed or renamed
+                continue
+
+            signatures = {}
+            img_paths, subfolders = scan_folder(folder, signatures)
+            known = self.folder_images[folder]
+            removed.update(known.difference(img_paths))
+            added.extend(img_path for img_path in img_paths if img_path not in known)
+            self.folder_images[folder] = set(img_paths)
+            for img_path in img_paths:
+                if img_path in known and img_path in score_index:
+                    signature = signatures.get(img_path)
+                    if signature != score_index.signature(img_path) and not self.self_writes.is_own(img_path, signature):
+                        modified.append(img_path)
+
+            for gone in [f for f in self.folder_images if os.path.dirname(f) == folder and f not in subfolders]:
+                removed.update(self.drop_folder(gone))
+            for gone in [f for f in self.subtree_scanners if os.path.dirname(f) == folder and f not in subfolders]:
+                self.stop_subtree_scans(gone)
+            if self.scan_recursive:
+                for subfolder in subfolders:
+                    if subfolder not in self.folder_images and subfolder not in self.subtree_scanners:
+                        self.scan_subtree(subfolder)
+
+        if removed:
+            self.new_files.discard(removed)
+            self.remove_images(removed)
+        if modified:
+            self.reload_images(modified)
+        if added:
+            self.new_files.add(added)
+            self.new_files_timer.start()
+
+    # Stops tracking folder and every folder below it, returns the images they held
+    def drop_folder(self, folder):
+        self.stop_subtree_scans(folder)
+        removed = set()
+        prefix = os.path.join(folder, '')
+        for gone in [f for f in self.folder_images if f == folder or f.startswith(prefix)]:
+            removed.update(self.folder_images.pop(gone))
+            self.folder_watcher.removePath(gone)
+        return removed
 
-        if not removed and not added:
-            return
-        
-        self.all_image_paths = new_image_paths.copy()
-
-        if self.full_image_label.isVisible() == False and self.filtered_flag == False:
-            self.clearLayout(self.grid_layout)
-            self.selected_images.clear()
-            self.image_paths = new_image_paths.copy()
-            self.display_images() 
-            return
-
-        if self.filtered_flag == False:
-            self.clearLayout(self.grid_layout)
-            self.selected_images.clear()
-            self.image_paths = new_image_paths.copy()
-            row = 0
-            for img_path in self.image_paths:
-                self.addImage(img_path, row, 0) # All in one column
-                row += 1
-        
     def display_images(self):
         if not self.image_paths:
+            self.gallery_model.set_paths([])  # The gallery always shows image_paths
             QMessageBox.warning(self, "No Images Found", "No images found!", QMessageBox.Ok)
             return
 
         self.current_index = 0  # Set to first image index
         self.is_initialized = True  # Mark as initialized
         self.full_image_label.setVisible(False) # Initially hide the full image
-        self.clearLayout(self.grid_layout)
-        self.selected_images.clear()
-        row, col = 0, 0
-            
-        for img_path in self.image_paths:
-            self.addImage(img_path, row, col)
-            col += 1
-            if col >= 5:  # 5 images per row
-                col = 0
-                row += 1
-
-        self.grid_layout.setColumnStretch(self.grid_layout.columnCount(), 1)
-        self.grid_layout.setRowStretch(self.grid_layout.rowCount(), 1)
-
-    def clearLayout(self, layout):
-        if layout is not None:
-            while layout.count():
-                item = layout.takeAt(0)
-                widget = item.widget()
-                if widget is not None:
-                    widget.deleteLater()
-                else:
-                    self.clearLayout(item.layout())
-
-    def addImage(self, img_path, row, col):
-        exif_dict = piexif.load(img_path)
-        rating = exif_dict["0th"].get(18246, None)
-        
-        # Load and scale image while keeping aspect ratio
-        img = QPixmap(img_path).scaled(300, 300, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-        vbox = QVBoxLayout()
-        
-        label = QLabel()
-        label.setFixedSize(320, 320)
-        label.setPixmap(img)
-        label.setAlignment(Qt.AlignCenter | Qt.AlignTop)
-        
-        line = os.path.basename(img_path)
-        line = "\u200b".join(line)
-        line += "\n"
-        line += self.star_numbers(rating)
-        stars_label = QLabel(line)  # Adding stars
-        stars_label.setWordWrap(True)
-        stars_label.setStyleSheet("background-color: lightgrey; border: solid blue; padding: 0px; border-radius: 10px;")
-        stars_label.setAlignment(Qt.AlignCenter | Qt.AlignTop)    
-        stars_label.setFixedWidth(320)  
-        stars_label.setFixedHeight(50)  
-
-        vbox.addWidget(label)
-        vbox.addWidget(stars_label)
-        label.mousePressEvent = lambda event, path=img_path, lbl=label: self.label_clicked(event, path, lbl)
-        widget = QWidget()
-        widget.setLayout(vbox)
-        widget.setStyleSheet("background-color: grey; border: solid blue; padding: 0px; border-radius: 10px;")
-        self.grid_layout.addWidget(widget, row, col)
+        self.gallery.set_multi_row(True)
+        self.gallery_model.set_paths(self.image_paths)  # Tiles and thumbnails are created as they scroll into view
 
     def switch_gallery_layout(self, layout_type):
         self.clearSelectedImages()
-        widgets = []
-        while self.grid_layout.count():
-            item = self.grid_layout.takeAt(0)
-            widget = item.widget()
-            if widget:
-                widgets.append(widget) 
-        if layout_type == 'multi-row':
-            row, col = 0, 0
-            for widget in widgets:
-                self.grid_layout.addWidget(widget, row, col)
-                col += 1
-                if col >= 5:  # 5 images per row
-                    col = 0
-                    row += 1
-        elif layout_type == 'single-column':
-            row = 0
-            col = 0
-            for widget in widgets:
-                self.grid_layout.addWidget(widget, row, 0)  # All in one column
-                row += 1
-
-    def label_clicked(self, event, path, lbl):
-        if event.button() == Qt.LeftButton and not event.modifiers():  
+        self.gallery.set_multi_row(layout_type == 'multi-row')
+
+    def on_gallery_clicked(self, index):
+        path = index.data(PathRole)
+        modifiers = QApplication.keyboardModifiers()
+        if not modifiers:
             self.toggle_full_image(path)  # (show/hide full image)
-        elif  event.modifiers() & Qt.ControlModifier:  # Ctrl + Click
-            self.toggle_selection(path, lbl) 
+        elif modifiers & Qt.ControlModifier:  # Ctrl + Click
+            self.toggle_selection(path)
 
-    def toggle_selection(self, img_path, label):
-        if img_path in self.selected_images:
-            self.selected_images.remove(img_path)
-            label.setStyleSheet("")  # Normal
-        else:
-            self.selected_images.add(img_path)
-            label.setStyleSheet("background-color: lightblue; border: solid blue;")  # Highlighted
+    def toggle_selection(self, img_path):
+        # Highlighted while selected
+        self.gallery_model.set_selected(img_path, img_path not in self.selected_images)
 
     def toggle_full_image(self, img_path):
         if self.full_image_label.isVisible() and self.current_full_image == img_path:
@@ -393,6 +961,7 @@ class MainWindow(QMainWindow):
             self.analyse_current_btn.setVisible(False) # Hide analyse button
             self.filter_btn.setVisible(True)
             self.filter_value.setVisible(True)   
+            self.filter_controls.setVisible(True)
         elif self.full_image_label.isVisible():
             self.show_full_image(img_path)
             self.clearSelectedImages()
@@ -403,26 +972,30 @@ class MainWindow(QMainWindow):
             self.next_btn.setVisible(True)
             self.filter_btn.setVisible(False)  
             self.filter_value.setVisible(False)  
+            self.filter_controls.setVisible(False)
 
     def show_full_image(self, img_path):
-        exif_dict = piexif.load(img_path)
-        rating = exif_dict["0th"].get(18246, None)
+        tags = read_rating_tags(img_path)  # Only the EXIF header is read
+        rating = tags.get('rating')
         date = datetime.datetime.fromtimestamp(os.path.getctime(img_path)).strftime("%d-%m-%Y")
 
-        pixmap = QPixmap(img_path)
-        scaled_pixmap = pixmap.scaled(self.full_image_label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation)
-        self.full_image_label.setPixmap(scaled_pixmap)
-
-        if img_path in self.image_paths:
-            self.current_index = self.image_paths.index(img_path)
-        else:
-            self.current_index = -1
+        self.current_index = self.gallery_model.row_of(img_path)  # -1 when not in the gallery
+
+        # Decoded at display size, usually already prefetched when stepping through the gallery.
+        # Otherwise the thumbnail stands in until on_full_image_ready
+        self.full_image_cache.set_size(self.full_image_label.width(), self.full_image_label.height())
+        pixmap = self.full_image_cache.show(img_path, self.image_paths, self.current_index)
+        if pixmap is None:
+            pixmap = self.gallery_model.thumbnails.get(img_path)
+            if pixmap is not None:
+                pixmap = pixmap.scaled(self.full_image_label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        self.full_image_label.setPixmap(pixmap if pixmap is not None else QPixmap())
         
         self.full_image_label.setVisible(True)  # Show the full image
         self.metadata_panel.setVisible(True)
         self.analyse_current_btn.setVisible(True)  # Show button when image is displayed
 
-        highlights, improvements, aesthetic_score = self.aesthetic_comments(exif_dict)
+        highlights, improvements, aesthetic_score = self.aesthetic_comments(tags.get('user_comment'))
 
         self.current_full_image = img_path
         line = os.path.basename(img_path)
@@ -439,6 +1012,11 @@ class MainWindow(QMainWindow):
         else:
             self.edit_rating.setValue(0)
 
+    def on_full_image_ready(self, img_path):
+        pixmap = self.full_image_cache.pixmaps.get(img_path)
+        if pixmap is not None and self.full_image_label.isVisible() and self.current_full_image == img_path:
+            self.full_image_label.setPixmap(pixmap)
+
     def show_previous(self):
         if self.image_paths and self.current_index > 0:
             self.current_index -= 1
@@ -450,66 +1028,47 @@ class MainWindow(QMainWindow):
             self.show_full_image(self.image_paths[self.current_index])
 
     def on_item_clicked(self, index):
-        file_path = self.model.filePath(index)
-
-        # Replace the last forward slash with a backslash
-        file_path = file_path.rsplit('/', 1)
-        if len(file_path) > 1:
-            file_path = file_path[0] + '\\' + file_path[1]
-        else:
-            file_path = file_path[0]  # in case there's no forward slash in the path
+        if self.model.isDir(index):
+            return  # Folders only expand
+        # Qt paths use forward slashes, the gallery uses the native separator
+        file_path = os.path.normpath(self.model.filePath(index))
         self.toggle_full_image(file_path)
 
+    # Rating filter plus the conditions, sort and top-K from the filter bar, all answered from the score index
     def load_filtered_images(self):
-        self.image_paths = []
-        if (self.filter_value.currentText() == "No Filter"):
+        conditions = []
+        if (self.filter_value.currentText() != "No Filter"):
+            conditions.append(('rating', '==', float(self.filter_value.currentText())))
+        try:
+            conditions += parse_conditions(self.filter_query.text())
+        except ValueError as e:
+            QMessageBox.warning(self, "Invalid Filter", str(e), QMessageBox.Ok)
+            return
+        sort_field = self.sort_field.currentData()
+        top_k = self.top_k.value() or None
+
+        if not conditions and sort_field is None and top_k is None:
             self.filtered_flag = False
             self.image_paths = self.all_image_paths.copy()
             self.display_images()
             return
         
         self.filtered_flag = True
-        for img_path in self.all_image_paths:
-            try:
-                exif_dict = piexif.load(img_path)
-                rating = exif_dict["0th"].get(18246, None)
-
-                if rating == None:
-                    continue
-                if str(rating) == self.filter_value.currentText():
-                    self.image_paths.append(img_path)
-            except:
-                rating = None
+        self.image_paths = self.score_index.query(conditions, sort_field, self.sort_order.currentData(), top_k)
+        if self.score_index_loader is not None and self.score_index_loader.busy():
+            self.statusBar().showMessage("Still reading the library, filtered the {} images read so far".format(
+                len(self.score_index)), 10000)
         self.display_images()
 
     def set_grid_metadata(self, img_path):
-        if not img_path in self.image_paths:
-            return
-        
-        exif_dict = piexif.load(img_path)
-        rating = exif_dict["0th"].get(18246, None)
-        index = self.image_paths.index(img_path)
-        # Get the widget from the layout
-        vbox = self.grid_layout.itemAt(index).widget()  # Get the QWidget from the layout
-        # Retrieve the layout from the QWidget
-        vbox_layout = vbox.layout()  # Get the QVBoxLayout from the QWidget
-        stars_label = vbox_layout.itemAt(1).widget()  # The second widget, which is the stars label
-        line = os.path.basename(img_path)
-        line = "\u200b".join(line)
-        line += "\n"
-        line += self.star_numbers(rating)
-        # Update star info
-        stars_label.setText(line)      
-
-        label = vbox_layout.itemAt(0).widget()
-        label.mousePressEvent = lambda event, path=img_path, lbl=label: self.label_clicked(event, path, lbl)
+        self.gallery_model.refresh(img_path)  # Repaints the tile with the new name and stars
 
     def set_metadata_panel(self, img_path):
         if self.full_image_label.isVisible() and self.current_full_image == img_path:
-            exif_dict = piexif.load(img_path)
-            rating = exif_dict["0th"].get(18246, None)
+            tags = read_rating_tags(img_path)
+            rating = tags.get('rating')
             date = datetime.datetime.fromtimestamp(os.path.getctime(img_path)).strftime("%d-%m-%Y")
-            highlights, improvements, aesthetic_score = self.aesthetic_comments(exif_dict)
+            highlights, improvements, aesthetic_score = self.aesthetic_comments(tags.get('user_comment'))
             line = os.path.basename(img_path)
             self.image_name_label.setText("\u200b".join(line))
             self.date_label.setText(date)
@@ -527,24 +1086,7 @@ class MainWindow(QMainWindow):
         if button_reply == QMessageBox.No:
             return
         
-        progress = QProgressDialog("Analysing images...", "Cancel", 0, len(self.image_paths), self)
-        progress.setWindowModality(Qt.WindowModal)
-        progress.setMinimumDuration(0)  # Show immediately compared to default of 4 secs
-
-        i = 0
-        for img_path in self.image_paths:
-            progress.setValue(i)
-            if progress.wasCanceled():
-                break
-
-            self.edit_flag = True
-            img_path = predict_image(img_path)
-            self.set_metadata_panel(img_path)
-            self.set_grid_metadata(img_path)
-            i += 1
-
-        progress.setValue(len(self.image_paths))
-        self.clearSelectedImages()
+        self.start_analysis(list(self.image_paths))
 
     def analyse_current_image(self):
         if self.current_index < 0 or self.current_index >= len(self.image_paths):
@@ -554,18 +1096,7 @@ class MainWindow(QMainWindow):
         if button_reply == QMessageBox.No:
             return
         
-        progress = QProgressDialog("Analysing images...", "Cancel", 0, 1, self)
-        progress.setWindowModality(Qt.WindowModal)
-        progress.setMinimumDuration(0)  # Show immediately compared to default of 4 secs
-
-        self.edit_flag = True
-        img_path = self.current_full_image  # Get the current image
-        img_path = predict_image(img_path)
-        self.set_metadata_panel(img_path)
-        self.set_grid_metadata(img_path)
-
-        progress.setValue(1)
-        self.clearSelectedImages()
+        self.start_analysis([self.current_full_image], self.score_single_images)
 
     def analyse_selected_images(self):
         if not self.selected_images:
@@ -576,24 +1107,7 @@ class MainWindow(QMainWindow):
         if button_reply == QMessageBox.No:
             return
         
-        progress = QProgressDialog("Analysing images...", "Cancel", 0, len(self.selected_images), self)
-        progress.setWindowModality(Qt.WindowModal)
-        progress.setMinimumDuration(0)  # Show immediately compared to default of 4 secs
-
-        i = 0
-        for img_path in self.selected_images:
-            progress.setValue(i)
-            if progress.wasCanceled():
-                break
-
-            self.edit_flag = True
-            img_path = predict_image(img_path)
-            self.set_metadata_panel(img_path)
-            self.set_grid_metadata(img_path)
-            i += 1
-
-        progress.setValue(len(self.selected_images))
-        self.clearSelectedImages()
+        self.start_analysis(list(self.selected_images))
 
     def save_changes(self):
         button_reply = QMessageBox.question(self, 'Confirm Action', "Would You like to Save Changes?", QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
@@ -614,15 +1128,30 @@ class MainWindow(QMainWindow):
             return
             
         # Update paths inside image_paths and all_image_paths
-        if img_path in self.image_paths:
-            index = self.image_paths.index(img_path)
+        index = self.gallery_model.row_of(img_path)
+        if index >= 0:
             self.image_paths[index] = new_path
         
-        if img_path in self.all_image_paths:
-            index = self.all_image_paths.index(img_path)
+        index = self.all_image_rows.pop(img_path, None)
+        if index is not None:
             self.all_image_paths[index] = new_path
-
-        save_changes(new_path, self.edit_rating.value())
+            self.all_image_rows[new_path] = index
+        self.gallery_model.rename(img_path, new_path)
+        self.full_image_cache.invalidate(img_path)
+        self.self_writes.rename(img_path, new_path)
+        folder_paths = self.folder_images.get(directory)
+        if folder_paths is not None:  # Not seen as a removal and an addition by the watcher
+            folder_paths.discard(img_path)
+            folder_paths.add(new_path)
+
+        self.self_writes.expect([new_path])
+        try:
+            save_changes(new_path, self.edit_rating.value())
+        finally:
+            self.self_writes.record(new_path)
+        self.change_score_index(ScoreIndex.rename, img_path, new_path)
+        self.change_score_index(ScoreIndex.update, new_path, {
+            'rating': self.edit_rating.value(), 'rating_percent': calculate_rating_percent(self.edit_rating.value())})
         self.current_full_image = new_path
         self.set_grid_metadata(new_path)
         self.set_metadata_panel(new_path)
@@ -637,19 +1166,20 @@ class MainWindow(QMainWindow):
         path = os.path.abspath(img_path)
         send2trash(path) # Send to trash instead of actual deletion incase of a mistake
 
-        if img_path in self.image_paths:
-            self.image_paths.remove(img_path)
-        if img_path in self.all_image_paths:
-            self.all_image_paths.remove(img_path)
-
-        self.clearSelectedImages()
-        self.filtered_flag = False
-        self.image_paths = self.all_image_paths.copy()
-
-        if len(self.image_paths) == 0:
-            self.clearLayout(self.grid_layout)
-
-        self.display_images() 
+        index = self.gallery_model.row_of(img_path)
+        if index >= 0:
+            del self.image_paths[index]
+        index = self.all_image_rows.pop(img_path, None)
+        if index is not None:
+            del self.all_image_paths[index]
+            for row in range(index, len(self.all_image_paths)):  # Only the images after it move up
+                self.all_image_rows[self.all_image_paths[row]] = row
+        self.change_score_index(ScoreIndex.remove, [img_path])
+        self.gallery_model.remove_paths([img_path])  # Only its tile goes, the filter is kept
+        self.full_image_cache.invalidate(img_path)
+        self.folder_images.get(os.path.dirname(img_path), set()).discard(img_path)
+
+        self.switch_gallery_layout('multi-row')
         self.full_image_label.setVisible(False)  # Hide the full image
         self.prev_btn.setVisible(False)  # Hide the navigation buttons
         self.next_btn.setVisible(False)
@@ -657,41 +1187,21 @@ class MainWindow(QMainWindow):
         self.analyse_current_btn.setVisible(False) # Hide analyse button
         self.filter_btn.setVisible(True)
         self.filter_value.setVisible(True)  
+        self.filter_controls.setVisible(True)
 
     def clearSelectedImages(self):
-        for selected_images in self.selected_images:
-            index = self.image_paths.index(selected_images)
-            # Get the widget from the layout
-            vbox = self.grid_layout.itemAt(index).widget()  # Get the QWidget from the layout
-            # Retrieve the layout from the QWidget
-            vbox_layout = vbox.layout()  # Get the QVBoxLayout from the QWidget
-            image_label = vbox_layout .itemAt(0).widget()  # The first widget, which is the image label
-            image_label.setStyleSheet("")
-        self.selected_images.clear()
+        self.gallery_model.clear_selection()
 
     def star_numbers(self, number):
-        if number == None:
-            return "☆☆☆☆☆"
-        if number == 1:
-            return "★☆☆☆☆"
-        if number == 2:
-            return "★★☆☆☆"
-        if number == 3:
-            return "★★★☆☆"
-        if number == 4:
-            return "★★★★☆"
-        if number == 5:
-            return "★★★★★"
-
-    def aesthetic_comments(self, exif_dict):
+        return star_numbers(number)
+
+    # user_comment is the decoded UserComment of the image, None when it has none
+    def aesthetic_comments(self, user_comment):
         highlights = ""
         improvements = ""
         score = ""
 
-        try:
-            user_comment = piexif.helper.UserComment.load(exif_dict["Exif"][piexif.ExifIFD.UserComment])
-        except:
-            user_comment = None
+        if user_comment is None:
             return "", "", None
         
         # Convert string to dictionary
@@ -754,7 +1264,33 @@ class MainWindow(QMainWindow):
 
 if __name__ == "__main__":
     import sys
-    app = QApplication(sys.argv)
-    window = MainWindow()
+    import argparse
+    import multiprocessing
+    multiprocessing.freeze_support()  # Inference workers are spawned from the exe on Windows
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--no-warm", action="store_true", help="Load the model on first analysis instead of at startup")
+    parser.add_argument("--workers", type=int, default=1, help="Inference worker processes used by the analyse buttons")
+    parser.add_argument("--blas-threads", type=int, default=1, help="BLAS threads per inference worker")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), help="Inference backend (default: caffe)")
+    parser.add_argument("--prefetch", type=int, default=PREFETCH_RADIUS,
+                        help="Images decoded ahead on each side of the one shown in the viewer")
+    parser.add_argument("--recursive", action="store_true", help="Start with Include Subfolders checked")
+    parser.add_argument("--auto-analyse", action="store_true", help="Start with Auto-Analyse New Images checked")
+    parser.add_argument("--metrics-file", help="Prometheus text file of pipeline metrics, rewritten every 10s")
+    args, qt_args = parser.parse_known_args()
+    if args.backend:
+        set_backend(args.backend)
+
+    app = QApplication(sys.argv[:1] + qt_args)
+    window = MainWindow(inference_workers=args.workers, blas_threads=args.blas_threads,
+                        prefetch_radius=args.prefetch)
+    window.Include_Subfolders.setChecked(args.recursive)
+    window.Auto_Analyse.setChecked(args.auto_analyse)
+    if args.metrics_file:
+        window.start_metrics_file(args.metrics_file, 10.0)
     window.show()
+    # Warm the model once the window has painted, --no-warm defers loading to the first analysis
+    if not args.no_warm:
+        QTimer.singleShot(0, window.warm_model)
     sys.exit(app.exec_())
\ No newline at end of file
@@ -0,0 +1,184 @@
+import os
+import sys
+import json
+import time
+import fnmatch
+import datetime
+import argparse
+import multiprocessing
+
+import metrics
+from job_journal import JobJournal
+
+'''
+Headless batch scoring.
+Walks the given folders recursively, scores every matching image with model.py and streams one
+JSON line per image as soon as it is scored, so the output can be piped while a run is going:
+
+python batch_score.py /photos --workers 8 --write-exif > scores.jsonl
+python batch_score.py /photos --exclude "*/rejects/*" -o scores.jsonl
+
+With --journal the run becomes a resumable job: every finished image is appended to the
+journal, and running the same command again skips completed images and retries failed ones
+up to --max-retries times, reporting throughput and ETA on stderr.
+--metrics-file keeps a Prometheus text file of throughput, stage latencies, queue depth and
+cache hits up to date during the run, --metrics-json writes the final snapshot
+'''
+DEFAULT_INCLUDE = ['*.jpg', '*.jpeg']
+
+def matches(rel_path, patterns):
+    rel_path = rel_path.replace(os.sep, '/').lower()
+    name = rel_path.rsplit('/', 1)[-1]
+    for pattern in patterns:
+        pattern = pattern.lower()
+        if fnmatch.fnmatchcase(name, pattern) or fnmatch.fnmatchcase(rel_path, pattern):
+            return True
+    return False
+
+# Yields image paths lazily in a stable (sorted) order so scoring starts before the walk ends.
+# Patterns match either the file name or the path relative to the root given on the command line
+def iter_images(roots, include=DEFAULT_INCLUDE, exclude=()):
+    for root in roots:
+        if os.path.isfile(root):
+            yield root
+            continue
+        for folder, dirs, files in os.walk(root):
+            dirs.sort()
+            for name in sorted(files):
+                img_path = os.path.join(folder, name)
+                rel_path = os.path.relpath(img_path, root)
+                if matches(rel_path, include) and not matches(rel_path, exclude):
+                    yield img_path
+
+def score_record(img_path, custom_dict):
+    from model import calculate_rating
+
+    rating_percent = int(custom_dict['fc11_score']*100)
+    return {
+        'path': img_path,
+        'fc11_score': custom_dict['fc11_score'],
+        'rating': calculate_rating(rating_percent),
+        'rating_percent': rating_percent,
+        'attributes': custom_dict
+    }
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Score images and stream the results as JSON lines")
+    parser.add_argument('paths', nargs='+', help="Folders (walked recursively) or image files")
+    parser.add_argument('-o', '--output', default='-', help="Output file, - for stdout (default)")
+    parser.add_argument('--batch-size', type=int, default=None, help="Images per forward pass")
+    parser.add_argument('--workers', type=int, default=1, help="Inference worker processes")
+    parser.add_argument('--blas-threads', type=int, default=1, help="BLAS threads per worker process")
+    parser.add_argument('--write-exif', action='store_true', help="Also write the rating and scores into each file")
+    parser.add_argument('--backend', choices=['caffe', 'opencv', 'int8', 'fp16'], help="Inference backend (default: caffe)")
+    parser.add_argument('--no-cache', action='store_true', help="Don't use the persistent score cache")
+    parser.add_argument('--include', action='append', help="Glob of files to score, repeatable "
+                                                           "(default: *.jpg and *.jpeg)")
+    parser.add_argument('--exclude', action='append', default=[], help="Glob of files to skip, repeatable")
+    parser.add_argument('--journal', help="Journal file making the run resumable")
+    parser.add_argument('--max-retries', type=int, default=2, help="Retries of failed images on later runs")
+    parser.add_argument('--fsync-every', type=int, default=64, help="Journal records per fsync")
+    parser.add_argument('--progress-interval', type=float, default=10.0, help="Seconds between progress reports")
+    parser.add_argument('--metrics-file', help="Prometheus text file rewritten during the run")
+    parser.add_argument('--metrics-interval', type=float, default=10.0, help="Seconds between metrics file writes")
+    parser.add_argument('--metrics-json', help="Write a JSON snapshot of the pipeline metrics at the end")
+    return parser
+
+class Progress(object):
+    def __init__(self, total, interval):
+        self.total = total
+        self.interval = interval
+        self.start = self.last = time.monotonic()
+
+    def update(self, counts, force=False):
+        now = time.monotonic()
+        if not force and now - self.last < self.interval:
+            return
+        self.last = now
+
+        done = counts['scored'] + counts['failed']
+        rate = done / max(now - self.start, 1e-9)
+        eta = (self.total - done) / rate if rate > 0 else 0
+        sys.stderr.write("{}/{} done ({} failed), {:.1f} images/s, ETA {}\n".format(
+            done, self.total, counts['failed'], rate, datetime.timedelta(seconds=int(eta))))
+
+# Yields (img_path, custom_dict) for every image that scored, reporting failures through on_error
+def score_paths(img_paths, args, on_error):
+    import model
+
+    if args.backend:
+        model.set_backend(args.backend)
+    batch_size = args.batch_size or model.BATCH_SIZE
+    if args.workers > 1 and not model.daemon_available():  # A running daemon scores the batch instead
+        with model.InferencePool(args.workers, args.blas_threads, batch_size=batch_size) as pool:
+            yield from pool.predict_images(img_paths, write_exif=args.write_exif,
+                                           use_cache=not args.no_cache, on_error=on_error)
+    else:
+        yield from model.predict_images(img_paths, batch_size, write_exif=args.write_exif,
+                                        use_cache=not args.no_cache, on_error=on_error)
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    img_paths = iter_images(args.paths, args.include or DEFAULT_INCLUDE, args.exclude)
+
+    journal = None
+    progress = None
+    if args.journal:
+        journal = JobJournal(args.journal, args.fsync_every)
+        all_paths = [os.path.abspath(img_path) for img_path in img_paths]
+        img_paths = journal.pending(all_paths, args.max_retries)
+        sys.stderr.write("{} images, {} done or out of retries, {} to score\n".format(
+            len(all_paths), len(all_paths) - len(img_paths), len(img_paths)))
+        progress = Progress(len(img_paths), args.progress_interval)
+
+    metrics_writer = None
+    if args.metrics_file or args.metrics_json:
+        metrics.enable()
+    if args.metrics_file:
+        metrics_writer = metrics.PrometheusFileWriter(args.metrics_file, args.metrics_interval).start()
+
+    out = sys.stdout if args.output == '-' else open(args.output, 'w')
+    counts = {'scored': 0, 'failed': 0}
+
+    def emit(record):
+        out.write(json.dumps(record) + '\n')
+        out.flush()
+        if progress is not None:
+            progress.update(counts)
+
+    def on_error(img_path, error):
+        counts['failed'] += 1
+        if journal is not None:
+            journal.record_failed(img_path, error)
+        emit({'path': img_path, 'error': str(error)})
+
+    start = time.perf_counter()
+    try:
+        for img_path, custom_dict in score_paths(img_paths, args, on_error):
+            counts['scored'] += 1
+            if journal is not None:
+                journal.record_done(img_path, custom_dict)
+            emit(score_record(img_path, custom_dict))
+    except BrokenPipeError:
+        return 0  # Downstream reader (e.g. head) closed the pipe
+    finally:
+        if journal is not None:
+            journal.close()
+        if out is not sys.stdout:
+            out.close()
+        if metrics_writer is not None:
+            metrics_writer.stop()
+        if args.metrics_json:
+            with open(args.metrics_json, 'w') as f:
+                json.dump(metrics.snapshot(), f, indent=2, sort_keys=True)
+
+    if progress is not None:
+        progress.update(counts, force=True)
+    elapsed = time.perf_counter() - start
+    sys.stderr.write("{} scored, {} failed in {:.1f}s ({:.1f} images/s)\n".format(
+        counts['scored'], counts['failed'], elapsed, counts['scored'] / max(elapsed, 1e-9)))
+    return 1 if counts['failed'] else 0
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
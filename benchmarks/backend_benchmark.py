@@ -0,0 +1,74 @@
+import os
+import time
+import argparse
+
+import common
+
+'''
+Compares the inference backends on the same prepared 227x227 inputs: model load time,
+images/s for each batch size and, when both backends load, the deviation of every output
+from pycaffe's. A backend that can't be loaded (e.g. no caffe build) is reported and skipped
+
+python benchmarks/backend_benchmark.py [images or folders] [--batch-sizes 1,8,16] [--repeat 3]
+'''
+
+def load_backend(model, name):
+    model.set_backend(name)
+    start = time.perf_counter()
+    backend = model.load_model()
+    return time.perf_counter() - start, backend
+
+def score_all(model, imgs, batch_size):
+    scores = []
+    for i in range(0, len(imgs), batch_size):
+        scores.extend(model.forward_images(imgs[i:i + batch_size]))
+    return scores
+
+def main():
+    parser = argparse.ArgumentParser(description="pycaffe vs OpenCV DNN inference benchmark")
+    parser.add_argument('images', nargs='*', help="JPEG files or folders (default: repo sample images)")
+    parser.add_argument('--backends', default='caffe,opencv', help="Comma separated backends to compare")
+    parser.add_argument('--batch-sizes', default='1,8,16', help="Comma separated batch sizes")
+    parser.add_argument('--min-images', type=int, default=32, help="Repeat the inputs up to this many images")
+    parser.add_argument('--repeat', type=int, default=3, help="Timing repetitions (best is kept)")
+    parser.add_argument('--json', help="Write results to this JSON file")
+    args = parser.parse_args()
+    json_path = os.path.abspath(args.json) if args.json else None
+    img_paths = common.collect_images(args.images)
+
+    common.use_repo_root()
+    import model
+
+    imgs = [model.prepare_image(img_path) for img_path in img_paths]
+    while len(imgs) < args.min_images:
+        imgs.extend(imgs[:args.min_images - len(imgs)])
+    batch_sizes = [int(size) for size in args.batch_sizes.split(',')]
+
+    results = {'images': len(imgs)}
+    reference = None
+    for name in args.backends.split(','):
+        try:
+            load_seconds, _ = load_backend(model, name)
+        except Exception as e:
+            print("{:>8}: unavailable ({})".format(name, e))
+            results[name] = {'error': str(e)}
+            continue
+
+        results[name] = {'load_seconds': load_seconds, 'images_per_second': {}}
+        print("{:>8}: loaded in {:.2f}s".format(name, load_seconds))
+        for batch_size in batch_sizes:
+            elapsed, scores = common.best_time(score_all, args.repeat, model, imgs, batch_size)
+            results[name]['images_per_second'][batch_size] = len(imgs) / elapsed
+            print("{:>8}  batch {:>3}: {:8.1f} images/s".format('', batch_size, len(imgs) / elapsed))
+
+        if reference is None:
+            reference = (name, scores)
+        else:
+            deviation = max(abs(a[key] - b[key]) for a, b in zip(reference[1], scores) for key in a)
+            results[name]['max_abs_deviation'] = deviation
+            print("{:>8}  max |d| vs {}: {:.6f}".format('', reference[0], deviation))
+
+    common.write_json(results, json_path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+import os
+import sys
+import json
+import time
+
+'''
+Shared helpers for the benchmark scripts. Scripts are run from anywhere as
+python benchmarks/<script>.py, the repo root is put on sys.path and made the working
+directory because model.py resolves its model files relative to it
+'''
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_IMAGES = ['test1.jpg', 'tmp1.jpg', 'tmp2.jpg']
+
+def use_repo_root():
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    os.chdir(REPO_ROOT)
+
+# Expands files and directories into a sorted list of absolute JPEG paths,
+# falling back to the sample images shipped with the repo
+def collect_images(inputs):
+    img_paths = []
+    for item in inputs:
+        item = os.path.abspath(item)
+        if os.path.isdir(item):
+            img_paths.extend(os.path.join(item, f) for f in sorted(os.listdir(item))
+                             if f.lower().endswith(('.jpg', '.jpeg')))
+        else:
+            img_paths.append(item)
+
+    if not img_paths:
+        img_paths = [os.path.join(REPO_ROOT, f) for f in SAMPLE_IMAGES]
+    return img_paths
+
+# Writes count noisy gradient JPEGs of the given size (a stand-in for camera files) and returns their paths.
+# With exif_comment_size an EXIF block is added too: camera tags, a rating and a UserComment of that many bytes
+def make_synthetic_jpegs(folder, width, height, count, quality=92, exif_comment_size=None):
+    import cv2
+    import numpy as np
+
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.RandomState(0)
+    img_paths = []
+    for i in range(count):
+        gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+        img = np.broadcast_to(gradient, (height, width, 3)).copy()
+        img += rng.normal(0, 25, size=(height, width, 3)).astype(np.float32)
+        img[:, :, i % 3] *= 0.6
+        img = np.clip(img, 0, 255).astype(np.uint8)
+
+        img_path = os.path.join(folder, 'synthetic_{}x{}_{}.jpg'.format(width, height, i))
+        cv2.imwrite(img_path, img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if exif_comment_size is not None:
+            add_exif(img_path, i % 5 + 1, exif_comment_size)
+        img_paths.append(img_path)
+    return img_paths
+
+def add_exif(img_path, rating, comment_size):
+    import piexif
+    import piexif.helper
+
+    exif_dict = {'0th': {piexif.ImageIFD.Make: b'Synthetic', piexif.ImageIFD.Model: b'Benchmark',
+                         piexif.ImageIFD.Rating: rating, piexif.ImageIFD.RatingPercent: rating * 20},
+                 'Exif': {piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump('x' * comment_size)}}
+    piexif.insert(piexif.dump(exif_dict), img_path)
+
+def parse_size(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+# Best wall time of repeat calls, along with the result of the last call
+def best_time(func, repeat, *args):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+# Commit and environment recorded with the results so runs can be compared between commits
+def run_info():
+    import platform
+    import subprocess
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT,
+                                         stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+# Median and 95th percentile in ms of one call per argument tuple
+def time_calls(func, args_list):
+    times = []
+    result = None
+    for args in args_list:
+        start = time.perf_counter()
+        result = func(*args)
+        times.append(1000.0 * (time.perf_counter() - start))
+    times.sort()
+    return {'calls': len(times), 'p50_ms': times[len(times) // 2],
+            'p95_ms': times[min(len(times) - 1, int(len(times) * 0.95))],
+            'mean_ms': sum(times) / len(times)}, result
+
+def write_json(results, path):
+    if path is None:
+        return
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('Results written to ' + path)
@@ -0,0 +1,86 @@
+import os
+import argparse
+import tempfile
+
+import common
+
+'''
+Compares the full-resolution decode path against the DCT-scaled reduced decode path:
+time and decoded buffer size per image for decode + transform_img, and with --scores the
+deviation of fc11_score and every fc9_* attribute plus agreement of the star rating
+
+python benchmarks/decode_benchmark.py [images or folders] [--synthetic 6000x4000] [--scores]
+'''
+
+def decode(model, img_path, reduced):
+    img = model.read_image(img_path, reduced)
+    return img, model.transform_img(img)
+
+def main():
+    parser = argparse.ArgumentParser(description="Full vs reduced JPEG decode benchmark")
+    parser.add_argument('images', nargs='*', help="JPEG files or folders (default: repo sample images)")
+    parser.add_argument('--synthetic', metavar='WxH', help="Generate synthetic JPEGs of this size instead")
+    parser.add_argument('--count', type=int, default=4, help="Number of synthetic images")
+    parser.add_argument('--repeat', type=int, default=3, help="Timing repetitions per image (best is kept)")
+    parser.add_argument('--scores', action='store_true', help="Also run the net and report score deviation")
+    parser.add_argument('--json', help="Write results to this JSON file")
+    args = parser.parse_args()
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    if args.synthetic:
+        width, height = common.parse_size(args.synthetic)
+        img_paths = common.make_synthetic_jpegs(tempfile.mkdtemp(prefix='aesthetic_bench_'),
+                                                width, height, args.count)
+    else:
+        img_paths = common.collect_images(args.images)
+
+    common.use_repo_root()
+    import model
+
+    results = {'images': len(img_paths), 'full': {}, 'reduced': {}}
+    totals = {'full': [0.0, 0], 'reduced': [0.0, 0]}
+    inputs = {'full': [], 'reduced': []}
+    for img_path in img_paths:
+        for mode, reduced in (('full', False), ('reduced', True)):
+            elapsed, (img, resized) = common.best_time(decode, args.repeat, model, img_path, reduced)
+            totals[mode][0] += elapsed
+            totals[mode][1] += img.nbytes
+            inputs[mode].append(resized)
+
+    for mode in ('full', 'reduced'):
+        results[mode]['ms_per_image'] = 1000.0 * totals[mode][0] / len(img_paths)
+        results[mode]['decoded_mb_per_image'] = totals[mode][1] / len(img_paths) / 1e6
+    results['speedup'] = results['full']['ms_per_image'] / results['reduced']['ms_per_image']
+    results['memory_ratio'] = results['full']['decoded_mb_per_image'] / results['reduced']['decoded_mb_per_image']
+
+    print("{} images".format(len(img_paths)))
+    for mode in ('full', 'reduced'):
+        print("{:>8}: {:8.2f} ms/image  {:8.2f} MB decoded/image".format(
+            mode, results[mode]['ms_per_image'], results[mode]['decoded_mb_per_image']))
+    print("speedup {:.2f}x, decoded memory {:.2f}x smaller".format(results['speedup'], results['memory_ratio']))
+
+    if args.scores:
+        full_scores = []
+        reduced_scores = []
+        for full_img, reduced_img in zip(inputs['full'], inputs['reduced']):
+            full_scores.append(model.forward_images([full_img])[0])
+            reduced_scores.append(model.forward_images([reduced_img])[0])
+
+        deviation = {}
+        for key in sorted(full_scores[0]):
+            diffs = [abs(f[key] - r[key]) for f, r in zip(full_scores, reduced_scores)]
+            deviation[key] = {'max_abs': max(diffs), 'mean_abs': sum(diffs) / len(diffs)}
+            print("{:>22}: max |d| {:.5f}  mean |d| {:.5f}".format(key, deviation[key]['max_abs'],
+                                                                 deviation[key]['mean_abs']))
+
+        agree = sum(1 for f, r in zip(full_scores, reduced_scores)
+                    if model.calculate_rating(int(f['fc11_score']*100)) ==
+                    model.calculate_rating(int(r['fc11_score']*100)))
+        results['deviation'] = deviation
+        results['rating_agreement'] = agree / len(full_scores)
+        print("star rating agreement: {}/{}".format(agree, len(full_scores)))
+
+    common.write_json(results, json_path)
+
+if __name__ == '__main__':
+    main()
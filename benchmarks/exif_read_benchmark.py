@@ -0,0 +1,122 @@
+import os
+import io
+import time
+import argparse
+import tempfile
+
+import common
+
+'''
+Compares reading the rating and scores of an image with piexif.load on the whole file (the
+previous gallery path), piexif.load on the APP1 segment only (load_exif_dict) and the
+header-only exif_io.rating_tags, which reads up to the end of APP1 and parses only the tags the
+gallery shows. Every reader goes through a file that counts the bytes and read calls reaching
+the disk, and with --latency/--bandwidth each read call is slowed down like on a network mount
+
+python benchmarks/exif_read_benchmark.py [images or folders] [--synthetic 6000x4000] [--latency 2 --bandwidth 50]
+'''
+
+# Unbuffered file that counts what is read through it, each read call sleeps latency seconds
+# plus its size over bandwidth (bytes/s) when given
+class CountingFile(io.RawIOBase):
+    def __init__(self, path, latency=0.0, bandwidth=None):
+        self.f = open(path, 'rb', buffering=0)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.bytes_read = 0
+        self.reads = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.f.seek(offset, whence)
+
+    def tell(self):
+        return self.f.tell()
+
+    def readinto(self, buffer):
+        count = self.f.readinto(buffer)
+        self.bytes_read += count
+        self.reads += 1
+        delay = self.latency + (count / self.bandwidth if self.bandwidth else 0.0)
+        if delay:
+            time.sleep(delay)
+        return count
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+def piexif_file(f):
+    import piexif
+    return piexif.load(f.read())  # What piexif.load(img_path) does
+
+def piexif_segment(f):
+    import piexif
+    from exif_io import read_exif_segment
+    _, payload = read_exif_segment(f)
+    return piexif.load(payload) if payload is not None else None
+
+def header_only(f):
+    from exif_io import rating_tags
+    return rating_tags(f)
+
+def run(read, img_paths, repeat, latency, bandwidth):
+    totals = {'bytes': 0, 'reads': 0}
+
+    def read_file(img_path):
+        raw = CountingFile(img_path, latency, bandwidth)
+        with io.BufferedReader(raw) as f:
+            result = read(f)
+        totals['bytes'] += raw.bytes_read
+        totals['reads'] += raw.reads
+        return result
+
+    stats, _ = common.time_calls(read_file, [(img_path,) for img_path in img_paths] * repeat)
+    stats['bytes_per_file'] = totals['bytes'] / stats['calls']
+    stats['reads_per_file'] = totals['reads'] / stats['calls']
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="EXIF rating read benchmark")
+    parser.add_argument('images', nargs='*', help="JPEG files or folders (default: repo sample images)")
+    parser.add_argument('--synthetic', metavar='WxH', help="Generate synthetic JPEGs with scores of this size instead")
+    parser.add_argument('--count', type=int, default=4, help="Number of synthetic images")
+    parser.add_argument('--repeat', type=int, default=5, help="Reads per image")
+    parser.add_argument('--latency', type=float, default=2.0, help="ms per read call of the slow reader")
+    parser.add_argument('--bandwidth', type=float, default=50.0, help="MB/s of the slow reader")
+    parser.add_argument('--json', help="Write results to this JSON file")
+    args = parser.parse_args()
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    if args.synthetic:
+        width, height = common.parse_size(args.synthetic)
+        img_paths = common.make_synthetic_jpegs(tempfile.mkdtemp(prefix='aesthetic_bench_'),
+                                                width, height, args.count, exif_comment_size=400)
+    else:
+        img_paths = common.collect_images(args.images)
+
+    common.use_repo_root()
+    readers = (('piexif_file', piexif_file), ('piexif_segment', piexif_segment), ('header_only', header_only))
+    slow = (args.latency / 1000.0, args.bandwidth * 1e6)
+    results = {'images': len(img_paths), 'mean_file_bytes': sum(os.path.getsize(p) for p in img_paths) / len(img_paths),
+               'slow_reader': {'latency_ms': args.latency, 'bandwidth_mb_s': args.bandwidth}}
+    for mode, (latency, bandwidth) in (('local', (0.0, None)), ('slow', slow)):
+        results[mode] = {}
+        print(mode)
+        for name, read in readers:
+            stats = run(read, img_paths, args.repeat if mode == 'local' else 1, latency, bandwidth)
+            results[mode][name] = stats
+            print("{:>16}: {:9.3f} ms/file (p95 {:9.3f})  {:10.0f} bytes/file  {:5.1f} reads/file".format(
+                name, stats['p50_ms'], stats['p95_ms'], stats['bytes_per_file'], stats['reads_per_file']))
+        results[mode]['speedup'] = results[mode]['piexif_file']['p50_ms'] / results[mode]['header_only']['p50_ms']
+        print("header only: {:.1f}x faster than piexif on the file".format(results[mode]['speedup']))
+
+    common.write_json(results, json_path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+import common
+
+'''
+Compares writing ratings with piexif.load + piexif.insert (the previous path, rewrites the
+whole file every time) against exif_io.write_rating (patches the APP1 segment in place).
+Each image gets --rounds score writes, the first exif_io write per file is usually a full
+rewrite because the tags don't exist yet
+
+python benchmarks/exif_write_benchmark.py [images or folders] [--synthetic 6000x4000] [--rounds 5]
+'''
+
+def random_scores(rng):
+    keys = ['fc11_score', 'fc9_VividColor', 'fc9_Symmetry', 'fc9_RuleOfThirds', 'fc9_MotionBlur',
+            'fc9_Repetition', 'fc9_Content', 'fc9_Light', 'fc9_Object', 'fc9_ColorHarmony',
+            'fc9_DoF', 'fc9_BalancingElement']
+    scores = dict((key, rng.uniform(-0.5, 0.5)) for key in keys)
+    scores['fc11_score'] = rng.uniform(0.0, 1.0)
+    return scores
+
+def piexif_write(img_path, rating, rating_percent, user_comment):
+    import piexif
+    import piexif.helper
+
+    exif_dict = piexif.load(img_path)
+    exif_dict['0th'][piexif.ImageIFD.RatingPercent] = rating_percent
+    exif_dict['0th'][piexif.ImageIFD.Rating] = rating
+    exif_dict['Exif'][piexif.ExifIFD.UserComment] = piexif.helper.UserComment.dump(user_comment)
+    piexif.insert(piexif.dump(exif_dict), img_path)
+    return os.path.getsize(img_path)
+
+def run(write, img_paths, rounds, seed):
+    from model import calculate_rating
+
+    rng = random.Random(seed)
+    results = {}
+    # The first round creates the tags, later rounds are re-analysis of already scored files
+    for name, round_count in (('first_write', 1), ('rewrites', rounds - 1)):
+        elapsed = 0.0
+        written = 0
+        for _ in range(round_count):
+            for img_path in img_paths:
+                scores = random_scores(rng)
+                rating_percent = int(scores['fc11_score']*100)
+                start = time.perf_counter()
+                written += write(img_path, calculate_rating(rating_percent), rating_percent, json.dumps(scores))
+                elapsed += time.perf_counter() - start
+        writes = max(1, round_count * len(img_paths))
+        results[name] = {'writes': round_count * len(img_paths), 'ms_per_write': 1000.0 * elapsed / writes,
+                         'bytes_per_write': written / writes}
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="EXIF rating write benchmark")
+    parser.add_argument('images', nargs='*', help="JPEG files or folders (default: repo sample images)")
+    parser.add_argument('--synthetic', metavar='WxH', help="Generate synthetic JPEGs of this size instead")
+    parser.add_argument('--count', type=int, default=4, help="Number of synthetic images")
+    parser.add_argument('--rounds', type=int, default=5, help="Score writes per image")
+    parser.add_argument('--workdir', help="Folder for the working copies, e.g. on a network mount")
+    parser.add_argument('--json', help="Write results to this JSON file")
+    args = parser.parse_args()
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    workdir = tempfile.mkdtemp(prefix='aesthetic_exif_', dir=args.workdir)
+    if args.synthetic:
+        width, height = common.parse_size(args.synthetic)
+        img_paths = common.make_synthetic_jpegs(os.path.join(workdir, 'src'), width, height, args.count)
+    else:
+        img_paths = common.collect_images(args.images)
+
+    common.use_repo_root()
+    from exif_io import write_rating
+
+    results = {'images': len(img_paths), 'rounds': args.rounds}
+    try:
+        for name, write in (('piexif', piexif_write), ('exif_io', write_rating)):
+            folder = os.path.join(workdir, name)
+            os.makedirs(folder)
+            copies = []
+            for img_path in img_paths:
+                copies.append(os.path.join(folder, os.path.basename(img_path)))
+                shutil.copy(img_path, copies[-1])
+            results[name] = run(write, copies, args.rounds, seed=0)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for stage in ('first_write', 'rewrites'):
+        print(stage)
+        for name in ('piexif', 'exif_io'):
+            print("{:>10}: {:8.2f} ms/write  {:12.0f} bytes/write".format(
+                name, results[name][stage]['ms_per_write'], results[name][stage]['bytes_per_write']))
+    rewrites = (results['piexif']['rewrites'], results['exif_io']['rewrites'])
+    if rewrites[1]['writes']:
+        results['rewrite_speedup'] = rewrites[0]['ms_per_write'] / rewrites[1]['ms_per_write']
+        results['rewrite_bytes_ratio'] = rewrites[0]['bytes_per_write'] / max(1, rewrites[1]['bytes_per_write'])
+        print("re-analysis writes: {:.1f}x faster, {:.0f}x fewer bytes written".format(
+            results['rewrite_speedup'], results['rewrite_bytes_ratio']))
+
+    common.write_json(results, json_path)
+
+if __name__ == '__main__':
+    main()
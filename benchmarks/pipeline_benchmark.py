@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import common
+
+'''
+Stage-level benchmark of the scoring pipeline and the gallery.
+Times every stage of predict_image separately (decode, resize, blob fill, forward, cache key
+hashing, piexif.load, piexif.dump, piexif.insert and exif_io.write_rating), then end to end
+with predict_images / InferencePool for each batch size and worker count. With --gui it also
+times the thumbnail tiers (EXIF thumbnail, scaled decode, disk cache hit, against the old
+full decode), opening the gallery, reading the scores of the folder with an empty and with a
+warm library catalog, and load_filtered_images on the same files (offscreen Qt).
+Results are written as JSON together with the commit, and --baseline prints the change
+against an earlier results file
+
+python benchmarks/pipeline_benchmark.py [images or folders] [--synthetic 6000x4000 --exif-comment 2048]
+    [--batch-sizes 1,16] [--workers 1,2] [--gui] [--json out.json] [--baseline old.json]
+'''
+
+def copy_images(img_paths, folder):
+    os.makedirs(folder)
+    copies = []
+    for i, img_path in enumerate(img_paths):
+        copies.append(os.path.join(folder, '{}_{}'.format(i, os.path.basename(img_path))))
+        shutil.copy(img_path, copies[-1])
+    return copies
+
+def stage_timings(model, img_paths, batch_sizes, workdir):
+    import piexif
+    import exif_io
+    from score_cache import content_hash
+
+    stages = {}
+    stages['decode'], _ = common.time_calls(model.read_image, [(img_path,) for img_path in img_paths])
+    imgs = [model.read_image(img_path) for img_path in img_paths]
+    stages['resize'], _ = common.time_calls(model.transform_img, [(img,) for img in imgs])
+    resized = [model.transform_img(img) for img in imgs]
+    stages['content_hash'], _ = common.time_calls(content_hash, [(img_path,) for img_path in img_paths])
+
+    exif_dicts = [piexif.load(img_path) for img_path in img_paths]
+    stages['piexif_load'], _ = common.time_calls(piexif.load, [(img_path,) for img_path in img_paths])
+    for exif_dict in exif_dicts:
+        exif_dict['0th'][piexif.ImageIFD.Rating] = 3
+        exif_dict['0th'][piexif.ImageIFD.RatingPercent] = 50
+    stages['piexif_dump'], _ = common.time_calls(piexif.dump, [(exif_dict,) for exif_dict in exif_dicts])
+    copies = copy_images(img_paths, os.path.join(workdir, 'piexif'))
+    stages['piexif_insert'], _ = common.time_calls(
+        piexif.insert, [(piexif.dump(exif_dict), copy) for exif_dict, copy in zip(exif_dicts, copies)])
+    copies = copy_images(img_paths, os.path.join(workdir, 'exif_io'))
+    comment = json.dumps(dict((key, 0.5) for key in model.OUTPUT_BLOBS))
+    stages['exif_io_first_write'], _ = common.time_calls(
+        exif_io.write_rating, [(copy, 3, 50, comment) for copy in copies])
+    stages['exif_io_rewrite'], _ = common.time_calls(
+        exif_io.write_rating, [(copy, 4, 70, comment) for copy in copies])
+
+    try:
+        backend = model.load_model()
+    except Exception as e:
+        print("model stages skipped: {}".format(e))
+        return stages, str(e)
+
+    import numpy as np
+    mean = model.load_mean()
+    blob = np.empty((1, 3, model.IMAGE_HEIGHT, model.IMAGE_WIDTH), dtype=np.float32)
+    stages['blob_fill'], _ = common.time_calls(model.fill_input_blob, [([img], blob, mean) for img in resized])
+    for batch_size in batch_sizes:
+        batches = [resized[i:i + batch_size] for i in range(0, len(resized), batch_size)]
+        backend.forward(batches[0])  # Warm up allocations for this batch size
+        timing, _ = common.time_calls(backend.forward, [(batch,) for batch in batches])
+        timing['ms_per_image'] = timing['mean_ms'] * len(batches) / len(resized)
+        stages['forward_batch_{}'.format(batch_size)] = timing
+    return stages, None
+
+def end_to_end(model, img_paths, batch_sizes, worker_counts, workdir):
+    results = {}
+    for workers in worker_counts:
+        for batch_size in batch_sizes:
+            name = 'batch_{}_workers_{}'.format(batch_size, workers)
+            copies = copy_images(img_paths, os.path.join(workdir, name))
+            start = time.perf_counter()
+            if workers > 1:
+                with model.InferencePool(workers, batch_size=batch_size) as pool:
+                    count = sum(1 for _ in pool.predict_images(copies, use_cache=False))
+            else:
+                count = sum(1 for _ in model.predict_images(copies, batch_size, use_cache=False))
+            elapsed = time.perf_counter() - start
+            results[name] = {'images': count, 'seconds': elapsed, 'images_per_second': count / elapsed}
+            print("{:>24}: {:8.2f} images/s".format(name, count / elapsed))
+    return results
+
+def gui_timings(img_paths, workdir):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5.QtWidgets import QApplication
+    import thumbnails
+    import AestheticSense
+    from catalog import LibraryCatalog
+    from library_scan import iter_folders
+    from score_index import ScoreIndex
+    from PyQt5.QtGui import QPixmap
+    from PyQt5.QtCore import Qt
+
+    app = QApplication.instance() or QApplication([])
+    window = AestheticSense.MainWindow()
+    copies = copy_images(img_paths, os.path.join(workdir, 'gui'))
+
+    stages = {}
+    size = thumbnails.THUMBNAIL_SIZE
+    disk_cache = thumbnails.ThumbnailDiskCache(os.path.join(workdir, 'thumbnails'))
+    stages['thumbnail_full_decode'], _ = common.time_calls(
+        lambda img_path: QPixmap(img_path).scaled(size, size, Qt.KeepAspectRatio, Qt.SmoothTransformation),
+        [(img_path,) for img_path in copies])
+    stages['thumbnail_exif'], _ = common.time_calls(thumbnails.exif_thumbnail, [(img_path,) for img_path in copies])
+    stages['thumbnail_exif']['usable'] = sum(1 for img_path in copies if thumbnails.exif_thumbnail(img_path) is not None)
+    stages['thumbnail_scaled_decode'], _ = common.time_calls(
+        thumbnails.decode_thumbnail, [(img_path,) for img_path in copies])
+    stages['thumbnail_cache_miss'], _ = common.time_calls(
+        thumbnails.load_thumbnail, [(img_path, size, disk_cache) for img_path in copies])
+    stages['thumbnail_cache_hit'], _ = common.time_calls(
+        thumbnails.load_thumbnail, [(img_path, size, disk_cache) for img_path in copies])
+
+    window.image_paths = copies
+    start = time.perf_counter()
+    window.display_images()
+    app.processEvents()
+    stages['display_images'] = {'files': len(copies), 'total_ms': 1000.0 * (time.perf_counter() - start)}
+
+    # Score index of the folder: EXIF of every file, then from the catalog filled by the first pass
+    folder = os.path.dirname(copies[0])
+    catalog = LibraryCatalog(folder, os.path.join(workdir, 'catalog.sqlite'))
+    for stage in ('library_index_cold', 'library_index_warm'):
+        start = time.perf_counter()
+        _, img_paths, signatures = next(iter_folders(folder, False, True))
+        ScoreIndex(catalog=catalog).load(img_paths, signatures)
+        stages[stage] = {'files': len(img_paths), 'total_ms': 1000.0 * (time.perf_counter() - start)}
+    catalog.close()
+
+    # Filtering is answered from the score index built when a folder is opened, an empty result
+    # would stop on the "No Images Found" box
+    window.all_image_paths = copies
+    window.score_index = ScoreIndex().load(copies)
+    AestheticSense.QMessageBox.warning = staticmethod(lambda *args: None)
+    for value in ('3', 'No Filter'):
+        window.filter_value.setCurrentText(value)
+        start = time.perf_counter()
+        window.load_filtered_images()
+        app.processEvents()
+        elapsed = 1000.0 * (time.perf_counter() - start)
+        stages['load_filtered_images_' + value.replace(' ', '_').lower()] = {
+            'files': len(copies), 'shown': len(window.image_paths), 'total_ms': elapsed}
+    window.close()
+    return stages
+
+def print_stages(stages, baseline):
+    for name in sorted(stages):
+        timing = stages[name]
+        value = timing.get('ms_per_image', timing.get('p50_ms', timing.get('total_ms')))
+        line = "{:>36}: {:10.3f} ms".format(name, value)
+        if baseline and name in baseline:
+            old = baseline[name].get('ms_per_image', baseline[name].get('p50_ms', baseline[name].get('total_ms')))
+            if old:
+                line += "  ({:+.1f}% vs baseline)".format(100.0 * (value - old) / old)
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Scoring pipeline and gallery stage benchmark")
+    parser.add_argument('images', nargs='*', help="JPEG files or folders (default: repo sample images)")
+    parser.add_argument('--synthetic', metavar='WxH', help="Generate synthetic JPEGs of this size instead")
+    parser.add_argument('--count', type=int, default=8, help="Number of synthetic images")
+    parser.add_argument('--exif-comment', type=int, default=None, metavar='BYTES',
+                        help="Give the synthetic images EXIF with a UserComment of this size")
+    parser.add_argument('--batch-sizes', default='1,16', help="Comma separated batch sizes")
+    parser.add_argument('--workers', default='1', help="Comma separated worker counts for the end to end run")
+    parser.add_argument('--gui', action='store_true', help="Also time thumbnail tiers, display_images and load_filtered_images")
+    parser.add_argument('--baseline', help="Earlier results JSON to compare against")
+    parser.add_argument('--json', help="Write results to this JSON file")
+    args = parser.parse_args()
+    json_path = os.path.abspath(args.json) if args.json else None
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    workdir = tempfile.mkdtemp(prefix='aesthetic_pipeline_')
+    if args.synthetic:
+        width, height = common.parse_size(args.synthetic)
+        img_paths = common.make_synthetic_jpegs(os.path.join(workdir, 'src'), width, height, args.count,
+                                                exif_comment_size=args.exif_comment)
+    else:
+        img_paths = common.collect_images(args.images)
+
+    common.use_repo_root()
+    import model
+
+    batch_sizes = [int(size) for size in args.batch_sizes.split(',')]
+    worker_counts = [int(count) for count in args.workers.split(',')]
+    results = {'run': common.run_info(), 'images': len(img_paths), 'backend': model.BACKEND,
+               'reduced_decode': model.REDUCED_DECODE}
+    try:
+        results['stages'], model_error = stage_timings(model, img_paths, batch_sizes, workdir)
+        print_stages(results['stages'], baseline and baseline.get('stages'))
+        if model_error is None:
+            results['end_to_end'] = end_to_end(model, img_paths, batch_sizes, worker_counts, workdir)
+        if args.gui:
+            results['gui'] = gui_timings(img_paths, workdir)
+            print_stages(results['gui'], baseline and baseline.get('gui'))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    common.write_json(results, json_path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import os
+import time
+import argparse
+import tracemalloc
+
+import numpy as np
+
+import common
+
+'''
+Microbenchmark of the preprocessing stage: getting the mean image and turning a batch of decoded
+images into the input blob. Compares
+  transformer: caffe.io.Transformer.preprocess steps per image (float copy, transpose, mean
+               subtraction) copied into the blob
+  blob_from_images: cv2.dnn.blobFromImages followed by the mean subtraction
+  fused: model.fill_input_blob writing straight into a preallocated blob
+and the mean from the binaryproto against the memory-mapped .npy cache.
+Reports ms per batch and the peak of NumPy allocations made while filling one batch
+
+python benchmarks/preprocess_benchmark.py [images or folders] [--batch-size 16] [--repeat 20]
+'''
+
+def transformer_fill(model, imgs, blob, mean):
+    for i, img in enumerate(imgs):
+        caffe_in = img.astype(np.float32, copy=False)
+        if caffe_in.shape[:2] != (model.IMAGE_HEIGHT, model.IMAGE_WIDTH):
+            caffe_in = model.transform_img(caffe_in)
+        caffe_in = caffe_in.transpose((2, 0, 1))
+        caffe_in -= mean
+        blob[i] = caffe_in
+    return blob
+
+def blob_from_images_fill(model, imgs, blob, mean):
+    import cv2
+
+    result = cv2.dnn.blobFromImages(imgs, 1.0, (model.IMAGE_WIDTH, model.IMAGE_HEIGHT), swapRB=False, crop=False)
+    result -= mean
+    return result
+
+def fused_fill(model, imgs, blob, mean):
+    return model.fill_input_blob(imgs, blob, mean)
+
+def traced_peak(func, *args):
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+def main():
+    parser = argparse.ArgumentParser(description="Preprocessing stage microbenchmark")
+    parser.add_argument('images', nargs='*', help="JPEG files or folders (default: repo sample images)")
+    parser.add_argument('--batch-size', type=int, default=16, help="Images per blob")
+    parser.add_argument('--repeat', type=int, default=20, help="Timing repetitions (best is kept)")
+    parser.add_argument('--json', help="Write results to this JSON file")
+    args = parser.parse_args()
+    json_path = os.path.abspath(args.json) if args.json else None
+    img_paths = common.collect_images(args.images)
+
+    common.use_repo_root()
+    import model
+
+    imgs = [model.prepare_image(img_path) for img_path in img_paths]
+    imgs = [imgs[i % len(imgs)] for i in range(args.batch_size)]
+    results = {'batch_size': args.batch_size, 'mean': {}, 'fill': {}}
+
+    start = time.perf_counter()
+    mean = model.read_mean_image()
+    results['mean']['binaryproto_ms'] = 1000.0 * (time.perf_counter() - start)
+    model.load_mean()  # Makes sure the .npy cache exists
+    start = time.perf_counter()
+    cached_mean = model.load_mean()
+    results['mean']['npy_mmap_ms'] = 1000.0 * (time.perf_counter() - start)
+    print("mean: binaryproto {:.2f} ms, mmap'd .npy {:.3f} ms".format(
+        results['mean']['binaryproto_ms'], results['mean']['npy_mmap_ms']))
+
+    blob = np.empty((args.batch_size, 3, model.IMAGE_HEIGHT, model.IMAGE_WIDTH), dtype=np.float32)
+    reference = None
+    for name, fill in (('transformer', transformer_fill), ('blob_from_images', blob_from_images_fill),
+                       ('fused', fused_fill)):
+        elapsed, result = common.best_time(fill, args.repeat, model, imgs, blob, cached_mean)
+        if reference is None:
+            reference = result.copy()
+        results['fill'][name] = {
+            'ms_per_batch': 1000.0 * elapsed,
+            'peak_alloc_mb': traced_peak(fill, model, imgs, blob, cached_mean) / 1e6,
+            'max_abs_diff': float(np.abs(result - reference).max())
+        }
+        print("{:>18}: {:8.3f} ms/batch  {:8.2f} MB allocated  max |d| {:.6f}".format(
+            name, results['fill'][name]['ms_per_batch'], results['fill'][name]['peak_alloc_mb'],
+            results['fill'][name]['max_abs_diff']))
+
+    common.write_json(results, json_path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import os
+import argparse
+import multiprocessing
+
+import common
+
+'''
+Accuracy and memory report of the reduced-precision backends against the float model.
+Every backend scores the same images in its own process, so the peak RSS reported is what one
+inference worker would need. Reports the deviation of fc11_score and every fc9_* attribute and
+how often the star rating from calculate_rating agrees with the reference
+
+python benchmarks/quantization_report.py [images or folders] [--reference opencv] [--backends int8,fp16]
+'''
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None  # Windows
+    import sys
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+def score_backend(name, img_paths):
+    common.use_repo_root()
+    import model
+
+    model.set_backend(name)
+    model.load_model()
+    scores = []
+    for i in range(0, len(img_paths), model.BATCH_SIZE):
+        imgs = [model.prepare_image(img_path) for img_path in img_paths[i:i + model.BATCH_SIZE]]
+        scores.extend(model.forward_images(imgs))
+    return scores, peak_rss_mb()
+
+def run_isolated(name, img_paths):
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        return pool.apply(score_backend, (name, img_paths))
+
+def main():
+    parser = argparse.ArgumentParser(description="Reduced-precision accuracy and memory report")
+    parser.add_argument('images', nargs='*', help="JPEG files or folders (default: repo sample images)")
+    parser.add_argument('--reference', default='opencv', help="Float backend to compare against")
+    parser.add_argument('--backends', default='int8,fp16', help="Comma separated backends to report")
+    parser.add_argument('--json', help="Write results to this JSON file")
+    args = parser.parse_args()
+    json_path = os.path.abspath(args.json) if args.json else None
+    img_paths = common.collect_images(args.images)
+
+    common.use_repo_root()
+    from model import calculate_rating
+
+    reference, reference_rss = run_isolated(args.reference, img_paths)
+    results = {'images': len(img_paths), 'reference': args.reference, 'peak_rss_mb': {args.reference: reference_rss}}
+    print("{} images, reference {}".format(len(img_paths), args.reference))
+
+    for name in args.backends.split(','):
+        run_isolated(name, [])  # Converts the weights on first use, kept out of the measured run
+        scores, rss = run_isolated(name, img_paths)
+        results['peak_rss_mb'][name] = rss
+
+        deviation = {}
+        for key in sorted(reference[0]):
+            diffs = [abs(r[key] - s[key]) for r, s in zip(reference, scores)]
+            deviation[key] = {'max_abs': max(diffs), 'mean_abs': sum(diffs) / len(diffs)}
+        agree = sum(1 for r, s in zip(reference, scores)
+                    if calculate_rating(int(r['fc11_score']*100)) == calculate_rating(int(s['fc11_score']*100)))
+        results[name] = {'deviation': deviation, 'rating_agreement': agree / len(scores)}
+
+        print(name)
+        for key in sorted(deviation):
+            print("{:>22}: max |d| {:.5f}  mean |d| {:.5f}".format(key, deviation[key]['max_abs'],
+                                                                 deviation[key]['mean_abs']))
+        print("{:>22}: {}/{}".format('star rating agreement', agree, len(scores)))
+
+    if reference_rss is not None:
+        for name, rss in sorted(results['peak_rss_mb'].items()):
+            print("{:>8}: peak RSS {:8.1f} MB".format(name, rss))
+
+    common.write_json(results, json_path)
+
+if __name__ == '__main__':
+    main()
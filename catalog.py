@@ -0,0 +1,163 @@
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+
+from score_cache import user_cache_dir
+
+'''
+Per-library catalog of the scores stored in the images.
+One SQLite file per loaded folder holds path, size, mtime, Rating, RatingPercent and the
+attribute scores of the UserComment for every image read so far. Opening the folder again
+compares the size and mtime from the scan with the catalog and only reads the EXIF of new or
+changed files, an unchanged library costs the directory walk and no file reads. Every score or
+rating the app writes goes through the ScoreIndex, which keeps the catalog in step
+'''
+CATALOG_DIR = os.path.join(user_cache_dir(), 'catalogs')
+
+def catalog_path(root, folder=CATALOG_DIR):
+    key = hashlib.sha1(os.path.normcase(os.path.abspath(root)).encode('utf-8')).hexdigest()
+    return os.path.join(folder, key + '.sqlite')
+
+class LibraryCatalog(object):
+    def __init__(self, root, path=None):
+        self.root = root
+        self.path = path or catalog_path(root)
+        self.lock = threading.Lock()
+        self.entries = None  # img_path -> (signature, record), read on the first lookup
+
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, size INTEGER, '
+                          'mtime_ns INTEGER, rating REAL, rating_percent REAL, scores TEXT)')
+        self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('root', os.path.abspath(root)))
+        self.conn.commit()
+
+    def load_entries(self):
+        entries = {}
+        for img_path, size, mtime_ns, rating, rating_percent, scores in self.conn.execute('SELECT * FROM images'):
+            record = json.loads(scores) if scores else {}
+            if rating is not None:
+                record['rating'] = rating
+            if rating_percent is not None:
+                record['rating_percent'] = rating_percent
+            entries[img_path] = ((size, mtime_ns), record)
+        return entries
+
+    # The record of img_path when the catalog saw the file with this (size, mtime_ns), else None
+    def lookup(self, img_path, signature):
+        with self.lock:
+            if self.conn is None:
+                return None
+            if self.entries is None:
+                self.entries = self.load_entries()
+            entry = self.entries.get(img_path)
+        if entry is None or entry[0] != signature:
+            return None
+        return dict(entry[1])
+
+    # Committed along with the next commit()
+    def put(self, img_path, signature, record):
+        record = dict(record)
+        rating = record.pop('rating', None)
+        rating_percent = record.pop('rating_percent', None)
+        with self.lock:
+            if self.conn is None:
+                return
+            self.conn.execute('INSERT OR REPLACE INTO images (path, size, mtime_ns, rating, rating_percent, scores) '
+                              'VALUES (?, ?, ?, ?, ?, ?)',
+                              (img_path, signature[0], signature[1], rating, rating_percent,
+                               json.dumps(record) if record else None))
+            if self.entries is not None:
+                if rating is not None:
+                    record['rating'] = rating
+                if rating_percent is not None:
+                    record['rating_percent'] = rating_percent
+                self.entries[img_path] = (signature, record)
+
+    def remove(self, img_paths):
+        with self.lock:
+            if self.conn is None:
+                return
+            self.conn.executemany('DELETE FROM images WHERE path = ?', [(img_path,) for img_path in img_paths])
+            if self.entries is not None:
+                for img_path in img_paths:
+                    self.entries.pop(img_path, None)
+
+    def rename(self, old_path, new_path):
+        with self.lock:
+            if self.conn is None:
+                return
+            self.conn.execute('DELETE FROM images WHERE path = ?', (new_path,))
+            self.conn.execute('UPDATE images SET path = ? WHERE path = ?', (new_path, old_path))
+            if self.entries is not None and old_path in self.entries:
+                self.entries[new_path] = self.entries.pop(old_path)
+
+    # Drops the images of the scanned folders that weren't found, folder_images is
+    # folder -> set of the image paths the scan found directly inside it
+    def prune(self, folder_images):
+        with self.lock:
+            if self.conn is None:
+                return 0
+            stale = []
+            for img_path, in self.conn.execute('SELECT path FROM images'):
+                found = folder_images.get(os.path.dirname(img_path))
+                if found is not None and img_path not in found:
+                    stale.append((img_path,))
+            self.conn.executemany('DELETE FROM images WHERE path = ?', stale)
+            self.conn.commit()
+            if self.entries is not None:
+                for img_path, in stale:
+                    self.entries.pop(img_path, None)
+            return len(stale)
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute('DELETE FROM images')
+            self.conn.commit()
+            self.entries = None
+
+    def commit(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.commit()
+
+    # Drops the writes since the last commit, after one of them failed
+    def rollback(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.rollback()
+            self.entries = None  # May hold records that weren't saved
+
+    def stats(self):
+        with self.lock:
+            count = self.conn.execute('SELECT COUNT(*) FROM images').fetchone()[0]
+        return {'root': self.root, 'path': self.path, 'entries': count}
+
+    # Later calls do nothing, an index still holding the catalog of the previous folder can't fail on it
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.commit()
+                self.conn.close()
+                self.conn = None
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect or clear the catalog of a library folder")
+    parser.add_argument('root', help="Library folder")
+    parser.add_argument('--clear', action='store_true', help="Forget every image of the library")
+    args = parser.parse_args()
+
+    catalog = LibraryCatalog(os.path.normpath(args.root))
+    if args.clear:
+        catalog.clear()
+    print(json.dumps(catalog.stats()))
+    catalog.close()
@@ -0,0 +1,311 @@
+import os
+import sys
+import struct
+import shutil
+
+import piexif
+import piexif.helper
+
+from jpeg_utils import iter_segments, SOI, SOS
+
+'''
+EXIF rating writer.
+Rating, RatingPercent and the UserComment holding the attribute scores are patched in place
+inside the existing APP1 segment when the tags are already there and the new values fit, which
+writes a few bytes instead of the whole file. Otherwise the APP1 segment is rebuilt with piexif
+and the file is rewritten segment by segment into a temporary file that atomically replaces it,
+keeping the creation time, owner, permissions and extended attributes of the original (hard
+linked files are written back in place instead so their links stay together).
+The browse path reads the same tags back with rating_tags, which stops at the end of the APP1
+segment and only walks IFD0 and the Exif IFD instead of decoding every tag and the thumbnail
+'''
+APP0 = 0xE0
+APP1 = 0xE1
+EXIF_HEADER = b'Exif\x00\x00'
+
+TAG_RATING = piexif.ImageIFD.Rating
+TAG_RATING_PERCENT = piexif.ImageIFD.RatingPercent
+TAG_ORIENTATION = piexif.ImageIFD.Orientation
+TAG_EXIF_IFD = piexif.ImageIFD.ExifTag
+TAG_USER_COMMENT = piexif.ExifIFD.UserComment
+
+TYPE_SHORT = 3
+TYPE_LONG = 4
+TYPE_UNDEFINED = 7
+
+# Spare room left after the UserComment whenever it is rewritten, so later scores of a
+# slightly different length can still be patched in place (padding is JSON whitespace)
+COMMENT_SLACK = 64
+COPY_CHUNK = 1 << 20
+REPLACEFILE_IGNORE_MERGE_ERRORS = 0x2
+
+# Returns (offset, length) of the EXIF APP1 segment or None
+def find_exif_segment(f):
+    for marker, offset, length in iter_segments(f):
+        if marker == APP1:
+            f.seek(offset + 4)
+            if f.read(6) == EXIF_HEADER:
+                return offset, length
+    return None
+
+def read_exif_segment(f):
+    segment = find_exif_segment(f)
+    if segment is None:
+        return None, None
+    offset, length = segment
+    f.seek(offset + 4)
+    return offset, f.read(length - 2)
+
+# IFD entries as {tag: (type, count, position of the 4 byte value/offset field in tiff)}
+def parse_ifd(tiff, ifd_offset, endian):
+    count = struct.unpack(endian + 'H', tiff[ifd_offset:ifd_offset + 2])[0]
+    entries = {}
+    for i in range(count):
+        position = ifd_offset + 2 + 12 * i
+        tag, value_type, value_count = struct.unpack(endian + 'HHI', tiff[position:position + 8])
+        entries[tag] = (value_type, value_count, position + 8)
+    return entries
+
+def tiff_endian(tiff):
+    if tiff[0:2] == b'II':
+        return '<'
+    if tiff[0:2] == b'MM':
+        return '>'
+    raise ValueError("Invalid TIFF header")
+
+def encode_comment(user_comment, size=None):
+    data = piexif.helper.UserComment.dump(user_comment)
+    if size is not None:
+        data += b' ' * (size - len(data))
+    return data
+
+def pad_comment(user_comment):
+    return user_comment + ' ' * COMMENT_SLACK
+
+# Returns a list of (offset in tiff, bytes) patches, or None when the values don't fit in place
+def plan_patches(tiff, rating, rating_percent, user_comment):
+    endian = tiff_endian(tiff)
+    ifd0 = parse_ifd(tiff, struct.unpack(endian + 'I', tiff[4:8])[0], endian)
+
+    patches = []
+    for tag, value in ((TAG_RATING, rating), (TAG_RATING_PERCENT, rating_percent)):
+        if tag not in ifd0:
+            return None
+        value_type, value_count, position = ifd0[tag]
+        if value_count != 1 or value_type not in (TYPE_SHORT, TYPE_LONG):
+            return None
+        fmt = 'H' if value_type == TYPE_SHORT else 'I'
+        patches.append((position, struct.pack(endian + fmt, value)))
+
+    if user_comment is not None:
+        if TAG_EXIF_IFD not in ifd0:
+            return None
+        exif_ifd_offset = struct.unpack(endian + 'I', tiff[ifd0[TAG_EXIF_IFD][2]:ifd0[TAG_EXIF_IFD][2] + 4])[0]
+        exif_ifd = parse_ifd(tiff, exif_ifd_offset, endian)
+        if TAG_USER_COMMENT not in exif_ifd:
+            return None
+        value_type, value_count, position = exif_ifd[TAG_USER_COMMENT]
+        data = encode_comment(user_comment)
+        if value_type != TYPE_UNDEFINED or value_count <= 4 or len(data) > value_count:
+            return None
+        data_offset = struct.unpack(endian + 'I', tiff[position:position + 4])[0]
+        if data_offset + value_count > len(tiff):
+            return None
+        patches.append((data_offset, encode_comment(user_comment, value_count)))
+
+    return patches
+
+# Tries to patch the values in place, returns the number of bytes written or None
+def patch_in_place(img_path, rating, rating_percent, user_comment):
+    with open(img_path, 'r+b') as f:
+        offset, payload = read_exif_segment(f)
+        if payload is None:
+            return None
+        tiff = payload[len(EXIF_HEADER):]
+        tiff_offset = offset + 4 + len(EXIF_HEADER)
+
+        try:
+            patches = plan_patches(tiff, rating, rating_percent, user_comment)
+        except (struct.error, ValueError):
+            return None  # Malformed EXIF, let piexif rebuild it
+        if patches is None:
+            return None
+
+        written = 0
+        for position, data in patches:
+            f.seek(tiff_offset + position)
+            f.write(data)
+            written += len(data)
+        return written
+
+def copy_range(src, dst, start, length):
+    src.seek(start)
+    while length > 0:
+        data = src.read(min(COPY_CHUNK, length))
+        if not data:
+            raise ValueError("Truncated JPEG")
+        dst.write(data)
+        length -= len(data)
+
+# Carries the permissions, flags, extended attributes and owner of img_path over to its rewritten
+# copy. The mtime is left at the time of the write, the library tells changed files by it
+def copy_metadata(img_path, tmp_path):
+    st = os.stat(img_path)
+    shutil.copystat(img_path, tmp_path)
+    os.utime(tmp_path, None)
+    if hasattr(os, 'chown'):
+        try:
+            os.chown(tmp_path, st.st_uid, st.st_gid)
+        except OSError:
+            pass  # Not allowed to give the file away, it belongs to the writer like with any editor
+
+# On Windows ReplaceFileW keeps the creation time (shown as the date), attributes and ACLs of
+# the replaced file, which os.replace would take from the temporary file
+def replace_file(tmp_path, img_path):
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        replace = ctypes.windll.kernel32.ReplaceFileW
+        replace.argtypes = [wintypes.LPCWSTR, wintypes.LPCWSTR, wintypes.LPCWSTR,
+                            wintypes.DWORD, wintypes.LPVOID, wintypes.LPVOID]
+        replace.restype = wintypes.BOOL
+        if replace(img_path, tmp_path, None, REPLACEFILE_IGNORE_MERGE_ERRORS, None, None):
+            return
+    os.replace(tmp_path, img_path)
+
+# Copies the rewritten file back over the original, for hard linked files that replacing would split
+def write_back(tmp_path, img_path):
+    with open(tmp_path, 'rb') as src, open(img_path, 'r+b') as dst:
+        shutil.copyfileobj(src, dst, COPY_CHUNK)
+        dst.truncate()
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.remove(tmp_path)
+
+# Writes the file again with exif_bytes as its APP1 segment. Segments are streamed into a
+# temporary file next to the image which then replaces it, so readers never see a partial file.
+# Matches piexif.insert's layout: EXIF first after SOI, replacing a leading JFIF APP0
+def rewrite_exif(img_path, exif_bytes):
+    segment = b'\xff\xe1' + struct.pack('>H', len(exif_bytes) + 2) + exif_bytes
+    folder, name = os.path.split(img_path)
+    tmp_path = os.path.join(folder, '.' + name + '.exif-tmp')
+
+    written = 0
+    try:
+        with open(img_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            dst.write(SOI)
+            dst.write(segment)
+            copied_data = False
+            for index, (marker, offset, length) in enumerate(list(iter_segments(src))):
+                if marker == SOS:
+                    src.seek(offset)
+                    shutil.copyfileobj(src, dst, COPY_CHUNK)
+                    copied_data = True
+                    break
+                if index == 0 and marker == APP0:
+                    continue
+                if marker == APP1:
+                    src.seek(offset + 4)
+                    if src.read(6) == EXIF_HEADER:
+                        continue
+                copy_range(src, dst, offset, 2 + length)
+
+            if not copied_data:
+                raise ValueError("Not a JPEG file: " + img_path)
+            dst.flush()
+            os.fsync(dst.fileno())
+            written = dst.tell()
+
+        if os.stat(img_path).st_nlink > 1:
+            write_back(tmp_path, img_path)
+        else:
+            copy_metadata(img_path, tmp_path)
+            replace_file(tmp_path, img_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return written
+
+# Value of a count 1 SHORT or LONG entry, None when missing or of another type
+def read_integer(tiff, entry, endian):
+    if entry is None:
+        return None
+    value_type, value_count, position = entry
+    if value_count != 1 or value_type not in (TYPE_SHORT, TYPE_LONG):
+        return None
+    fmt = 'H' if value_type == TYPE_SHORT else 'I'
+    return struct.unpack(endian + fmt, tiff[position:position + struct.calcsize(fmt)])[0]
+
+# {'rating', 'rating_percent', 'user_comment'} of a TIFF block, tags that aren't there are left out
+def parse_rating_tags(tiff):
+    endian = tiff_endian(tiff)
+    ifd0 = parse_ifd(tiff, struct.unpack(endian + 'I', tiff[4:8])[0], endian)
+    tags = {}
+    for key, tag in (('rating', TAG_RATING), ('rating_percent', TAG_RATING_PERCENT)):
+        value = read_integer(tiff, ifd0.get(tag), endian)
+        if value is not None:
+            tags[key] = value
+
+    exif_ifd_offset = read_integer(tiff, ifd0.get(TAG_EXIF_IFD), endian)
+    if exif_ifd_offset is None:
+        return tags
+    exif_ifd = parse_ifd(tiff, exif_ifd_offset, endian)
+    if TAG_USER_COMMENT in exif_ifd:
+        value_type, value_count, position = exif_ifd[TAG_USER_COMMENT]
+        if value_count > 4:  # Stored at an offset, up to 4 bytes sit in the field itself
+            position = struct.unpack(endian + 'I', tiff[position:position + 4])[0]
+        try:
+            tags['user_comment'] = piexif.helper.UserComment.load(tiff[position:position + value_count])
+        except ValueError:
+            pass  # Unknown character code, left out like a missing comment
+    return tags
+
+# The tags the gallery shows, read from an open file. Only the bytes up to the end of the APP1
+# segment are read, files without EXIF or with a malformed one give {}
+def rating_tags(f):
+    _, payload = read_exif_segment(f)
+    if payload is None:
+        return {}
+    try:
+        return parse_rating_tags(payload[len(EXIF_HEADER):])
+    except (struct.error, ValueError):
+        return {}
+
+# EXIF Orientation of an open file, which the decoder applies, None when missing or malformed
+def orientation(f):
+    _, payload = read_exif_segment(f)
+    if payload is None:
+        return None
+    try:
+        tiff = payload[len(EXIF_HEADER):]
+        endian = tiff_endian(tiff)
+        ifd0 = parse_ifd(tiff, struct.unpack(endian + 'I', tiff[4:8])[0], endian)
+        return read_integer(tiff, ifd0.get(TAG_ORIENTATION), endian)
+    except (struct.error, ValueError):
+        return None
+
+def read_rating_tags(img_path):
+    with open(img_path, 'rb') as f:
+        return rating_tags(f)
+
+def load_exif_dict(img_path):
+    with open(img_path, 'rb') as f:
+        _, payload = read_exif_segment(f)
+    if payload is None:
+        return {'0th': {}, 'Exif': {}, 'GPS': {}, 'Interop': {}, '1st': {}, 'thumbnail': None}
+    return piexif.load(payload)
+
+# Sets Rating/RatingPercent (and the UserComment when given) and returns the number of bytes written
+def write_rating(img_path, rating, rating_percent, user_comment=None):
+    written = patch_in_place(img_path, rating, rating_percent, user_comment)
+    if written is not None:
+        return written
+
+    exif_dict = load_exif_dict(img_path)
+    exif_dict['0th'][TAG_RATING] = rating
+    exif_dict['0th'][TAG_RATING_PERCENT] = rating_percent
+    if user_comment is not None:
+        exif_dict['Exif'][TAG_USER_COMMENT] = encode_comment(pad_comment(user_comment))
+    return rewrite_exif(img_path, piexif.dump(exif_dict))
@@ -0,0 +1,270 @@
+import os
+from collections import OrderedDict
+
+from PyQt5.QtWidgets import QListView, QStyledItemDelegate
+from PyQt5.QtGui import QPixmap, QColor, QPen
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QSize, QRect
+
+from thumbnails import THUMBNAIL_SIZE, ThumbnailLoader, ThumbnailDiskCache
+
+'''
+Model/view gallery.
+The gallery is a QListView in icon mode over a list of paths, so only the tiles in view are
+painted and no widget exists per image. Ratings come from the ScoreIndex of the library (see
+score_index.py), painting a tile reads no file for them, and thumbnails are made on demand: painting a tile without a thumbnail asks the background
+ThumbnailLoader for it (see thumbnails.py) and the tile is repainted once it arrives. Scrolling
+drops the requests not started yet, the repaint asks again for whatever is visible now.
+Thumbnails are kept as QPixmaps in an LRU with a byte budget, so memory does not grow with the
+size of the folder
+'''
+TILE_WIDTH = 320
+TILE_SPACING = 10
+CAPTION_HEIGHT = 50
+PIXMAP_CACHE_BYTES = 128 << 20
+
+PathRole = Qt.UserRole
+RatingRole = Qt.UserRole + 1
+SelectedRole = Qt.UserRole + 2
+
+def star_numbers(number):
+    if number not in (1, 2, 3, 4, 5):
+        return "☆☆☆☆☆"
+    return "★" * number + "☆" * (5 - number)
+
+def pixmap_bytes(pixmap):
+    return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+# QPixmaps by path, least recently used dropped first once their total size is over max_bytes
+class PixmapCache(object):
+    def __init__(self, max_bytes=PIXMAP_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.pixmaps = OrderedDict()
+
+    def __len__(self):
+        return len(self.pixmaps)
+
+    def __contains__(self, key):
+        return key in self.pixmaps
+
+    def get(self, key):
+        pixmap = self.pixmaps.get(key)
+        if pixmap is not None:
+            self.pixmaps.move_to_end(key)
+        return pixmap
+
+    def put(self, key, pixmap):
+        self.pop(key)
+        self.pixmaps[key] = pixmap
+        self.total_bytes += pixmap_bytes(pixmap)
+        while self.total_bytes > self.max_bytes and len(self.pixmaps) > 1:
+            _, old = self.pixmaps.popitem(last=False)
+            self.total_bytes -= pixmap_bytes(old)
+
+    def pop(self, key):
+        pixmap = self.pixmaps.pop(key, None)
+        if pixmap is not None:
+            self.total_bytes -= pixmap_bytes(pixmap)
+        return pixmap
+
+class GalleryModel(QAbstractListModel):
+    def __init__(self, parent=None, max_bytes=PIXMAP_CACHE_BYTES, disk_cache=None):
+        super().__init__(parent)
+        self.paths = []
+        self.row_map = {}  # img_path -> row
+        self.score_index = None  # Where the ratings are looked up
+        self.selected = set()
+        self.thumbnails = PixmapCache(max_bytes)
+        self.loader = ThumbnailLoader(self, THUMBNAIL_SIZE, disk_cache or ThumbnailDiskCache())
+        self.loader.loaded.connect(self.on_thumbnail_loaded)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.paths)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        img_path = self.paths[index.row()]
+        if role == PathRole:
+            return img_path
+        if role == Qt.DisplayRole:
+            return os.path.basename(img_path)
+        if role == Qt.DecorationRole:
+            return self.thumbnail(img_path)
+        if role == RatingRole:
+            rating = self.score_index.value(img_path, 'rating') if self.score_index is not None else None
+            return None if rating is None else int(rating)
+        if role == SelectedRole:
+            return img_path in self.selected
+        return None
+
+    def set_paths(self, img_paths):
+        self.beginResetModel()
+        self.paths = list(img_paths)
+        self.update_row_map()
+        self.selected.clear()
+        self.loader.cancel()
+        self.endResetModel()
+
+    def update_row_map(self):
+        self.row_map = dict((img_path, row) for row, img_path in enumerate(self.paths))
+
+    def row_of(self, img_path):
+        return self.row_map.get(img_path, -1)
+
+    # Adds tiles at the end, only the new rows are laid out
+    def insert_paths(self, img_paths):
+        img_paths = [img_path for img_path in img_paths if img_path not in self.row_map]
+        if not img_paths:
+            return
+        first = len(self.paths)
+        self.beginInsertRows(QModelIndex(), first, first + len(img_paths) - 1)
+        for row, img_path in enumerate(img_paths, first):
+            self.paths.append(img_path)
+            self.row_map[img_path] = row
+        self.endInsertRows()
+
+    # Removes tiles one run of consecutive rows at a time, last run first so earlier rows keep their place
+    def remove_paths(self, img_paths):
+        rows = sorted((self.row_map[img_path] for img_path in img_paths if img_path in self.row_map), reverse=True)
+        if not rows:
+            return
+        runs = []
+        for row in rows:
+            if runs and runs[-1][0] == row + 1:
+                runs[-1][0] = row
+            else:
+                runs.append([row, row])
+        for first, last in runs:
+            for img_path in self.paths[first:last + 1]:
+                self.selected.discard(img_path)
+                self.thumbnails.pop(img_path)
+            self.beginRemoveRows(QModelIndex(), first, last)
+            del self.paths[first:last + 1]
+            self.endRemoveRows()
+        self.update_row_map()
+
+    def set_score_index(self, score_index):
+        self.score_index = score_index
+        self.ratings_changed()
+
+    # The score index changed, visible tiles repaint their stars
+    def ratings_changed(self):
+        if self.paths:
+            self.dataChanged.emit(self.index(0), self.index(len(self.paths) - 1), [RatingRole])
+
+    def refresh(self, img_path):
+        # Rating changed, repainted from the score index. The pixels didn't, the thumbnail is kept
+        self.row_changed(self.row_of(img_path))
+
+    def reload(self, img_path):
+        # File changed on disk, the thumbnail is made again on the next paint
+        self.thumbnails.pop(img_path)
+        self.row_changed(self.row_of(img_path))
+
+    def rename(self, old_path, new_path):
+        row = self.row_of(old_path)
+        if row < 0:
+            return
+        self.paths[row] = new_path
+        del self.row_map[old_path]
+        self.row_map[new_path] = row
+        if old_path in self.selected:
+            self.selected.discard(old_path)
+            self.selected.add(new_path)
+        pixmap = self.thumbnails.pop(old_path)
+        if pixmap is not None:
+            self.thumbnails.put(new_path, pixmap)
+        self.refresh(new_path)
+
+    def row_changed(self, row):
+        if row >= 0:
+            index = self.index(row)
+            self.dataChanged.emit(index, index)
+
+    def set_selected(self, img_path, selected):
+        if selected:
+            self.selected.add(img_path)
+        else:
+            self.selected.discard(img_path)
+        self.row_changed(self.row_of(img_path))
+
+    def clear_selection(self):
+        self.selected.clear()
+        if self.paths:
+            self.dataChanged.emit(self.index(0), self.index(len(self.paths) - 1), [SelectedRole])
+
+    def thumbnail(self, img_path):
+        pixmap = self.thumbnails.get(img_path)
+        if pixmap is None:
+            self.loader.request(img_path)
+        return pixmap
+
+    def cancel_pending(self):
+        self.loader.cancel()
+
+    def on_thumbnail_loaded(self, img_path, image):
+        self.thumbnails.put(img_path, QPixmap.fromImage(image))
+        self.row_changed(self.row_of(img_path))
+
+    def stop(self):
+        self.loader.stop()
+
+# Paints a tile: thumbnail on top, name and stars in a caption box below
+class GalleryDelegate(QStyledItemDelegate):
+    def sizeHint(self, option, index):
+        return QSize(TILE_WIDTH, TILE_WIDTH + CAPTION_HEIGHT)
+
+    def paint(self, painter, option, index):
+        painter.save()
+        painter.setRenderHint(painter.Antialiasing)
+        rect = option.rect
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(QColor('grey'))
+        painter.drawRoundedRect(rect, 10, 10)
+
+        image_rect = QRect(rect.left(), rect.top(), TILE_WIDTH, TILE_WIDTH)
+        if index.data(SelectedRole):
+            painter.setBrush(QColor('lightblue'))
+            painter.setPen(QPen(QColor('blue'), 2))
+            painter.drawRect(image_rect.adjusted(1, 1, -1, -1))
+
+        pixmap = index.data(Qt.DecorationRole)
+        if pixmap is not None:
+            x = image_rect.left() + (TILE_WIDTH - pixmap.width()) // 2
+            painter.drawPixmap(x, image_rect.top() + (TILE_WIDTH - THUMBNAIL_SIZE) // 2, pixmap)
+
+        caption_rect = QRect(rect.left(), image_rect.bottom() + 1, TILE_WIDTH, CAPTION_HEIGHT)
+        painter.setPen(QPen(QColor('blue'), 1))
+        painter.setBrush(QColor('lightgrey'))
+        painter.drawRoundedRect(caption_rect.adjusted(0, 0, -1, -1), 10, 10)
+        painter.setPen(QColor('black'))
+        text = index.data(Qt.DisplayRole) + "\n" + star_numbers(index.data(RatingRole))
+        painter.drawText(caption_rect, Qt.AlignHCenter | Qt.AlignTop | Qt.TextWrapAnywhere, text)
+        painter.restore()
+
+class GalleryView(QListView):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setViewMode(QListView.IconMode)
+        self.setResizeMode(QListView.Adjust)
+        self.setMovement(QListView.Static)
+        self.setUniformItemSizes(True)  # Layout is computed from one size hint, not per row
+        self.setSpacing(TILE_SPACING)
+        self.setSelectionMode(QListView.NoSelection)  # Ctrl+Click selection is kept by the model
+        self.setVerticalScrollMode(QListView.ScrollPerPixel)
+        self.setItemDelegate(GalleryDelegate(self))
+
+    def set_multi_row(self, multi_row):
+        self.setFlow(QListView.LeftToRight if multi_row else QListView.TopToBottom)
+        self.setWrapping(multi_row)
+        width = TILE_WIDTH + 2 * TILE_SPACING + self.verticalScrollBar().sizeHint().width() + 2 * self.frameWidth()
+        self.setMinimumWidth(0 if multi_row else width)
+
+    def scrollContentsBy(self, dx, dy):
+        # Tiles scrolled past don't need their thumbnails any more
+        if self.model() is not None:
+            self.model().cancel_pending()
+        super().scrollContentsBy(dx, dy)
@@ -0,0 +1,85 @@
+from library_scan import file_signature
+
+'''
+Hot-folder ingest.
+Files that land in a watched folder are only taken in once they are complete: their size and
+mtime are checked on every poll and a file counts as stable when they didn't change since the
+previous one, so a camera tether or a card dump still copying is skipped until it is done.
+Own writes (scores and ratings written back into the EXIF) are recorded in a registry with the
+size and mtime they left behind, so a folder change can tell them from an external edit of the
+same file without muting the watcher while the app is writing
+'''
+STABLE_POLL_INTERVAL = 1000  # ms between size checks of files still being written
+
+# New files waiting for their size to settle
+class StabilityTracker(object):
+    def __init__(self):
+        self.signatures = {}  # img_path -> signature at the last poll
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def __contains__(self, img_path):
+        return img_path in self.signatures
+
+    def add(self, img_paths):
+        for img_path in img_paths:
+            if img_path not in self.signatures:
+                self.signatures[img_path] = file_signature(img_path)
+
+    def discard(self, img_paths):
+        for img_path in img_paths:
+            self.signatures.pop(img_path, None)
+
+    # Paths unchanged since the previous poll, in the order they were added. Files that are
+    # gone are dropped, empty ones are still being created
+    def poll(self):
+        stable = []
+        for img_path, previous in list(self.signatures.items()):
+            signature = file_signature(img_path)
+            if signature is None:
+                del self.signatures[img_path]
+            elif signature == previous and signature[0] > 0:
+                del self.signatures[img_path]
+                stable.append(img_path)
+            else:
+                self.signatures[img_path] = signature
+        return stable
+
+# Files the app is writing or has written. A path is expected from the moment it is handed to a
+# writer until its write is recorded, after which only the signature the write left counts as own
+class WriteRegistry(object):
+    def __init__(self):
+        self.expected = {}  # img_path -> number of writers that haven't finished
+        self.written = {}   # img_path -> signature after the last own write
+
+    def expect(self, img_paths):
+        for img_path in img_paths:
+            self.expected[img_path] = self.expected.get(img_path, 0) + 1
+
+    def finish(self, img_paths):
+        for img_path in img_paths:
+            count = self.expected.get(img_path, 0) - 1
+            if count > 0:
+                self.expected[img_path] = count
+            else:
+                self.expected.pop(img_path, None)
+
+    # Called once the write of img_path is done
+    def record(self, img_path):
+        self.finish([img_path])
+        signature = file_signature(img_path)
+        if signature is not None:
+            self.written[img_path] = signature
+
+    def is_own(self, img_path, signature):
+        return img_path in self.expected or self.written.get(img_path) == signature
+
+    def rename(self, old_path, new_path):
+        signature = self.written.pop(old_path, None)
+        if signature is not None:
+            self.written[new_path] = signature
+
+    def forget(self, img_paths):
+        for img_path in img_paths:
+            self.written.pop(img_path, None)
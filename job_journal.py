@@ -0,0 +1,77 @@
+import os
+import json
+import time
+
+'''
+Append-only journal for resumable scoring jobs.
+One JSON line per finished image, {"path", "status": "done", "scores"} or
+{"path", "status": "failed", "error"}, written in order and fsync'd every fsync_every
+records (or fsync_interval seconds). A process killed mid-write can only leave a torn last
+line, which is cut off when the journal is opened again, so every earlier record survives
+'''
+class JobJournal(object):
+    def __init__(self, path, fsync_every=64, fsync_interval=5.0):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.completed = {}  # path -> scores
+        self.failures = {}   # path -> number of failed attempts
+
+        self.load()
+        self.f = open(path, 'a')
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            # Torn record from an interrupted write, drop it so new records start on a fresh line
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+            img_path = record.get('path')
+            if record.get('status') == 'done':
+                self.completed[img_path] = record.get('scores')
+                self.failures.pop(img_path, None)
+            elif record.get('status') == 'failed':
+                self.failures[img_path] = self.failures.get(img_path, 0) + 1
+
+    def append(self, record):
+        self.f.write(json.dumps(record) + '\n')
+        self.unsynced += 1
+        if self.unsynced >= self.fsync_every or time.monotonic() - self.last_sync >= self.fsync_interval:
+            self.sync()
+
+    def record_done(self, img_path, scores):
+        self.completed[img_path] = scores
+        self.failures.pop(img_path, None)
+        self.append({'path': img_path, 'status': 'done', 'scores': scores})
+
+    def record_failed(self, img_path, error):
+        self.failures[img_path] = self.failures.get(img_path, 0) + 1
+        self.append({'path': img_path, 'status': 'failed', 'error': str(error)})
+
+    # Images still to score: not completed and failed at most max_retries times so far
+    def pending(self, img_paths, max_retries):
+        return [img_path for img_path in img_paths if img_path not in self.completed
+                and self.failures.get(img_path, 0) <= max_retries]
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        self.sync()
+        self.f.close()
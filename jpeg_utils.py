@@ -0,0 +1,76 @@
+import struct
+
+'''
+Minimal JPEG marker walking, reads only the header segments and never the image data
+'''
+SOI = b'\xff\xd8'
+SOS = 0xDA
+EOI = 0xD9
+
+# Start Of Frame markers (all except DHT, JPG and DAC which share the range)
+SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# Markers without a length field
+STANDALONE_MARKERS = set(range(0xD0, 0xD8)) | {0x01}
+
+# Yields (marker, offset, length) for every header segment up to Start Of Scan.
+# offset is the position of the 0xFF byte of the marker and length is the value of the
+# segment's length field (covers the 2 length bytes plus the payload), 0 for standalone markers
+def iter_segments(f):
+    f.seek(0)
+    if f.read(2) != SOI:
+        return
+
+    offset = 2
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return
+        if byte != b'\xff':
+            return  # Corrupt stream, stop rather than guessing
+        marker = f.read(1)
+        # Skip fill bytes between markers
+        while marker == b'\xff':
+            offset += 1
+            marker = f.read(1)
+        if not marker:
+            return
+        marker = marker[0]
+
+        if marker in STANDALONE_MARKERS:
+            yield marker, offset, 0
+            offset += 2
+            continue
+        if marker == EOI:
+            return
+
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            return
+        length = struct.unpack('>H', length_bytes)[0]
+        yield marker, offset, length
+        if marker == SOS:
+            return
+
+        offset += 2 + length
+        f.seek(offset)
+
+# Returns (width, height) from the frame header of an open file, or None when it is not a JPEG
+def jpeg_size(f):
+    try:
+        for marker, offset, length in iter_segments(f):
+            if marker in SOF_MARKERS:
+                f.seek(offset + 4)
+                precision, height, width = struct.unpack('>BHH', f.read(5))
+                return width, height
+    except struct.error:
+        pass
+    return None
+
+# Returns (width, height) from the frame header, or None for files that are not a JPEG
+def read_jpeg_size(img_path):
+    try:
+        with open(img_path, 'rb') as f:
+            return jpeg_size(f)
+    except (IOError, OSError):
+        return None
@@ -0,0 +1,59 @@
+import os
+
+'''
+Folder scanning for the gallery.
+Built on os.scandir, so file types come from the directory entries without a stat per file
+(sizes and mtimes for the library catalog come from the same pass, free on Windows and one stat
+per image elsewhere).
+Symlinked folders are not followed (no loops) and unreadable folders are skipped. Folders are
+visited depth first in name order and reported one at a time, so callers can show the first
+images while the rest of a large archive is still being listed
+'''
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg')
+SCAN_BATCH_INTERVAL = 0.1  # Seconds between batches of scanned folders sent to the gallery
+
+def is_image_name(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+# (size, mtime_ns) of a file, None when it is gone
+def file_signature(img_path):
+    try:
+        st = os.stat(img_path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+# Sorted (img_paths, subfolders) directly inside folder. When a signatures dict is given the
+# (size, mtime_ns) of each image is added to it, from the directory entry where the OS has it
+def scan_folder(folder, signatures=None):
+    img_paths = []
+    subfolders = []
+    try:
+        for entry in os.scandir(folder):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subfolders.append(entry.path)
+                elif is_image_name(entry.name) and entry.is_file():
+                    img_paths.append(entry.path)
+                    if signatures is not None:
+                        st = entry.stat()
+                        signatures[entry.path] = (st.st_size, st.st_mtime_ns)
+            except OSError:
+                continue  # Vanished or unreadable entry
+    except OSError:
+        pass  # No permission, or the folder is gone
+    img_paths.sort()
+    subfolders.sort()
+    return img_paths, subfolders
+
+# Yields (folder, img_paths, signatures) for root and, when recursive, every folder below it.
+# With with_signatures each folder gets a dict of its own, None otherwise
+def iter_folders(root, recursive=True, with_signatures=False):
+    stack = [root]
+    while stack:
+        folder = stack.pop()
+        signatures = {} if with_signatures else None
+        img_paths, subfolders = scan_folder(folder, signatures)
+        yield folder, img_paths, signatures
+        if recursive:
+            stack.extend(reversed(subfolders))
@@ -0,0 +1,242 @@
+import os
+import time
+import threading
+from bisect import bisect_left
+
+'''
+Lightweight pipeline metrics.
+Counters, gauges and per-stage latency histograms (fixed buckets, Prometheus style) in one
+process-wide registry. Everything is a no-op until enable() is called; when enabled a timed
+stage costs two perf_counter() calls and a bucket lookup under a lock.
+Exported as a JSON snapshot, as Prometheus text (PrometheusFileWriter rewrites a file every few
+seconds, e.g. for node_exporter's textfile collector) and shown in the GUI's stats panel.
+Inference worker processes send their deltas back with each chunk, see drain() and merge()
+'''
+# Histogram upper bounds in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PREFIX = 'aestheticsense_'
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # Last bucket is +Inf
+        self.total = 0.0
+        self.low = None
+        self.high = None
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.low = value if self.low is None else min(self.low, value)
+        self.high = value if self.high is None else max(self.high, value)
+
+    def state(self):
+        return self.counts, self.total, self.low, self.high
+
+    def merge(self, state):
+        counts, total, low, high = state
+        for i, n in enumerate(counts):
+            self.counts[i] += n
+        self.total += total
+        if low is not None:
+            self.low = low if self.low is None else min(self.low, low)
+            self.high = high if self.high is None else max(self.high, high)
+
+    # Linear interpolation inside the bucket holding the q-th observation, clamped to the
+    # observed range so a handful of samples don't report a bucket bound
+    def percentile(self, q):
+        value = self.bucket_percentile(q)
+        if value is None:
+            return None
+        return min(max(value, self.low), self.high)
+
+    def bucket_percentile(self, q):
+        count = self.count
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        lower = 0.0
+        for i, n in enumerate(self.counts):
+            upper = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+            if n and seen + n >= rank:
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+            lower = upper
+        return BUCKETS[-1]
+
+class Timer(object):
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        observe(self.stage, time.perf_counter() - self.start)
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+NULL_TIMER = NullTimer()
+
+enabled = False
+lock = threading.Lock()
+counters = {}
+gauges = {}
+stages = {}
+start_time = time.time()
+last_rate = (start_time, 0)
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+def is_enabled():
+    return enabled
+
+def reset():
+    global start_time, last_rate
+    with lock:
+        counters.clear()
+        gauges.clear()
+        stages.clear()
+        start_time = time.time()
+        last_rate = (start_time, 0)
+
+def inc(name, value=1):
+    if not enabled:
+        return
+    with lock:
+        counters[name] = counters.get(name, 0) + value
+
+def set_gauge(name, value):
+    if not enabled:
+        return
+    gauges[name] = value
+
+def observe(stage, seconds):
+    if not enabled:
+        return
+    with lock:
+        histogram = stages.get(stage)
+        if histogram is None:
+            histogram = stages[stage] = Histogram()
+        histogram.observe(seconds)
+
+# with timer('decode'): ... records the duration of the block as a 'decode' stage latency
+def timer(stage):
+    if not enabled:
+        return NULL_TIMER
+    return Timer(stage)
+
+# Counters and histograms recorded since the last drain, cleared afterwards (None when disabled)
+def drain():
+    if not enabled:
+        return None
+    with lock:
+        delta = {'counters': dict(counters),
+                 'stages': dict((stage, h.state()) for stage, h in stages.items())}
+        counters.clear()
+        stages.clear()
+    return delta
+
+def merge(delta):
+    if not enabled or not delta:
+        return
+    with lock:
+        for name, value in delta['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+        for stage, state in delta['stages'].items():
+            stages.setdefault(stage, Histogram()).merge(state)
+
+def snapshot():
+    global last_rate
+
+    now = time.time()
+    with lock:
+        scored = counters.get('images_scored', 0)
+        previous_time, previous_scored = last_rate
+        last_rate = (now, scored)
+        hits = counters.get('cache_hits', 0)
+        lookups = hits + counters.get('cache_misses', 0)
+        stage_stats = {}
+        for stage, histogram in stages.items():
+            count = histogram.count
+            stage_stats[stage] = {
+                'count': count,
+                'mean_ms': 1000.0 * histogram.total / count if count else None,
+                'p50_ms': 1000.0 * histogram.percentile(0.5) if count else None,
+                'p95_ms': 1000.0 * histogram.percentile(0.95) if count else None,
+                'p99_ms': 1000.0 * histogram.percentile(0.99) if count else None
+            }
+        return {
+            'enabled': enabled,
+            'uptime_seconds': now - start_time,
+            'images_per_second': scored / max(now - start_time, 1e-9),
+            'recent_images_per_second': (scored - previous_scored) / max(now - previous_time, 1e-9),
+            'cache_hit_rate': hits / lookups if lookups else None,
+            'counters': dict(counters),
+            'gauges': dict(gauges),
+            'stages': stage_stats
+        }
+
+def prometheus_text():
+    lines = []
+    with lock:
+        for name, value in sorted(counters.items()):
+            lines.append('# TYPE {}{}_total counter'.format(PREFIX, name))
+            lines.append('{}{}_total {}'.format(PREFIX, name, value))
+        for name, value in sorted(gauges.items()):
+            lines.append('# TYPE {}{} gauge'.format(PREFIX, name))
+            lines.append('{}{} {}'.format(PREFIX, name, value))
+
+        name = PREFIX + 'stage_seconds'
+        lines.append('# TYPE {} histogram'.format(name))
+        for stage, histogram in sorted(stages.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(name, stage, bound, cumulative))
+            lines.append('{}_sum{{stage="{}"}} {}'.format(name, stage, histogram.total))
+            lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, cumulative))
+    return '\n'.join(lines) + '\n'
+
+def write_prometheus(path):
+    # Written next to the target and renamed, so a scraper never reads a half written file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(prometheus_text())
+    os.replace(tmp_path, path)
+
+# Rewrites a Prometheus text file every interval seconds on a daemon thread until stop()
+class PrometheusFileWriter(object):
+    def __init__(self, path, interval=10.0):
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='metrics-writer', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                write_prometheus(self.path)
+            except OSError:
+                pass  # Target folder went away, try again next time
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        write_prometheus(self.path)
@@ -1,10 +1,22 @@
 import os
 import glob
 import cv2
-import piexif
-import piexif.helper
 import json
 import sys
+import io
+import queue
+import sqlite3
+import functools
+import itertools
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from jpeg_utils import read_jpeg_size, jpeg_size
+from score_cache import ScoreCache, content_hash, user_cache_dir
+from exif_io import write_rating
+import metrics
+import score_daemon
 
 
 # Function for EXE (PyInstaller) so files are accessed via correct path due to how
@@ -19,17 +31,14 @@ def resourcePath(relativePath):
 
 os.environ["MPLCONFIGDIR"] = resourcePath(".")
 
-import caffe
+import threading
 import numpy as np
-from caffe.proto import caffe_pb2
 
 # Loading model files using resourcePath
 IMAGE_MEAN = resourcePath('mean_AADB_regression_warp256.binaryproto')
 DEPLOY = resourcePath('initModel.prototxt')
 MODEL_FILE = resourcePath('initModel.caffemodel')
 
-caffe.set_mode_cpu()
-
 #Size of images
 IMAGE_WIDTH = 227
 IMAGE_HEIGHT = 227
@@ -46,54 +55,477 @@ def transform_img(img, img_width=IMAGE_WIDTH, img_height=IMAGE_HEIGHT):
 
 '''
 Reading mean image, caffe model and its weights
+Building the net (~200MB of weights) waits until the first inference or an explicit
+load_model() call, so importing this module stays cheap. The same prototxt/caffemodel can
+run on pycaffe or on OpenCV's DNN module, chosen with set_backend() or AESTHETIC_BACKEND
 '''
-#Read mean image
-mean_blob = caffe_pb2.BlobProto()
-with open(IMAGE_MEAN, "rb") as f:
-    mean_blob.ParseFromString(f.read())
-mean_array = np.asarray(mean_blob.data, dtype=np.float32).reshape(
-    (mean_blob.channels, mean_blob.height, mean_blob.width))
+OUTPUT_BLOBS = ['fc11_score', 'fc9_VividColor', 'fc9_Symmetry', 'fc9_RuleOfThirds', 'fc9_MotionBlur',
+                'fc9_Repetition', 'fc9_Content', 'fc9_Light', 'fc9_Object', 'fc9_ColorHarmony',
+                'fc9_DoF', 'fc9_BalancingElement']
 
-#Cropping mean image to correct dimensions for model
-mean_array = mean_array[:, 15:242, 15:242]
+def read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
 
-#Read model architecture and trained model's weights
-net = caffe.Net(DEPLOY, caffe.TEST, weights=MODEL_FILE)
+# Decodes a caffe BlobProto without needing caffe/protobuf: the legacy num/channels/height/width
+# fields or the shape message give the dimensions, data holds the floats (packed or not)
+def read_binaryproto(path):
+    with open(path, 'rb') as f:
+        data = f.read()
 
+    dims = {}
+    shape = []
+    values = []
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+            dims[field] = value
+        elif wire_type == 2:
+            length, pos = read_varint(data, pos)
+            payload = data[pos:pos + length]
+            pos += length
+            if field == 5:
+                values.append(np.frombuffer(payload, dtype='<f4'))
+            elif field == 7:
+                shape_pos = 0
+                while shape_pos < len(payload):
+                    shape_key, shape_pos = read_varint(payload, shape_pos)
+                    if shape_key & 7 == 2:
+                        dims_length, shape_pos = read_varint(payload, shape_pos)
+                        end = shape_pos + dims_length
+                        while shape_pos < end:
+                            dim, shape_pos = read_varint(payload, shape_pos)
+                            shape.append(dim)
+                    else:
+                        dim, shape_pos = read_varint(payload, shape_pos)
+                        shape.append(dim)
+        elif wire_type == 5:
+            if field == 5:
+                values.append(np.frombuffer(data[pos:pos + 4], dtype='<f4'))
+            pos += 4
+        elif wire_type == 1:
+            pos += 8
+        else:
+            raise ValueError("Unsupported protobuf wire type in " + path)
 
-#Define image transformers
-net.blobs[input_layer].reshape(1,        # batch size
-                              3,         # channel
-                              IMAGE_WIDTH, IMAGE_HEIGHT)  # image size
-transformer = caffe.io.Transformer({input_layer: net.blobs[input_layer].data.shape})
-transformer.set_mean(input_layer, mean_array)
-transformer.set_transpose(input_layer, (2,0,1))
+    if not shape:
+        shape = [dims.get(1, 1), dims.get(2, 1), dims.get(3, 1), dims.get(4, 1)]
+    return np.concatenate(values).astype(np.float32).reshape(shape)
 
-def predict_image(img_path):
-    img = cv2.imread(img_path, cv2.IMREAD_COLOR)
-    img = transform_img(img, img_width=IMAGE_WIDTH, img_height=IMAGE_HEIGHT)
+def read_mean_image():
+    mean = read_binaryproto(IMAGE_MEAN)
+    mean = mean.reshape(mean.shape[-3:])
 
-    net.blobs[input_layer].data[...] = transformer.preprocess(input_layer, img)
-    out = net.forward()
+    #Cropping mean image to correct dimensions for model
+    return np.ascontiguousarray(mean[:, 15:242, 15:242])
 
-    pred_score = out['fc11_score'][0][0]
-    
-    exif_dict = piexif.load(img_path)
-    rating_percent = int(pred_score*100)
-    exif_dict['0th'][piexif.ImageIFD.RatingPercent] = rating_percent
+# The cropped mean is cached as .npy next to the binaryproto (or in the user cache folder when
+# that folder is read-only, e.g. inside the exe) and memory-mapped while it is newer than the binaryproto
+def mean_cache_paths():
+    name = '{}.crop{}.npy'.format(os.path.splitext(os.path.basename(IMAGE_MEAN))[0], IMAGE_WIDTH)
+    return [os.path.join(os.path.dirname(IMAGE_MEAN), name), os.path.join(user_cache_dir(), name)]
+
+def load_mean():
+    source_mtime = os.path.getmtime(IMAGE_MEAN)
+    for path in mean_cache_paths():
+        try:
+            if os.path.getmtime(path) >= source_mtime:
+                return np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            pass
+
+    mean = read_mean_image()
+    for path in mean_cache_paths():
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, mean)
+            os.replace(path + '.tmp', path)
+            return np.load(path, mmap_mode='r')
+        except OSError:
+            continue
+    return mean
+
+# Fused replacement for caffe.io.Transformer.preprocess: writes the batch straight into blob
+# (N, 3, H, W float32) as BGR, CHW minus the mean. The subtraction reads the HWC image through a
+# transposed view and casts while writing, so no per-image float/transposed copies are made.
+# Images not already at the input size are resized into resize_buffer first
+def fill_input_blob(imgs, blob, mean, resize_buffer=None):
+    with metrics.timer('preprocess'):
+        for i, img in enumerate(imgs):
+            if img.shape[:2] != (IMAGE_HEIGHT, IMAGE_WIDTH):
+                if resize_buffer is None or resize_buffer.dtype != img.dtype:
+                    resize_buffer = np.empty((IMAGE_HEIGHT, IMAGE_WIDTH, 3), dtype=img.dtype)
+                img = cv2.resize(img, (IMAGE_WIDTH, IMAGE_HEIGHT), dst=resize_buffer, interpolation=cv2.INTER_CUBIC)
+            np.subtract(img.transpose(2, 0, 1), mean, out=blob[i])
+    return blob
+
+class CaffeBackend(object):
+    name = 'caffe'
+
+    def __init__(self):
+        import caffe
+
+        caffe.set_mode_cpu()
+
+        #Read model architecture and trained model's weights
+        self.net = caffe.Net(DEPLOY, caffe.TEST, weights=MODEL_FILE)
+        self.net.blobs[input_layer].reshape(1,        # batch size
+                                            3,         # channel
+                                            IMAGE_WIDTH, IMAGE_HEIGHT)  # image size
+        self.mean = load_mean()
+        self.resize_buffer = np.empty((IMAGE_HEIGHT, IMAGE_WIDTH, 3), dtype=np.uint8)
+
+    def forward(self, imgs):
+        # Resize the input blob to the number of images so the whole batch runs in one pass
+        batch_size = len(imgs)
+        if self.net.blobs[input_layer].data.shape[0] != batch_size:
+            self.net.blobs[input_layer].reshape(batch_size, 3, IMAGE_WIDTH, IMAGE_HEIGHT)
+            self.net.reshape()
+
+        fill_input_blob(imgs, self.net.blobs[input_layer].data, self.mean, self.resize_buffer)
+        return self.net.forward()
+
+# Input blob reused across batches of the same size (cv2.dnn copies it in setInput)
+class InputBuffer(object):
+    def __init__(self):
+        self.mean = load_mean()
+        self.blob = None
+        self.resize_buffer = np.empty((IMAGE_HEIGHT, IMAGE_WIDTH, 3), dtype=np.uint8)
+
+    def fill(self, imgs):
+        if self.blob is None or self.blob.shape[0] != len(imgs):
+            self.blob = np.empty((len(imgs), 3, IMAGE_HEIGHT, IMAGE_WIDTH), dtype=np.float32)
+        return fill_input_blob(imgs, self.blob, self.mean, self.resize_buffer)
+
+# cv2.dnn runs the convolutions multi-threaded without a tuned BLAS and needs no caffe build
+class OpenCVBackend(object):
+    name = 'opencv'
+
+    def __init__(self):
+        self.inputs = InputBuffer()
+        self.net = cv2.dnn.readNetFromCaffe(DEPLOY, MODEL_FILE)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+
+    def forward(self, imgs):
+        self.net.setInput(self.inputs.fill(imgs), input_layer)
+        return dict(zip(OUTPUT_BLOBS, self.net.forward(OUTPUT_BLOBS)))
+
+# Low-memory mode: conv trunk in cv2.dnn, fully connected layers with int8/float16 weights (see quantized.py)
+class QuantizedBackend(object):
+    def __init__(self, mode):
+        import quantized
+
+        self.name = mode
+        self.inputs = InputBuffer()
+        self.heads = quantized.QuantizedHeads(quantized.load_weights(DEPLOY, MODEL_FILE, mode))
+        self.trunk = quantized.load_trunk(DEPLOY, MODEL_FILE)
+
+    def forward(self, imgs):
+        self.trunk.setInput(self.inputs.fill(imgs), input_layer)
+        pool5 = self.trunk.forward('pool5')
+        return self.heads.forward(pool5.reshape(len(imgs), -1))
+
+BACKENDS = {'caffe': CaffeBackend, 'opencv': OpenCVBackend,
+            'int8': functools.partial(QuantizedBackend, 'int8'),
+            'fp16': functools.partial(QuantizedBackend, 'fp16')}
+BACKEND = os.environ.get('AESTHETIC_BACKEND', 'caffe')
+
+backend = None
+model_lock = threading.Lock()
+
+def set_backend(name):
+    global BACKEND, backend
+
+    if name not in BACKENDS:
+        raise ValueError("Unknown backend: " + name)
+    with model_lock:
+        if name != BACKEND:
+            BACKEND = name
+            backend = None
+
+def is_model_loaded():
+    return backend is not None
+
+def load_model():
+    global backend
+
+    with model_lock:
+        if backend is None:
+            backend = BACKENDS[BACKEND]()
+        return backend
+
+#Number of images pushed through the net in one forward pass
+BATCH_SIZE = 16
+
+# Send predict_image()/predict_images() to a running scoring daemon instead of loading the net here
+USE_DAEMON = os.environ.get('AESTHETIC_DAEMON', '1') != '0'
+DAEMON_BATCH = 2 * BATCH_SIZE  # Paths per request to the daemon
+
+def daemon_available():
+    return USE_DAEMON and score_daemon.is_running()
+
+# Let libjpeg scale JPEGs down by 2/4/8 while decoding (DCT-domain scaling) instead of
+# decoding at full resolution and resizing afterwards. The largest factor is used that still
+# leaves the shorter side at least REDUCED_MIN_SIDE pixels, which is what transform_img resizes from
+REDUCED_DECODE = True
+REDUCED_MIN_SIDE = 256
+REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                 (4, cv2.IMREAD_REDUCED_COLOR_4),
+                 (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+def decode_flag(img_path, reduced=None, size=None):
+    if reduced is None:
+        reduced = REDUCED_DECODE
+    if not reduced:
+        return cv2.IMREAD_COLOR
+
+    if size is None:
+        size = read_jpeg_size(img_path)
+    if size is None:
+        return cv2.IMREAD_COLOR
+    for factor, flag in REDUCED_FLAGS:
+        if min(size) // factor >= REDUCED_MIN_SIDE:
+            return flag
+    return cv2.IMREAD_COLOR
+
+def read_image(img_path, reduced=None):
+    return cv2.imread(img_path, decode_flag(img_path, reduced))
+
+# Same as prepare_image for an encoded image held in memory (e.g. sent to the scoring daemon)
+def prepare_image_bytes(data, reduced=None):
+    size = jpeg_size(io.BytesIO(data))
+    flag = decode_flag(None, reduced, size) if size is not None else cv2.IMREAD_COLOR
+    with metrics.timer('decode'):
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+    if img is None:
+        raise IOError("Could not decode image data")
+    with metrics.timer('resize'):
+        return transform_img(img, img_width=IMAGE_WIDTH, img_height=IMAGE_HEIGHT)
+
+def prepare_image(img_path, reduced=None):
+    with metrics.timer('decode'):
+        img = read_image(img_path, reduced)
+    if img is None:
+        raise IOError("Could not read image: " + img_path)
+    with metrics.timer('resize'):
+        return transform_img(img, img_width=IMAGE_WIDTH, img_height=IMAGE_HEIGHT)
+
+# The 'forward' stage includes filling the input blob, which is also reported as 'preprocess'
+def forward_images(imgs):
+    net = load_model()
+    with metrics.timer('forward'):
+        out = net.forward(imgs)
+    metrics.inc('batches')
+    metrics.set_gauge('last_batch_size', len(imgs))
+    return [calculate_custom_dict(out, i) for i in range(len(imgs))]
+
+def write_scores(img_path, custom_dict):
+    rating_percent = int(custom_dict['fc11_score']*100)
     rating = calculate_rating(rating_percent)
-    exif_dict['0th'][piexif.ImageIFD.Rating] = rating
+    with metrics.timer('exif_write'):
+        write_rating(img_path, rating, rating_percent, json.dumps(custom_dict))
 
-    custom_dict = calculate_custom_dict(out)
-    user_comment = json.dumps(custom_dict)
-    user_comment = piexif.helper.UserComment.dump(user_comment)
-    exif_dict["Exif"][piexif.ExifIFD.UserComment] = user_comment
+# Uses the scoring daemon when one is running (see score_daemon.py), the net is then never
+# loaded in this process. The scores are still written here, the daemon only reads the file
+def predict_image(img_path):
+    custom_dict = score_daemon.try_score_path(img_path) if USE_DAEMON else None
+    if custom_dict is not None:
+        write_scores(img_path, custom_dict)
+        return img_path
 
-    exif_bytes = piexif.dump(exif_dict)
-    piexif.insert(exif_bytes, img_path)
+    for img_path, _ in predict_images([img_path], batch_size=1, prefetch_depth=0, use_daemon=False):
+        pass
 
     return img_path
 
+'''
+Persistent score cache, see score_cache.py. Lookups hash the file on the prefetch threads,
+so cache hits skip decoding and the forward pass entirely
+'''
+SCORE_CACHE = True
+score_cache = None
+score_cache_owner = None
+cache_lock = threading.Lock()
+
+def get_score_cache():
+    global score_cache, score_cache_owner
+
+    if not SCORE_CACHE:
+        return None
+    # Backend and decode settings change the scores slightly, so they are part of the cache key
+    variant = BACKEND + ('-reduced' if REDUCED_DECODE else '-full')
+    owner = (os.getpid(), variant)  # sqlite connections must not be reused by forked workers
+    with cache_lock:
+        if score_cache_owner != owner:
+            score_cache_owner = owner
+            try:
+                score_cache = ScoreCache(model_files=(DEPLOY, MODEL_FILE, IMAGE_MEAN), variant=variant)
+            except (sqlite3.Error, OSError):
+                score_cache = None  # Unwritable cache dir, score without caching
+        return score_cache
+
+# Runs on the prefetch threads: returns (cache key, cached custom_dict, None, None) on a hit
+# and (cache key, None, img, None) when the image has to go through the net. With catch_errors
+# a file that can't be read gives (None, None, None, error) instead of raising
+def load_for_scoring(img_path, cache=None, catch_errors=False):
+    try:
+        key = None
+        if cache is not None:
+            with metrics.timer('cache_lookup'):
+                key = content_hash(img_path)
+                custom_dict = cache.get(key)
+            if custom_dict is not None:
+                metrics.inc('cache_hits')
+                return key, custom_dict, None, None
+            metrics.inc('cache_misses')
+        return key, None, prepare_image(img_path), None
+    except Exception as e:
+        if not catch_errors:
+            raise
+        return None, None, None, e
+
+#Threads decoding/resizing images and how many images may be decoded ahead of the net
+PREFETCH_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+PREFETCH_DEPTH = 2 * BATCH_SIZE
+
+# Decodes and resizes images on a thread pool ahead of the consumer, yielding
+# (img_path, load(img_path)) in input order. At most `depth` images are queued or being decoded,
+# so nothing more is read until the consumer catches up (cv2 releases the GIL while decoding)
+def prefetch_images(img_paths, workers=PREFETCH_WORKERS, depth=PREFETCH_DEPTH, load=prepare_image):
+    if depth <= 0:
+        for img_path in img_paths:
+            yield img_path, load(img_path)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = deque()
+    try:
+        for img_path in img_paths:
+            if len(pending) >= depth:
+                ready_path, future = pending.popleft()
+                metrics.set_gauge('prefetch_queue_depth', len(pending))
+                yield ready_path, future.result()
+            pending.append((img_path, executor.submit(load, img_path)))
+            metrics.set_gauge('prefetch_queue_depth', len(pending))
+
+        while pending:
+            ready_path, future = pending.popleft()
+            metrics.set_gauge('prefetch_queue_depth', len(pending))
+            yield ready_path, future.result()
+    finally:
+        # Consumer stopped early (cancel/error), drop whatever has not started yet
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+# pending holds [img_path, cache key, custom_dict, img, error] in input order, img is set for cache misses
+def score_pending(pending, cache=None, write_exif=True, on_error=None):
+    imgs = [item[3] for item in pending if item[3] is not None]
+    if imgs:
+        scores = iter(forward_images(imgs))
+        new_entries = []
+        for item in pending:
+            if item[3] is not None:
+                item[2] = next(scores)
+                if item[1] is not None:
+                    new_entries.append((item[1], item[2]))
+        if cache is not None and new_entries:
+            with metrics.timer('cache_store'):
+                cache.put_many(new_entries)
+
+    for img_path, key, custom_dict, img, error in pending:
+        if error is None and write_exif:
+            try:
+                write_scores(img_path, custom_dict)
+            except Exception as e:
+                if on_error is None:
+                    raise
+                error = e
+        if error is not None:
+            metrics.inc('images_failed')
+            on_error(img_path, error)
+            continue
+        metrics.inc('images_scored')
+        yield img_path, custom_dict
+
+# Same contract as predict_images, scored by the daemon DAEMON_BATCH paths at a time and written
+# here. If the daemon goes away the images not scored yet go through the local net
+def predict_images_daemon(img_paths, batch_size, write_exif, use_cache, on_error):
+    client = score_daemon.DaemonClient()
+    img_paths = iter(img_paths)
+    for chunk in iter(lambda: list(itertools.islice(img_paths, DAEMON_BATCH)), []):
+        try:
+            results = client.score_paths(chunk, use_cache)
+        except (OSError, EOFError, ValueError, score_daemon.DaemonError):
+            yield from predict_images(itertools.chain(chunk, img_paths), batch_size, write_exif,
+                                      use_cache=use_cache, on_error=on_error, use_daemon=False)
+            return
+
+        for img_path, result in zip(chunk, results):
+            custom_dict = result.get('scores')
+            error = IOError(result['error']) if 'error' in result else None
+            if error is None and write_exif:
+                try:
+                    write_scores(img_path, custom_dict)
+                except Exception as e:
+                    error = e
+            if error is not None:
+                if on_error is None:
+                    raise error
+                metrics.inc('images_failed')
+                on_error(img_path, error)
+                continue
+            metrics.inc('images_scored')
+            yield img_path, custom_dict
+
+# Scores images batch_size at a time, yielding (img_path, custom_dict) for each image
+# in input order as soon as its batch has been scored (and written when write_exif is set).
+# Decoding of the next images overlaps with the forward pass of the current batch,
+# and images found in the score cache are not decoded at all.
+# Without on_error the first unreadable image raises, with it on_error(img_path, error)
+# is called for that image and the rest carry on. While a scoring daemon runs the images are
+# sent to it instead and the net isn't loaded here
+def predict_images(img_paths, batch_size=BATCH_SIZE, write_exif=True,
+                   prefetch_depth=PREFETCH_DEPTH, decode_workers=PREFETCH_WORKERS, use_cache=True,
+                   on_error=None, use_daemon=True):
+    if use_daemon and daemon_available():
+        yield from predict_images_daemon(img_paths, batch_size, write_exif, use_cache, on_error)
+        return
+
+    cache = get_score_cache() if use_cache else None
+    load = functools.partial(load_for_scoring, cache=cache, catch_errors=on_error is not None)
+
+    pending = []
+    missing = 0
+    try:
+        for img_path, loaded in prefetch_images(img_paths, decode_workers, max(prefetch_depth, 0), load):
+            pending.append([img_path] + list(loaded))
+            if loaded[2] is not None:
+                missing += 1
+            # Hits are passed straight through unless they are queued behind a miss
+            if missing == 0 or missing == batch_size:
+                yield from score_pending(pending, cache, write_exif, on_error)
+                pending = []
+                missing = 0
+
+        if pending:
+            yield from score_pending(pending, cache, write_exif, on_error)
+    finally:
+        if cache is not None:
+            cache.commit()
+
 def calculate_rating(rating_percent):
     if rating_percent <= 12:
         rating = 1
@@ -120,30 +552,185 @@ def calculate_rating_percent(rating):
         rating_percent = 95
     return rating_percent
 
-def calculate_custom_dict(out):
+def calculate_custom_dict(out, index=0):
     custom_dict = {
-    'fc9_VividColor': float(out['fc9_VividColor'][0][0]),
-    'fc9_Symmetry': float(out['fc9_Symmetry'][0][0]),
-    'fc9_RuleOfThirds': float(out['fc9_RuleOfThirds'][0][0]),
-    'fc11_score': float(out['fc11_score'][0][0]),
-    'fc9_MotionBlur': float(out['fc9_MotionBlur'][0][0]),
-    'fc9_Repetition': float(out['fc9_Repetition'][0][0]),
-    'fc9_Content': float(out['fc9_Content'][0][0]),
-    'fc9_Light': float(out['fc9_Light'][0][0]),
-    'fc9_Object': float(out['fc9_Object'][0][0]),
-    'fc9_ColorHarmony': float(out['fc9_ColorHarmony'][0][0]),
-    'fc9_DoF': float(out['fc9_DoF'][0][0]),
-    'fc9_BalancingElement': float(out['fc9_BalancingElement'][0][0])
+    'fc9_VividColor': float(out['fc9_VividColor'][index][0]),
+    'fc9_Symmetry': float(out['fc9_Symmetry'][index][0]),
+    'fc9_RuleOfThirds': float(out['fc9_RuleOfThirds'][index][0]),
+    'fc11_score': float(out['fc11_score'][index][0]),
+    'fc9_MotionBlur': float(out['fc9_MotionBlur'][index][0]),
+    'fc9_Repetition': float(out['fc9_Repetition'][index][0]),
+    'fc9_Content': float(out['fc9_Content'][index][0]),
+    'fc9_Light': float(out['fc9_Light'][index][0]),
+    'fc9_Object': float(out['fc9_Object'][index][0]),
+    'fc9_ColorHarmony': float(out['fc9_ColorHarmony'][index][0]),
+    'fc9_DoF': float(out['fc9_DoF'][index][0]),
+    'fc9_BalancingElement': float(out['fc9_BalancingElement'][index][0])
     }
 
     return custom_dict
 
 def save_changes(img_path, rating):
-    exif_dict = piexif.load(img_path)
     rating_percent = calculate_rating_percent(rating)
-    exif_dict['0th'][piexif.ImageIFD.RatingPercent] = rating_percent
-    exif_dict['0th'][piexif.ImageIFD.Rating] = rating
-    exif_dict['0th'][piexif.ImageIFD.RatingPercent] = 10
+    write_rating(img_path, rating, rating_percent)
+
+'''
+Multi-process inference
+Each worker process owns one net. Where fork is available the net is loaded in the parent
+first so the workers share its weight pages copy-on-write instead of loading their own copy
+'''
+BLAS_THREAD_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+
+def set_blas_threads(num_threads):
+    for name in BLAS_THREAD_VARS:
+        os.environ[name] = str(num_threads)
+    cv2.setNumThreads(num_threads)
+
+    # BLAS may already be initialised (forked after load_model), so also ask it directly
+    try:
+        import ctypes
+        process = ctypes.CDLL(None)
+    except (OSError, TypeError):
+        return  # Not supported on Windows, the environment variables cover spawned workers
+    for symbol in ('openblas_set_num_threads', 'MKL_Set_Num_Threads', 'omp_set_num_threads'):
+        try:
+            getattr(process, symbol)(num_threads)
+        except AttributeError:
+            pass
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+pool_cancelled = None  # Event set by InferencePool.cancel(), seen by every worker
+
+def pool_worker_init(worker_ids, cpu_sets, blas_threads, backend_name, cancelled=None):
+    global pool_cancelled
+
+    pool_cancelled = cancelled
+    set_blas_threads(blas_threads)
+    set_backend(backend_name)
+    metrics.reset()  # Forked workers start from the parent's counters
+
+    try:
+        worker_id = worker_ids.get_nowait()
+    except queue.Empty:
+        worker_id = None  # Replacement worker, leave it unpinned
+    if cpu_sets and worker_id is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpu_sets[worker_id])
+
+    load_model()
+
+def pool_score_chunk(img_paths, batch_size, write_exif, use_cache=True, catch_errors=False, collect_metrics=False):
+    # Workers are pinned to few cores, so decoding runs inline rather than on prefetch threads.
+    # Returns [(img_path, custom_dict, error)] so failures can be reported back in the parent,
+    # along with the metrics recorded for the chunk. collect_metrics follows the parent for each
+    # chunk, so enabling the stats panel after the pool was started takes effect right away
+    metrics.enable(collect_metrics)
+    results = []
+    if pool_cancelled is not None and pool_cancelled.is_set():
+        return results, metrics.drain()  # Queued before a cancel, left unscored
+
+    def on_error(img_path, error):
+        results.append((img_path, None, error))
+
+    for img_path, custom_dict in predict_images(img_paths, batch_size, write_exif, prefetch_depth=0,
+                                                use_cache=use_cache,
+                                                on_error=on_error if catch_errors else None,
+                                                use_daemon=False):
+        results.append((img_path, custom_dict, None))
+    return results, metrics.drain()
+
+class InferencePool(object):
+    def __init__(self, workers=None, blas_threads=1, pin_cpus=True, batch_size=BATCH_SIZE):
+        cpus = available_cpus()
+        if not workers:
+            workers = max(1, len(cpus) // blas_threads)
+        self.workers = workers
+        self.batch_size = batch_size
+        # Chunks handed to the workers but not yet consumed, bounds memory and lets cancel stop early
+        self.max_pending = 2 * workers
+
+        # Worker i gets blas_threads consecutive cores, wrapping around when oversubscribed
+        cpu_sets = None
+        if pin_cpus:
+            cpu_sets = [[cpus[(i * blas_threads + j) % len(cpus)] for j in range(blas_threads)]
+                        for i in range(workers)]
+
+        if 'fork' in multiprocessing.get_all_start_methods():
+            load_model()
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing.get_context('spawn')
+
+        worker_ids = context.Queue()
+        for i in range(workers):
+            worker_ids.put(i)
+        self.cancelled = context.Event()
+        self.pool = context.Pool(workers, initializer=pool_worker_init,
+                                 initargs=(worker_ids, cpu_sets, blas_threads, BACKEND, self.cancelled))
+
+    # Same contract as predict_images: yields (img_path, custom_dict) in input order. After cancel()
+    # no more chunks are handed out, chunks not started yet are skipped and the ones being scored
+    # are still yielded, so every file a worker wrote is reported. Closing the generator early
+    # waits for those chunks instead, no worker writes a file after it returns
+    def predict_images(self, img_paths, write_exif=True, use_cache=True, on_error=None):
+        self.cancelled.clear()
+        pending = deque()
+        chunk = []
+        args = (self.batch_size, write_exif, use_cache, on_error is not None)
+        try:
+            for img_path in img_paths:
+                if self.cancelled.is_set():
+                    chunk = []
+                    break
+                chunk.append(img_path)
+                if len(chunk) < self.batch_size:
+                    continue
+                if len(pending) >= self.max_pending:
+                    yield from self.collect(pending.popleft(), on_error)
+                pending.append(self.pool.apply_async(pool_score_chunk, (chunk,) + args + (metrics.is_enabled(),)))
+                metrics.set_gauge('pool_chunks_in_flight', len(pending))
+                chunk = []
+
+            if chunk and not self.cancelled.is_set():
+                pending.append(self.pool.apply_async(pool_score_chunk, (chunk,) + args + (metrics.is_enabled(),)))
+            while pending:
+                metrics.set_gauge('pool_chunks_in_flight', len(pending))
+                yield from self.collect(pending.popleft(), on_error)
+        finally:
+            if pending:
+                self.cancelled.set()
+                for result in pending:
+                    result.wait()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def collect(self, result, on_error):
+        with metrics.timer('pool_wait'):
+            results, delta = result.get()
+        metrics.merge(delta)
+        for img_path, custom_dict, error in results:
+            if error is not None:
+                on_error(img_path, error)
+                continue
+            yield img_path, custom_dict
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
 
-    exif_bytes = piexif.dump(exif_dict)
-    piexif.insert(exif_bytes, img_path)
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
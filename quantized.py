@@ -0,0 +1,192 @@
+import os
+import re
+
+import cv2
+import numpy as np
+
+from score_cache import user_cache_dir
+
+'''
+Reduced-precision weights for the fully connected layers.
+fc6, fc7, fc8new and the fc8_* attribute heads hold ~60M of the net's ~62M weights. They are
+stored as int8 with one scale per output neuron (or as float16) and run with NumPy, converting
+a block of rows back to float32 at a time, while the conv trunk up to pool5 runs in OpenCV's DNN
+module from a trimmed copy of the caffemodel. The small fc9_*, fc10_merge and fc11_score layers
+stay float32. Weights are converted once from the caffemodel into the user cache folder and
+rebuilt when the model files change:
+
+python quantized.py --mode int8
+'''
+MODES = ('int8', 'fp16')
+
+# Order of the bottoms of Concat9 in initModel.prototxt, which fc10_merge depends on
+ATTRIBUTES = ['BalancingElement', 'ColorHarmony', 'Content', 'DoF', 'Light', 'MotionBlur',
+              'Object', 'Repetition', 'RuleOfThirds', 'Symmetry', 'VividColor']
+
+# Output rows converted to float32 per matmul, bounds the temporary memory to ~20MB for fc6
+BLOCK_ROWS = 512
+
+def cache_path(name):
+    return os.path.join(user_cache_dir(), name)
+
+def is_fresh(path, sources):
+    if not os.path.exists(path):
+        return False
+    mtime = os.path.getmtime(path)
+    return all(os.path.getmtime(source) <= mtime for source in sources)
+
+# Writes the deploy prototxt cut before fc6, OpenCV then only keeps the conv weights of the caffemodel
+def trunk_prototxt(deploy):
+    path = cache_path(os.path.splitext(os.path.basename(deploy))[0] + '.trunk.prototxt')
+    if is_fresh(path, [deploy]):
+        return path
+
+    with open(deploy) as f:
+        text = f.read()
+    match = re.search(r'\nlayer\s*\{\s*name:\s*"fc6"', text)
+    if match is None:
+        raise ValueError("No fc6 layer in " + deploy)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text[:match.start() + 1])
+    os.replace(tmp_path, path)
+    return path
+
+CONV_LAYERS = ['conv1', 'conv2', 'conv3', 'conv4', 'conv5']
+
+def varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def proto_field(number, payload):
+    return varint(number << 3 | 2) + varint(len(payload)) + payload
+
+# Minimal NetParameter holding only the given layers' blobs (BlobProto shape + packed data),
+# loading the trunk from it avoids parsing the whole ~200MB caffemodel in every worker
+def write_caffemodel(path, layers):
+    with open(path, 'wb') as f:
+        for name, layer_type, blobs in layers:
+            layer = proto_field(1, name.encode('utf-8')) + proto_field(2, layer_type.encode('utf-8'))
+            for blob in blobs:
+                shape = proto_field(1, b''.join(varint(dim) for dim in blob.shape))
+                data = np.ascontiguousarray(blob, dtype='<f4').tobytes()
+                layer += proto_field(7, proto_field(7, shape) + proto_field(5, data))
+            f.write(proto_field(100, layer))
+
+def quantize(weights, mode):
+    if mode == 'fp16':
+        return {'w': weights.astype(np.float16)}
+
+    # Symmetric per output neuron: w ~= q * scale with q in [-127, 127]
+    scale = np.abs(weights).max(axis=1) / 127.0
+    scale[scale == 0] = 1.0
+    q = np.rint(weights / scale[:, None]).astype(np.int8)
+    return {'w': q, 'scale': scale.astype(np.float32)}
+
+def build_weights(deploy, model_file, mode, path):
+    net = cv2.dnn.readNetFromCaffe(deploy, model_file)
+
+    def params(name):
+        return net.getParam(name, 0), net.getParam(name, 1).reshape(-1)
+
+    arrays = {}
+    fc8_layers = ['fc8new'] + ['fc8_' + attribute for attribute in ATTRIBUTES]
+    # fc8new and the attribute heads all read fc7, stacked they compute Concat9 in one product
+    stacked = [params(name) for name in fc8_layers]
+    quantized_layers = [('fc6', params('fc6')), ('fc7', params('fc7')),
+                        ('fc8', (np.concatenate([w for w, b in stacked]), np.concatenate([b for w, b in stacked])))]
+    for name, (weights, bias) in quantized_layers:
+        for key, value in quantize(weights, mode).items():
+            arrays[name + '_' + key] = value
+        arrays[name + '_b'] = bias
+    arrays['fc8_sizes'] = np.array([len(b) for w, b in stacked])
+
+    for name in ['fc9_' + attribute for attribute in ATTRIBUTES] + ['fc10_merge', 'fc11_score']:
+        arrays[name + '_w'], arrays[name + '_b'] = params(name)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    trunk_model = trunk_caffemodel_path(model_file)
+    write_caffemodel(trunk_model + '.tmp', [(name, 'Convolution', params(name)) for name in CONV_LAYERS])
+    os.replace(trunk_model + '.tmp', trunk_model)
+    del net
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+def trunk_caffemodel_path(model_file):
+    return cache_path(os.path.splitext(os.path.basename(model_file))[0] + '.trunk.caffemodel')
+
+def weights_path(model_file, mode):
+    return cache_path('{}.{}.npz'.format(os.path.splitext(os.path.basename(model_file))[0], mode))
+
+def load_weights(deploy, model_file, mode):
+    if mode not in MODES:
+        raise ValueError("Unknown quantization mode: " + mode)
+    path = weights_path(model_file, mode)
+    if not is_fresh(path, [deploy, model_file]) or not is_fresh(trunk_caffemodel_path(model_file), [model_file]):
+        build_weights(deploy, model_file, mode, path)
+    with np.load(path) as data:
+        return dict((key, data[key]) for key in data.files)
+
+# Conv trunk up to pool5 as a cv2.dnn net, call after load_weights() has built the trimmed caffemodel
+def load_trunk(deploy, model_file):
+    net = cv2.dnn.readNetFromCaffe(trunk_prototxt(deploy), trunk_caffemodel_path(model_file))
+    net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+    net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+    return net
+
+class QuantizedHeads(object):
+    def __init__(self, weights):
+        self.weights = weights
+        self.fc8_splits = np.cumsum(weights['fc8_sizes'])[:-1]
+
+    def dense(self, x, name):
+        w = self.weights[name + '_w']
+        scale = self.weights.get(name + '_scale')
+        out = np.empty((x.shape[0], w.shape[0]), dtype=np.float32)
+        for start in range(0, w.shape[0], BLOCK_ROWS):
+            block = w[start:start + BLOCK_ROWS].astype(np.float32)
+            out[:, start:start + BLOCK_ROWS] = np.dot(x, block.T)
+        if scale is not None:
+            out *= scale
+        out += self.weights[name + '_b']
+        return out
+
+    # pool5 activations (N, 9216) -> dict of output blobs shaped like the net's, (N, 1) each
+    def forward(self, pool5):
+        relu = lambda x: np.maximum(x, 0, out=x)
+        fc7 = relu(self.dense(relu(self.dense(pool5, 'fc6')), 'fc7'))
+        concat9 = relu(self.dense(fc7, 'fc8'))
+
+        out = {}
+        heads = np.split(concat9, self.fc8_splits, axis=1)[1:]
+        for attribute, head in zip(ATTRIBUTES, heads):
+            name = 'fc9_' + attribute
+            out[name] = np.dot(head, self.weights[name + '_w'].T) + self.weights[name + '_b']
+        fc10 = relu(np.dot(concat9, self.weights['fc10_merge_w'].T) + self.weights['fc10_merge_b'])
+        out['fc11_score'] = np.dot(fc10, self.weights['fc11_score_w'].T) + self.weights['fc11_score_b']
+        return out
+
+if __name__ == '__main__':
+    import argparse
+    from model import DEPLOY, MODEL_FILE
+
+    parser = argparse.ArgumentParser(description="Build the reduced-precision weights ahead of time")
+    parser.add_argument('--mode', choices=MODES, default='int8')
+    args = parser.parse_args()
+
+    trunk_prototxt(DEPLOY)
+    path = weights_path(MODEL_FILE, args.mode)
+    build_weights(DEPLOY, MODEL_FILE, args.mode, path)
+    print("{} ({:.1f} MB)".format(path, os.path.getsize(path) / 1e6))
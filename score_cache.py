@@ -0,0 +1,216 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from jpeg_utils import iter_segments
+from exif_io import orientation
+
+'''
+Persistent cache of model outputs keyed on image content.
+Entries are keyed on a hash of the JPEG without its APP0 (JFIF) and APP1 (EXIF/XMP) segments,
+which piexif replaces when inserting EXIF, so writing the rating back, renaming the file or
+copying it elsewhere still hits, plus a key for the model files and inference settings. The EXIF
+Orientation is hashed in as well since the decoder rotates by it, so a lossless rotate misses.
+When the model files change every entry is dropped on open. Several processes share the file
+(GUI, pool workers, the daemon, batch_score.py), so no write is left open between calls: the
+last_used times of hits are kept in memory and written in one short transaction every few
+seconds or hundreds of hits
+'''
+METADATA_MARKERS = (0xE0, 0xE1)  # APP0, APP1
+HASH_CHUNK = 1 << 20
+MAX_ENTRIES = 200000
+TOUCH_FLUSH_INTERVAL = 5.0  # s between writes of the last_used times of hits
+TOUCH_FLUSH_SIZE = 256
+
+def user_cache_dir():
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+        return os.path.join(base, 'AestheticSense', 'Cache')
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'aestheticsense')
+
+DEFAULT_CACHE_PATH = os.path.join(user_cache_dir(), 'scores.sqlite')
+
+# Hash of the file with the APP0/APP1 segments left out, i.e. of the pixel data and the remaining
+# headers, plus the EXIF Orientation when it rotates or flips the image
+def content_hash(img_path):
+    digest = hashlib.sha1()
+    with open(img_path, 'rb') as f:
+        skipped = [(offset, offset + 2 + length) for marker, offset, length in iter_segments(f)
+                   if marker in METADATA_MARKERS]
+        position = 0
+        f.seek(0)
+        for start, end in skipped:
+            hash_range(f, digest, position, start)
+            position = end
+        hash_range(f, digest, position, None)
+        rotation = orientation(f)
+        if rotation not in (None, 1):  # Unrotated images keep the keys they had before
+            digest.update('orientation:{}'.format(rotation).encode('ascii'))
+    return digest.hexdigest()
+
+def hash_range(f, digest, start, end):
+    f.seek(start)
+    remaining = None if end is None else end - start
+    while remaining is None or remaining > 0:
+        size = HASH_CHUNK if remaining is None else min(HASH_CHUNK, remaining)
+        data = f.read(size)
+        if not data:
+            return
+        digest.update(data)
+        if remaining is not None:
+            remaining -= len(data)
+
+# Fingerprint of the model files. Hashing the ~200MB caffemodel is only redone when its size
+# or mtime changes, the previous result is kept in the cache's meta table
+def files_stat(paths):
+    stats = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stats.append('{}:{}:{}'.format(os.path.basename(path), st.st_size, int(st.st_mtime)))
+        except OSError:
+            stats.append('{}:missing'.format(os.path.basename(path)))
+    return '|'.join(stats)
+
+def files_hash(paths):
+    digest = hashlib.sha1()
+    for path in paths:
+        digest.update(os.path.basename(path).encode('utf-8'))
+        try:
+            with open(path, 'rb') as f:
+                hash_range(f, digest, 0, None)
+        except (IOError, OSError):
+            digest.update(b'missing')
+    return digest.hexdigest()
+
+class ScoreCache(object):
+    def __init__(self, path=DEFAULT_CACHE_PATH, model_files=(), variant='', max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.puts_since_prune = 0
+        self.touched = {}  # content_hash -> last_used of the hits not written yet
+        self.last_flush = time.time()
+
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS scores (content_hash TEXT, model_key TEXT, '
+                          'scores TEXT, last_used REAL, PRIMARY KEY (content_hash, model_key))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used)')
+        self.conn.commit()
+
+        self.model_key = hashlib.sha1(
+            (self.check_model(model_files) + '|' + variant).encode('utf-8')).hexdigest()
+
+    def get_meta(self, key):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def check_model(self, model_files):
+        if not model_files:
+            return ''
+        with self.lock:
+            stat = files_stat(model_files)
+            fingerprint = self.get_meta('model_fingerprint')
+            if self.get_meta('model_stat') != stat or fingerprint is None:
+                new_fingerprint = files_hash(model_files)
+                if fingerprint is not None and fingerprint != new_fingerprint:
+                    self.conn.execute('DELETE FROM scores')  # Model changed, every score is stale
+                fingerprint = new_fingerprint
+                self.set_meta('model_stat', stat)
+                self.set_meta('model_fingerprint', fingerprint)
+                self.conn.commit()
+            return fingerprint
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute('SELECT scores FROM scores WHERE content_hash = ? AND model_key = ?',
+                                    (key, self.model_key)).fetchone()
+            if row is None:
+                return None
+            self.touched[key] = time.time()
+            if len(self.touched) >= TOUCH_FLUSH_SIZE or time.time() - self.last_flush >= TOUCH_FLUSH_INTERVAL:
+                try:
+                    self.flush_touched()
+                    self.conn.commit()
+                except sqlite3.OperationalError:
+                    self.conn.rollback()  # Busy, last_used only orders pruning so the hit still counts
+            return json.loads(row[0])
+
+    # Writes the last_used times of the hits, called with the lock held and committed right after
+    def flush_touched(self):
+        self.last_flush = time.time()
+        if not self.touched:
+            return
+        touched = self.touched
+        self.touched = {}
+        self.conn.executemany('UPDATE scores SET last_used = ? WHERE content_hash = ? AND model_key = ?',
+                              [(last_used, key, self.model_key) for key, last_used in touched.items()])
+
+    def put_many(self, items):
+        now = time.time()
+        with self.lock:
+            self.conn.executemany('INSERT OR REPLACE INTO scores (content_hash, model_key, scores, last_used) '
+                                  'VALUES (?, ?, ?, ?)',
+                                  [(key, self.model_key, json.dumps(custom_dict), now) for key, custom_dict in items])
+            self.flush_touched()
+            self.puts_since_prune += len(items)
+            if self.puts_since_prune >= 1000:
+                self.prune()
+            self.conn.commit()
+
+    def commit(self):
+        with self.lock:
+            self.flush_touched()
+            self.conn.commit()
+
+    # Drops the least recently used entries beyond max_entries, called with the lock held
+    def prune(self):
+        self.puts_since_prune = 0
+        count = self.conn.execute('SELECT COUNT(*) FROM scores').fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute('DELETE FROM scores WHERE rowid IN (SELECT rowid FROM scores '
+                              'ORDER BY last_used LIMIT ?)', (count - self.max_entries,))
+
+    def invalidate(self):
+        with self.lock:
+            self.conn.execute('DELETE FROM scores')
+            self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            count = self.conn.execute('SELECT COUNT(*) FROM scores').fetchone()[0]
+        return {'path': self.path, 'entries': count, 'max_entries': self.max_entries}
+
+    def close(self):
+        with self.lock:
+            self.flush_touched()
+            self.conn.commit()
+            self.conn.close()
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect or clear the inference result cache")
+    parser.add_argument('--path', default=DEFAULT_CACHE_PATH)
+    parser.add_argument('--clear', action='store_true', help="Remove every cached score")
+    args = parser.parse_args()
+
+    cache = ScoreCache(args.path)
+    if args.clear:
+        cache.invalidate()
+    print(json.dumps(cache.stats()))
+    cache.close()
@@ -0,0 +1,337 @@
+import os
+import sys
+import json
+import time
+import queue
+import socket
+import struct
+import functools
+import threading
+import socketserver
+from concurrent.futures import Future
+
+'''
+Local scoring daemon.
+Loads the model once and serves scores over a Unix domain socket, so GUI instances and scripts
+share one copy of the weights and skip the net load. Requests from all clients are decoded on
+their connection threads and coalesced into batched forward passes: a batch is run once it holds
+batch_size images or max_wait seconds after its first image arrived.
+
+python score_daemon.py [--socket PATH] [--batch-size 16] [--max-wait-ms 10] [--backend opencv]
+
+Messages in both directions are a '>II' header (JSON length, body length), a UTF-8 JSON object
+and an optional binary body. Requests:
+  {"op": "score", "path": "/abs/path.jpg"}        score a file the daemon can read
+  {"op": "score"} + JPEG bytes as the body         score an image sent by the client
+  {"op": "score_batch", "paths": [...]}            score several files, "cache": false skips the cache
+  {"op": "health"}, {"op": "stats"}
+Responses are {"ok": true, ...} ({"scores": calculate_custom_dict payload} for score, {"results":
+[{"scores": ...} or {"error": "..."} per path]} for score_batch) or {"ok": false, "error": "..."}.
+Cache hits never leave a write open on the shared cache file (see score_cache.py), so a daemon
+serving hits doesn't lock out the other processes writing scores. Not available where AF_UNIX is missing (Windows), clients then
+just report the daemon as not running
+'''
+CONNECT_TIMEOUT = 0.5
+REQUEST_TIMEOUT = 120.0
+MAX_BODY = 256 << 20
+
+def default_socket_path():
+    if os.environ.get('AESTHETIC_SOCKET'):
+        return os.environ['AESTHETIC_SOCKET']
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'aestheticsense.sock')
+    from score_cache import user_cache_dir
+    return os.path.join(user_cache_dir(), 'daemon.sock')
+
+SOCKET_PATH = default_socket_path()
+
+def recv_exact(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise EOFError("Connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+def send_message(sock, header, body=b''):
+    data = json.dumps(header).encode('utf-8')
+    sock.sendall(struct.pack('>II', len(data), len(body)) + data + body)
+
+def recv_message(sock):
+    header_size, body_size = struct.unpack('>II', recv_exact(sock, 8))
+    if body_size > MAX_BODY:
+        raise ValueError("Message too large")
+    header = json.loads(recv_exact(sock, header_size).decode('utf-8'))
+    return header, recv_exact(sock, body_size) if body_size else b''
+
+'''
+Client
+'''
+class DaemonError(Exception):
+    pass
+
+class DaemonClient(object):
+    def __init__(self, path=None, timeout=REQUEST_TIMEOUT):
+        self.path = path or SOCKET_PATH
+        self.timeout = timeout
+
+    def request(self, header, body=b''):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise DaemonError("Unix domain sockets are not supported on this platform")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(CONNECT_TIMEOUT)
+            sock.connect(self.path)
+            sock.settimeout(self.timeout)
+            send_message(sock, header, body)
+            response, _ = recv_message(sock)
+        finally:
+            sock.close()
+        if not response.get('ok'):
+            raise DaemonError(response.get('error', 'Unknown error'))
+        return response
+
+    def score_path(self, img_path):
+        return self.request({'op': 'score', 'path': os.path.abspath(img_path)})['scores']
+
+    # [{'scores': custom_dict} or {'error': message}] in the order of img_paths
+    def score_paths(self, img_paths, use_cache=True):
+        header = {'op': 'score_batch', 'paths': [os.path.abspath(img_path) for img_path in img_paths]}
+        if not use_cache:
+            header['cache'] = False
+        return self.request(header)['results']
+
+    def score_bytes(self, data):
+        return self.request({'op': 'score'}, data)['scores']
+
+    def health(self):
+        return self.request({'op': 'health'})
+
+    def stats(self):
+        return self.request({'op': 'stats'})
+
+def is_running(path=None):
+    try:
+        DaemonClient(path, timeout=CONNECT_TIMEOUT).health()
+        return True
+    except (OSError, EOFError, ValueError, DaemonError):
+        return False
+
+# Scores through the daemon, None when no daemon is listening so the caller scores locally.
+# Errors about the image itself (unreadable file) are raised like local scoring would
+def try_score_path(img_path, path=None):
+    path = path or SOCKET_PATH
+    if not os.path.exists(path):
+        return None
+    try:
+        return DaemonClient(path).score_path(img_path)
+    except (OSError, EOFError, ValueError):
+        return None  # Stale socket or daemon went away
+    except DaemonError as e:
+        raise IOError(str(e))
+
+'''
+Server
+'''
+class MicroBatcher(object):
+    def __init__(self, forward, batch_size, max_wait):
+        self.forward = forward
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.images = 0
+        self.thread = threading.Thread(target=self.run, name='micro-batcher', daemon=True)
+        self.thread.start()
+
+    def submit(self, img):
+        future = Future()
+        self.queue.put((img, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                scores = self.forward([img for img, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.images += len(batch)
+            for (_, future), custom_dict in zip(batch, scores):
+                future.set_result(custom_dict)
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128  # Listen backlog, many clients connect at once when a batch starts
+
+    def __init__(self, path, batch_size, max_wait):
+        import model
+        import metrics
+
+        self.model = model
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.cache = model.get_score_cache()
+        metrics.enable()
+        model.load_model()
+        self.batcher = MicroBatcher(model.forward_images, batch_size, max_wait)
+
+        socketserver.UnixStreamServer.__init__(self, path, DaemonHandler)
+        os.chmod(path, 0o600)  # Only the user running the daemon may send it paths to read
+
+    def score(self, header, body):
+        model = self.model
+        if 'path' in header:
+            key, custom_dict, img, _ = model.load_for_scoring(header['path'], self.cache)
+            if custom_dict is not None:
+                return custom_dict
+        else:
+            key, img = None, model.prepare_image_bytes(body)
+
+        custom_dict = self.batcher.submit(img).result()
+        if key is not None:
+            self.cache.put_many([(key, custom_dict)])
+        return custom_dict
+
+    # Files of one request are decoded on the prefetch threads and their misses are submitted to
+    # the batcher as they come, so they share forward passes with each other and other clients
+    def score_paths(self, img_paths, use_cache=True):
+        model = self.model
+        cache = self.cache if use_cache else None
+        load = functools.partial(model.load_for_scoring, cache=cache, catch_errors=True)
+        pending = []
+        for img_path, (key, custom_dict, img, error) in model.prefetch_images(img_paths, load=load):
+            if img is not None:
+                pending.append((key, self.batcher.submit(img)))
+            else:
+                pending.append((None, error if error is not None else custom_dict))
+
+        results = []
+        new_entries = []
+        for key, value in pending:
+            if isinstance(value, Future):
+                try:
+                    value = value.result()
+                except Exception as e:
+                    value = e
+                if key is not None and not isinstance(value, Exception):
+                    new_entries.append((key, value))
+            if isinstance(value, Exception):
+                results.append({'error': str(value) or type(value).__name__})
+            else:
+                results.append({'scores': value})
+        if cache is not None and new_entries:
+            cache.put_many(new_entries)
+        return results
+
+    def health(self):
+        return {'status': 'ok', 'pid': os.getpid(), 'backend': self.model.BACKEND,
+                'uptime_seconds': time.time() - self.started}
+
+    def stats(self):
+        import metrics
+
+        batcher = self.batcher
+        stats = self.health()
+        stats.update({'requests': self.requests, 'errors': self.errors, 'batches': batcher.batches,
+                      'images': batcher.images, 'queue_depth': batcher.queue.qsize(),
+                      'mean_batch_size': batcher.images / batcher.batches if batcher.batches else None,
+                      'batch_size': batcher.batch_size, 'max_wait_ms': 1000.0 * batcher.max_wait,
+                      'metrics': metrics.snapshot()})
+        return stats
+
+class DaemonHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        while True:
+            try:
+                header, body = recv_message(self.request)
+            except (EOFError, OSError, ValueError):
+                return
+
+            server.requests += 1
+            op = header.get('op')
+            try:
+                if op == 'score':
+                    response = {'ok': True, 'scores': server.score(header, body)}
+                elif op == 'score_batch':
+                    response = {'ok': True, 'results': server.score_paths(header['paths'], header.get('cache', True))}
+                elif op == 'health':
+                    response = dict(server.health(), ok=True)
+                elif op == 'stats':
+                    response = dict(server.stats(), ok=True)
+                else:
+                    response = {'ok': False, 'error': 'Unknown op: {}'.format(op)}
+            except Exception as e:
+                server.errors += 1
+                response = {'ok': False, 'error': str(e) or type(e).__name__}
+
+            try:
+                send_message(self.request, response)
+            except OSError:
+                return
+
+def serve(path=None, batch_size=None, max_wait=0.01):
+    import model
+
+    path = path or SOCKET_PATH
+    if os.path.exists(path):
+        if is_running(path):
+            raise RuntimeError("A scoring daemon is already listening on " + path)
+        os.remove(path)  # Left behind by a daemon that was killed
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+
+    server = DaemonServer(path, batch_size or model.BATCH_SIZE, max_wait)
+    sys.stderr.write("Scoring daemon ({} backend) listening on {}\n".format(model.BACKEND, path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if server.cache is not None:
+            server.cache.commit()
+        if os.path.exists(path):
+            os.remove(path)
+
+if __name__ == '__main__':
+    import signal
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve image scores to local clients over a Unix socket")
+    parser.add_argument('--socket', default=SOCKET_PATH, help="Socket path (default: %(default)s)")
+    parser.add_argument('--batch-size', type=int, default=None, help="Maximum images per forward pass")
+    parser.add_argument('--max-wait-ms', type=float, default=10.0,
+                        help="Longest a request waits for others to share its batch")
+    parser.add_argument('--backend', help="Inference backend (default: caffe)")
+    parser.add_argument('--status', action='store_true', help="Print the running daemon's stats and exit")
+    args = parser.parse_args()
+
+    if args.status:
+        print(json.dumps(DaemonClient(args.socket).stats(), indent=2, sort_keys=True))
+        sys.exit(0)
+    if args.backend:
+        import model
+        model.set_backend(args.backend)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    serve(args.socket, args.batch_size, args.max_wait_ms / 1000.0)
@@ -0,0 +1,225 @@
+import re
+import json
+import threading
+
+import numpy as np
+
+from exif_io import read_rating_tags
+from library_scan import file_signature
+from model import OUTPUT_BLOBS, calculate_rating
+
+'''
+In-memory columnar index of the scores of the images in the gallery.
+One float32 NumPy array per field (rating, rating_percent and the model outputs), NaN where an
+image has no value. It is filled once from the EXIF headers when a folder is loaded and kept up
+to date from the scores the GUI writes, so filtering on rating ranges or attribute thresholds,
+sorting and top-K by any field are array operations without file I/O. The size and mtime of each
+file when it was read are kept too, to tell when a file changed on disk since. With a library
+catalog (see catalog.py) files whose size and mtime match the catalog aren't read at all, and
+every change made through the index is written to the catalog. The index is locked, the UI
+thread can query it while a loader thread fills it, and files are read outside the lock
+'''
+FIELDS = ['rating', 'rating_percent'] + OUTPUT_BLOBS
+OPERATORS = {'<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal,
+             '==': np.equal, '=': np.equal, '!=': np.not_equal}
+CONDITION = re.compile(r'^\s*(\w+)\s*(<=|>=|==|!=|<|>|=)\s*(-?[\d.]+)\s*$')
+
+# Field values stored in the EXIF of an image, missing fields are left out
+def read_scores(img_path):
+    tags = read_rating_tags(img_path)
+    record = dict((key, tags[key]) for key in ('rating', 'rating_percent') if key in tags)
+    try:
+        custom_dict = json.loads(tags['user_comment'])
+    except (KeyError, ValueError, TypeError):
+        custom_dict = None  # Not analysed, or a comment written by something else
+    if isinstance(custom_dict, dict):
+        record.update((key, value) for key, value in custom_dict.items() if key in OUTPUT_BLOBS)
+    return record
+
+# The fields predict_image writes for a calculate_custom_dict result
+def scores_record(custom_dict):
+    rating_percent = int(custom_dict['fc11_score']*100)
+    record = dict((key, custom_dict[key]) for key in OUTPUT_BLOBS if key in custom_dict)
+    record['rating'] = calculate_rating(rating_percent)
+    record['rating_percent'] = rating_percent
+    return record
+
+# "rating >= 4, fc9_MotionBlur < -0.2" -> [('rating', '>=', 4.0), ('fc9_MotionBlur', '<', -0.2)]
+def parse_conditions(text):
+    conditions = []
+    for part in text.split(','):
+        if not part.strip():
+            continue
+        match = CONDITION.match(part)
+        if match is None:
+            raise ValueError("Can't read condition: " + part.strip())
+        field, operator, value = match.groups()
+        if field not in FIELDS:
+            raise ValueError("Unknown field: " + field)
+        conditions.append((field, operator, float(value)))
+    return conditions
+
+class ScoreIndex(object):
+    def __init__(self, capacity=1024, catalog=None):
+        self.catalog = catalog
+        self.lock = threading.RLock()
+        self.paths = []
+        self.rows = {}  # img_path -> row
+        self.signatures = {}  # img_path -> (size, mtime_ns) when its EXIF was read
+        self.columns = dict((field, np.full(capacity, np.nan, dtype=np.float32)) for field in FIELDS)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.paths)
+
+    def __contains__(self, img_path):
+        with self.lock:
+            return img_path in self.rows
+
+    def signature(self, img_path):
+        with self.lock:
+            return self.signatures.get(img_path)
+
+    # Value of field for img_path, None when the image isn't indexed or has no value
+    def value(self, img_path, field):
+        with self.lock:
+            row = self.rows.get(img_path)
+            if row is None:
+                return None
+            value = self.columns[field][row]
+        return None if np.isnan(value) else float(value)
+
+    def column(self, field):
+        return self.columns[field][:len(self.paths)]
+
+    # Called with the lock held
+    def add(self, img_path, record=None):
+        row = self.rows.get(img_path)
+        if row is None:
+            row = len(self.paths)
+            if row == len(self.columns['rating']):
+                for field, values in self.columns.items():
+                    grown = np.full(2 * len(values), np.nan, dtype=np.float32)
+                    grown[:row] = values
+                    self.columns[field] = grown
+            self.paths.append(img_path)
+            self.rows[img_path] = row
+        for field in FIELDS:
+            self.columns[field][row] = np.nan
+        self.set_values(row, record or {})
+        return row
+
+    # Field values of a row, NaN fields left out
+    def record(self, row):
+        record = {}
+        for field in FIELDS:
+            value = self.columns[field][row]
+            if not np.isnan(value):
+                record[field] = float(value)
+        return record
+
+    def set_values(self, row, record):
+        for field, value in record.items():
+            if field in self.columns and value is not None:
+                self.columns[field][row] = value
+
+    # Reads the EXIF of each image, unreadable files are indexed without values. signatures is
+    # img_path -> (size, mtime_ns) when the caller already has them from a folder scan
+    def load(self, img_paths, signatures=None):
+        for img_path in img_paths:
+            self.refresh(img_path, signatures.get(img_path) if signatures else None)
+        if self.catalog is not None:
+            self.catalog.commit()
+        return self
+
+    def refresh(self, img_path, signature=None):
+        if signature is None:
+            signature = file_signature(img_path)
+        record = None
+        if self.catalog is not None and signature is not None:
+            record = self.catalog.lookup(img_path, signature)
+        if record is None:
+            try:
+                record = read_scores(img_path)
+            except Exception:
+                record = {}
+            if self.catalog is not None and signature is not None:
+                self.catalog.put(img_path, signature, record)
+        with self.lock:
+            self.signatures[img_path] = signature
+            self.add(img_path, record)
+
+    # Values the app has just written into the file
+    def update(self, img_path, record):
+        signature = file_signature(img_path)
+        with self.lock:
+            row = self.rows.get(img_path)
+            if row is None:
+                row = self.add(img_path, record)
+            else:
+                self.set_values(row, record)
+            self.signatures[img_path] = signature
+            record = self.record(row)
+        if self.catalog is not None and signature is not None:
+            self.catalog.put(img_path, signature, record)
+            self.catalog.commit()
+
+    def remove(self, img_paths):
+        img_paths = list(img_paths)
+        if self.catalog is not None:
+            self.catalog.remove(img_paths)
+            self.catalog.commit()
+        with self.lock:
+            rows = [self.rows.pop(img_path) for img_path in img_paths if img_path in self.rows]
+            for img_path in img_paths:
+                self.signatures.pop(img_path, None)
+            if not rows:
+                return
+            size = len(self.paths)
+            for field, values in self.columns.items():
+                kept = np.delete(values[:size], rows)
+                values[:len(kept)] = kept
+                values[len(kept):size] = np.nan
+            removed = set(rows)
+            self.paths = [img_path for row, img_path in enumerate(self.paths) if row not in removed]
+            self.rows = dict((img_path, row) for row, img_path in enumerate(self.paths))
+
+    def rename(self, old_path, new_path):
+        with self.lock:
+            row = self.rows.pop(old_path, None)
+            if row is None:
+                return
+            self.paths[row] = new_path
+            self.rows[new_path] = row
+            self.signatures[new_path] = self.signatures.pop(old_path, None)
+        if self.catalog is not None:
+            self.catalog.rename(old_path, new_path)
+            self.catalog.commit()
+
+    # Boolean mask of the rows matching every (field, operator, value) condition, NaN never matches
+    def mask(self, conditions):
+        mask = np.ones(len(self.paths), dtype=bool)
+        for field, operator, value in conditions:
+            with np.errstate(invalid='ignore'):
+                mask &= OPERATORS[operator](self.column(field), value)
+        return mask
+
+    # Matching rows in index order, or ordered by sort_field (images without a value last),
+    # only the first top_k when given
+    def query(self, conditions=(), sort_field=None, descending=True, top_k=None):
+        with self.lock:
+            return self.query_rows(conditions, sort_field, descending, top_k)
+
+    def query_rows(self, conditions, sort_field, descending, top_k):
+        rows = np.flatnonzero(self.mask(conditions))
+        if sort_field is not None:
+            values = self.column(sort_field)[rows]
+            keys = np.where(np.isnan(values), np.inf, -values if descending else values)
+            if top_k is not None and top_k < len(rows):
+                best = np.argpartition(keys, top_k)[:top_k]
+                rows = rows[best[np.argsort(keys[best], kind='stable')]]
+            else:
+                rows = rows[np.argsort(keys, kind='stable')]
+        if top_k is not None:
+            rows = rows[:top_k]
+        return [self.paths[row] for row in rows]
@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import struct
+import shutil
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+import piexif
+import piexif.helper
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import exif_io
+from jpeg_utils import iter_segments, SOS
+
+'''
+Round trips of exif_io.write_rating through both write paths (patched in place and rewritten),
+for little- and big-endian TIFF blocks and files without EXIF, read back with rating_tags and piexif
+'''
+TAG_MAKE = piexif.ImageIFD.Make
+TYPE_ASCII = 2
+
+def plain_jpeg(path, seed=0):
+    rng = np.random.RandomState(seed)
+    img = rng.randint(0, 255, size=(48, 64, 3)).astype(np.uint8)
+    ok, data = cv2.imencode('.jpg', img)
+    with open(path, 'wb') as f:
+        f.write(data.tobytes())
+    return path
+
+# TIFF block with Make and, when given, Rating/RatingPercent in IFD0 and a UserComment of
+# comment_size bytes in the Exif IFD, laid out by hand so both byte orders can be tested
+def build_tiff(endian, rating=None, rating_percent=None, comment=None, comment_size=None):
+    order = b'II' if endian == '<' else b'MM'
+    make = b'Test\x00'
+    entries = [(TAG_MAKE, TYPE_ASCII, len(make), None)]
+    if rating is not None:
+        entries.append((exif_io.TAG_RATING, exif_io.TYPE_SHORT, 1, struct.pack(endian + 'H', rating) + b'\x00\x00'))
+    if rating_percent is not None:
+        entries.append((exif_io.TAG_RATING_PERCENT, exif_io.TYPE_SHORT, 1,
+                        struct.pack(endian + 'H', rating_percent) + b'\x00\x00'))
+    entries.append((exif_io.TAG_EXIF_IFD, exif_io.TYPE_LONG, 1, None))
+    entries.sort()
+
+    ifd0_offset = 8
+    make_offset = ifd0_offset + 2 + 12 * len(entries) + 4
+    exif_ifd_offset = make_offset + 8
+    comment_offset = exif_ifd_offset + 2 + 12 + 4
+    comment_data = b''
+    if comment is not None:
+        comment_data = exif_io.encode_comment(comment, comment_size)
+
+    tiff = order + struct.pack(endian + 'HI', 42, ifd0_offset)
+    tiff += struct.pack(endian + 'H', len(entries))
+    for tag, value_type, count, value in entries:
+        if tag == TAG_MAKE:
+            value = struct.pack(endian + 'I', make_offset)
+        elif tag == exif_io.TAG_EXIF_IFD:
+            value = struct.pack(endian + 'I', exif_ifd_offset)
+        tiff += struct.pack(endian + 'HHI', tag, value_type, count) + value
+    tiff += struct.pack(endian + 'I', 0)
+    tiff += make + b'\x00' * (exif_ifd_offset - make_offset - len(make))
+
+    exif_entries = []
+    if comment is not None:
+        exif_entries.append(struct.pack(endian + 'HHII', exif_io.TAG_USER_COMMENT, exif_io.TYPE_UNDEFINED,
+                                        len(comment_data), comment_offset))
+    tiff += struct.pack(endian + 'H', len(exif_entries)) + b''.join(exif_entries)
+    tiff += b'\x00' * (12 - 12 * len(exif_entries)) + struct.pack(endian + 'I', 0)
+    return tiff + comment_data
+
+# Inserts an APP1 segment holding tiff right after SOI
+def insert_exif(path, tiff):
+    payload = exif_io.EXIF_HEADER + tiff
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:2] + b'\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload + data[2:])
+
+def scan_data(path):
+    with open(path, 'rb') as f:
+        for marker, offset, length in iter_segments(f):
+            if marker == SOS:
+                f.seek(offset)
+                return f.read()
+    return None
+
+class WriteRatingTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='exif_io_test_')
+        self.img_path = plain_jpeg(os.path.join(self.folder, 'image.jpg'))
+        self.scan = scan_data(self.img_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def check(self, rating, rating_percent, scores):
+        tags = exif_io.read_rating_tags(self.img_path)
+        self.assertEqual(tags['rating'], rating)
+        self.assertEqual(tags['rating_percent'], rating_percent)
+        self.assertEqual(json.loads(tags['user_comment']), scores)
+
+        exif_dict = piexif.load(self.img_path)
+        self.assertEqual(exif_dict['0th'][exif_io.TAG_RATING], rating)
+        self.assertEqual(exif_dict['0th'][exif_io.TAG_RATING_PERCENT], rating_percent)
+        self.assertEqual(piexif.helper.UserComment.load(exif_dict['Exif'][exif_io.TAG_USER_COMMENT]),
+                         tags['user_comment'])
+        self.assertEqual(scan_data(self.img_path), self.scan)  # Image data untouched
+
+    def test_no_exif(self):
+        self.assertEqual(exif_io.read_rating_tags(self.img_path), {})
+        scores = {'fc11_score': 0.5}
+        written = exif_io.write_rating(self.img_path, 3, 50, json.dumps(scores))
+        self.assertEqual(written, os.path.getsize(self.img_path))  # Rewritten
+        self.check(3, 50, scores)
+
+        scores = {'fc11_score': 0.7}
+        written = exif_io.write_rating(self.img_path, 4, 70, json.dumps(scores))
+        self.assertLess(written, 200)  # The slack left by the rewrite is patched in place
+        self.check(4, 70, scores)
+
+    def test_patch_in_place(self):
+        for endian in ('<', '>'):
+            plain_jpeg(self.img_path)
+            insert_exif(self.img_path, build_tiff(endian, 1, 10, '{}', comment_size=200))
+            size = os.path.getsize(self.img_path)
+            scores = {'fc11_score': 0.9, 'fc9_Light': -0.25}
+            written = exif_io.write_rating(self.img_path, 5, 90, json.dumps(scores))
+            self.assertEqual(written, 2 + 2 + 200, endian)  # Both values and the comment
+            self.assertEqual(os.path.getsize(self.img_path), size)
+            self.assertEqual(exif_io.tiff_endian(self.tiff()), endian)
+            self.check(5, 90, scores)
+
+    def test_rewrite(self):
+        for endian in ('<', '>'):
+            # No rating tags and a comment too short for the scores
+            plain_jpeg(self.img_path)
+            insert_exif(self.img_path, build_tiff(endian, comment='{}'))
+            scores = {'fc11_score': 0.2, 'fc9_Content': 0.125}
+            written = exif_io.write_rating(self.img_path, 1, 20, json.dumps(scores))
+            self.assertEqual(written, os.path.getsize(self.img_path))
+            self.check(1, 20, scores)
+            self.assertEqual(piexif.load(self.img_path)['0th'][TAG_MAKE], b'Test')  # Other tags are kept
+
+    def test_read_both_byte_orders(self):
+        for endian in ('<', '>'):
+            plain_jpeg(self.img_path)
+            insert_exif(self.img_path, build_tiff(endian, 2, 37, '{"fc11_score": 0.37}'))
+            self.assertEqual(exif_io.read_rating_tags(self.img_path),
+                             {'rating': 2, 'rating_percent': 37, 'user_comment': '{"fc11_score": 0.37}'})
+
+    def test_malformed_exif(self):
+        insert_exif(self.img_path, b'XX' + b'\x00' * 10)
+        self.assertEqual(exif_io.read_rating_tags(self.img_path), {})
+
+    @unittest.skipIf(sys.platform == 'win32', "POSIX modes and hard links")
+    def test_rewrite_keeps_file_metadata(self):
+        os.chmod(self.img_path, 0o640)
+        os.utime(self.img_path, (1000000000, 1000000000))
+        link_path = os.path.join(self.folder, 'link.jpg')
+        os.link(self.img_path, link_path)
+
+        exif_io.write_rating(self.img_path, 4, 75, '{}')
+        self.assertTrue(os.path.samefile(self.img_path, link_path))  # Written back, not replaced
+        self.assertEqual(exif_io.read_rating_tags(link_path)['rating'], 4)
+
+        os.remove(link_path)
+        insert_exif(self.img_path, build_tiff('<'))  # No rating tags, rewritten again
+        os.utime(self.img_path, (1000000000, 1000000000))
+        exif_io.write_rating(self.img_path, 5, 95, '{}')
+        st = os.stat(self.img_path)
+        self.assertEqual(st.st_mode & 0o777, 0o640)
+        self.assertGreater(st.st_mtime, 1000000000)  # Changed files are told apart by their mtime
+        self.assertEqual([name for name in os.listdir(self.folder) if name.endswith('.exif-tmp')], [])
+
+    def tiff(self):
+        with open(self.img_path, 'rb') as f:
+            _, payload = exif_io.read_exif_segment(f)
+        return payload[len(exif_io.EXIF_HEADER):]
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+import piexif
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import exif_io
+from score_cache import content_hash
+
+'''
+content_hash keys: unchanged by metadata the rating writer touches, changed by the EXIF
+Orientation the decoder applies
+'''
+
+class ContentHashTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='score_cache_test_')
+        self.img_path = os.path.join(self.folder, 'image.jpg')
+        img = np.random.RandomState(0).randint(0, 255, size=(48, 64, 3)).astype(np.uint8)
+        cv2.imwrite(self.img_path, img)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def set_orientation(self, value):
+        exif_dict = exif_io.load_exif_dict(self.img_path)
+        exif_dict['0th'][piexif.ImageIFD.Orientation] = value
+        piexif.insert(piexif.dump(exif_dict), self.img_path)
+
+    def test_rating_keeps_key(self):
+        key = content_hash(self.img_path)
+        exif_io.write_rating(self.img_path, 3, 50, '{"fc11_score": 0.5}')
+        self.assertEqual(content_hash(self.img_path), key)
+        self.set_orientation(1)
+        self.assertEqual(content_hash(self.img_path), key)  # Upright, same pixels as without the tag
+
+    def test_orientation_changes_key(self):
+        key = content_hash(self.img_path)
+        self.set_orientation(6)
+        with open(self.img_path, 'rb') as f:
+            self.assertEqual(exif_io.orientation(f), 6)
+        rotated = content_hash(self.img_path)
+        self.assertNotEqual(rotated, key)
+        self.set_orientation(8)
+        self.assertNotIn(content_hash(self.img_path), (key, rotated))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,236 @@
+import os
+import hashlib
+import functools
+import threading
+from collections import OrderedDict
+
+import piexif
+from PyQt5.QtGui import QImage, QImageReader
+from PyQt5.QtCore import Qt, QObject, pyqtSignal
+
+from exif_io import read_exif_segment
+from score_cache import user_cache_dir
+
+'''
+Thumbnail pipeline.
+Thumbnails are made on background threads in three tiers: the thumbnail embedded in the EXIF
+when it is at least as large as the tile, otherwise a scaled decode (QImageReader.setScaledSize
+lets the JPEG decoder skip DCT coefficients instead of decoding the full image). Results are kept
+in a size-bounded disk cache keyed on path, mtime and size, so a folder seen before opens with
+its thumbnails read straight from the cache. Only QImage is used off the GUI thread, the gallery
+turns the results into QPixmaps
+'''
+THUMBNAIL_SIZE = 300
+DISK_CACHE_DIR = os.path.join(user_cache_dir(), 'thumbnails')
+DISK_CACHE_BYTES = 512 << 20
+JPEG_QUALITY = 85
+LOADER_THREADS = 2
+
+def fit_size(max_width, max_height, width, height):
+    scale = min(float(max_width) / width, float(max_height) / height, 1.0)
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+# The EXIF thumbnail when it is large enough for the tile, None otherwise (only the APP1 segment is read)
+def exif_thumbnail(img_path, size=THUMBNAIL_SIZE):
+    try:
+        with open(img_path, 'rb') as f:
+            _, payload = read_exif_segment(f)
+        if payload is None:
+            return None
+        data = piexif.load(payload).get('thumbnail')
+    except Exception:
+        return None  # No or broken EXIF, decode the image instead
+    if not data:
+        return None
+    image = QImage.fromData(data)
+    if image.isNull() or max(image.width(), image.height()) < size:
+        return None
+    return image.scaled(size, size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+# Decodes the image scaled down to fit max_width x max_height
+def decode_scaled(img_path, max_width, max_height):
+    reader = QImageReader(img_path)
+    full_size = reader.size()  # From the header, nothing is decoded yet
+    if full_size.isValid():
+        width, height = fit_size(max_width, max_height, full_size.width(), full_size.height())
+        if (width, height) != (full_size.width(), full_size.height()):
+            full_size.setWidth(width)
+            full_size.setHeight(height)
+            reader.setScaledSize(full_size)
+    return reader.read()  # Null QImage when the file can't be decoded
+
+def decode_thumbnail(img_path, size=THUMBNAIL_SIZE):
+    return decode_scaled(img_path, size, size)
+
+class ThumbnailDiskCache(object):
+    def __init__(self, path=DISK_CACHE_DIR, max_bytes=DISK_CACHE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.total_bytes = None  # Counted on the first put
+
+    def key(self, img_path, size=THUMBNAIL_SIZE):
+        st = os.stat(img_path)
+        name = '{}|{}|{}|{}'.format(os.path.abspath(img_path), st.st_mtime_ns, st.st_size, size)
+        return hashlib.sha1(name.encode('utf-8')).hexdigest()
+
+    def file_path(self, key):
+        return os.path.join(self.path, key[:2], key + '.jpg')
+
+    def get(self, key):
+        path = self.file_path(key)
+        if not os.path.exists(path):
+            return None
+        image = QImage(path)
+        if image.isNull():
+            return None
+        try:
+            os.utime(path, None)  # Recently used entries are pruned last
+        except OSError:
+            pass
+        return image
+
+    def put(self, key, image):
+        path = self.file_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+        if not image.save(tmp_path, 'JPG', JPEG_QUALITY):
+            return
+        os.replace(tmp_path, path)
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(size for _, size, _ in self.entries())
+            else:
+                self.total_bytes += os.path.getsize(path)
+            if self.total_bytes > self.max_bytes:
+                self.prune()
+
+    def entries(self):
+        entries = []
+        for folder in os.scandir(self.path):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                if entry.name.endswith('.jpg'):
+                    st = entry.stat()
+                    entries.append((entry.path, st.st_size, st.st_mtime))
+        return entries
+
+    # Removes the least recently used files down to 90% of max_bytes, called with the lock held
+    def prune(self):
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        self.total_bytes = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self.total_bytes <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self.total_bytes -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            for path, _, _ in self.entries():
+                os.remove(path)
+            self.total_bytes = 0
+
+# Cached thumbnail, else the EXIF thumbnail, else a scaled decode. A null QImage when the
+# file is gone or not an image
+def load_thumbnail(img_path, size=THUMBNAIL_SIZE, disk_cache=None):
+    try:
+        key = disk_cache.key(img_path, size) if disk_cache is not None else None
+    except OSError:
+        return QImage()
+    if key is not None:
+        image = disk_cache.get(key)
+        if image is not None:
+            return image
+
+    image = exif_thumbnail(img_path, size)
+    if image is None:
+        image = decode_thumbnail(img_path, size)
+    if key is not None and not image.isNull():
+        try:
+            disk_cache.put(key, image)
+        except OSError:
+            pass  # Cache folder not writable, the thumbnail is still shown
+    return image
+
+# Runs load(key) on background threads and emits (key, result) as each is ready. Requests are
+# served newest first since they come from what was shown last, cancel() drops the ones not started
+class ImageLoader(QObject):
+    loaded = pyqtSignal(object, object)
+
+    def __init__(self, load, parent=None, threads=LOADER_THREADS):
+        super().__init__(parent)
+        self.load = load
+        self.requests = OrderedDict()  # key -> None
+        self.in_flight = set()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.threads = [threading.Thread(target=self.run, name='thumbnail-loader', daemon=True)
+                        for _ in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def request(self, key):
+        with self.condition:
+            if key in self.in_flight:
+                return
+            self.requests[key] = None
+            self.requests.move_to_end(key)
+            self.condition.notify()
+
+    def cancel(self):
+        with self.condition:
+            self.requests.clear()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.requests and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                key, _ = self.requests.popitem()
+                self.in_flight.add(key)
+
+            result = self.load(key)
+            with self.condition:
+                self.in_flight.discard(key)
+                if self.stopped:
+                    return
+            self.loaded.emit(key, result)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.requests.clear()
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+# Gallery thumbnails, emits (img_path, QImage)
+class ThumbnailLoader(ImageLoader):
+    def __init__(self, parent=None, size=THUMBNAIL_SIZE, disk_cache=None, threads=LOADER_THREADS):
+        super().__init__(functools.partial(load_thumbnail, size=size, disk_cache=disk_cache), parent, threads)
+
+if __name__ == '__main__':
+    import json
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect or clear the thumbnail cache")
+    parser.add_argument('--path', default=DISK_CACHE_DIR)
+    parser.add_argument('--clear', action='store_true', help="Remove every cached thumbnail")
+    args = parser.parse_args()
+
+    cache = ThumbnailDiskCache(args.path)
+    if os.path.isdir(args.path):
+        if args.clear:
+            cache.clear()
+        entries = cache.entries()
+    else:
+        entries = []
+    print(json.dumps({'path': args.path, 'entries': len(entries),
+                      'bytes': sum(size for _, size, _ in entries), 'max_bytes': cache.max_bytes}))
@@ -0,0 +1,70 @@
+from PyQt5.QtGui import QPixmap
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from gallery import PixmapCache
+from thumbnails import ImageLoader, decode_scaled
+
+'''
+Display-size image cache of the full image viewer.
+Images are decoded straight at the size of the viewer (a scaled JPEG decode, not a full
+resolution pixmap scaled afterwards) on background threads and kept as QPixmaps in a
+byte-bounded LRU. Showing an image queues it first and its neighbours (radius on each side,
+nearest first) behind it, so stepping with Previous/Next is served from the cache. An image that
+isn't ready yet is announced with ready(img_path) once it is. Changing the viewer size drops
+everything, the cached pixmaps no longer fit
+'''
+PREFETCH_RADIUS = 2
+VIEWER_CACHE_BYTES = 96 << 20
+VIEWER_THREADS = 2
+
+def load_display_image(key):
+    img_path, width, height = key
+    return decode_scaled(img_path, width, height)
+
+class FullImageCache(QObject):
+    ready = pyqtSignal(str)
+
+    def __init__(self, parent=None, radius=PREFETCH_RADIUS, max_bytes=VIEWER_CACHE_BYTES):
+        super().__init__(parent)
+        self.radius = radius
+        self.size = None
+        self.pixmaps = PixmapCache(max_bytes)
+        self.loader = ImageLoader(load_display_image, self, VIEWER_THREADS)
+        self.loader.loaded.connect(self.on_loaded)
+
+    def set_size(self, width, height):
+        if self.size != (width, height):
+            self.size = (width, height)
+            self.loader.cancel()
+            self.pixmaps = PixmapCache(self.pixmaps.max_bytes)
+
+    # The display-size pixmap of img_path, or None while it is decoded. Its neighbours around
+    # index in img_paths are queued too, the loader serves the newest request first so they are
+    # queued farthest first and img_path last
+    def show(self, img_path, img_paths=(), index=-1):
+        self.loader.cancel()
+        if index >= 0:
+            for distance in range(self.radius, 0, -1):
+                for neighbour in (index + distance, index - distance):
+                    if 0 <= neighbour < len(img_paths):
+                        self.request(img_paths[neighbour])
+        pixmap = self.pixmaps.get(img_path)
+        if pixmap is None:
+            self.request(img_path)
+        return pixmap
+
+    def request(self, img_path):
+        if img_path not in self.pixmaps:
+            self.loader.request((img_path,) + self.size)
+
+    def on_loaded(self, key, image):
+        img_path, width, height = key
+        if (width, height) == self.size:
+            self.pixmaps.put(img_path, QPixmap.fromImage(image))  # Null when the file can't be decoded
+            self.ready.emit(img_path)
+
+    def invalidate(self, img_path):
+        self.pixmaps.pop(img_path)
+
+    def stop(self):
+        self.loader.stop()